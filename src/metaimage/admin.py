@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from metaimage.models import MetaImage
+from metaimage.models import IngestJob, IngestRecord, MetaImage, SourceURL
 
 
 class BaseModelAdmin(admin.ModelAdmin):
@@ -25,15 +25,43 @@ class MetaImageAdmin(BaseModelAdmin):
             'fields': ('image', 'crop_from', 'effect', 'title', 'slug', 'caption', 'source_url', 'source_note', 'safetylevel', 'privacy', 'tags', 'imageset', 'admin_notes', 'is_active')
             }),
         )
-    list_display = ('title', 'slug', 'caption', 'creator', 'created', 'is_public', 'safetylevel', 'the_tags')
+    list_display = ('title', 'slug', 'caption', 'creator', 'created', 'is_public', 'safetylevel', 'ingest_status', 'the_tags')
+    list_filter = ('camera',)
     prepopulated_fields = {"slug": ("title",)}
 
+    def queryset(self, request):
+        # The changelist shows each row's creator and tags; fetch
+        # those per page rather than per row.
+        return super(MetaImageAdmin, self).queryset(request).select_related(
+            'creator').defer('admin_notes').with_tags()
+
     def the_tags(self, obj):
         """
         This workaround of m2m limitation of django-taggit is from
         https://github.com/alex/django-taggit/issues/46
         """
-        return "%s" % (obj.tags.all(), )
+        return ", ".join([tag.name for tag in obj.get_tag_list()])
     the_tags.short_description = 'Tags'
 
+
+class IngestJobAdmin(admin.ModelAdmin):
+    list_display = ('metaimage', 'status', 'attempts', 'created', 'claimed', 'finished', 'not_before', 'worker')
+    list_filter = ('status',)
+    raw_id_fields = ('metaimage',)
+
+
+class IngestRecordAdmin(admin.ModelAdmin):
+    list_display = ('metaimage', 'source', 'total_seconds', 'slowest_phase', 'file_size', 'created', 'error')
+    list_filter = ('source',)
+    raw_id_fields = ('metaimage',)
+
+
+class SourceURLAdmin(admin.ModelAdmin):
+    list_display = ('url', 'blob', 'etag', 'last_modified', 'checked')
+    raw_id_fields = ('blob',)
+    search_fields = ('url',)
+
 admin.site.register(MetaImage, MetaImageAdmin)
+admin.site.register(IngestJob, IngestJobAdmin)
+admin.site.register(IngestRecord, IngestRecordAdmin)
+admin.site.register(SourceURL, SourceURLAdmin)
@@ -0,0 +1,72 @@
+"""Benchmark of connection reuse in utils.openanything: fetching many
+images from one host with a fresh urllib2 connection per request (the
+old open_anything behaviour), against a pooled Fetcher.  Needs no
+Django settings or network access; run with,
+
+    python -m metaimage.benchmarks.connections [num_requests [connect_ms]]
+
+connect_ms (default 5) is added to each new connection the local server
+accepts, as a stand-in for the handshake round trips to a real host.
+"""
+
+import sys
+import time
+import urllib2
+
+from metaimage.utils.openanything import fetch, Fetcher
+from metaimage.utils.stubserver import StubHTTPServer
+
+
+PAYLOAD = 'GIF89a' + '\0' * 20000
+
+
+def fetch_with_urllib2(url):
+    f = urllib2.urlopen(url)
+    data = f.read()
+    f.close()
+    return data
+
+
+def fetch_with_fetcher(fetcher, url):
+    return fetch(url, retry_attempts=1, fetcher=fetcher)['data']
+
+
+def time_fetches(server, fetch_one, num_requests):
+    connections_before = server.connections
+    started = time.time()
+    for i in range(num_requests):
+        assert fetch_one(server.url('/image.gif')) == PAYLOAD
+    elapsed = time.time() - started
+    return elapsed, server.connections - connections_before
+
+
+def run(num_requests=500, connect_delay=0.005, out=sys.stdout):
+    server = StubHTTPServer(
+        {'/image.gif': (200, {'Content-Type': 'image/gif'}, PAYLOAD)},
+        connect_delay=connect_delay).start()
+    fetcher = Fetcher()
+    try:
+        results = [
+            ('urllib2, new connection per request',
+             time_fetches(server, fetch_with_urllib2, num_requests)),
+            ('Fetcher, pooled keep-alive connections',
+             time_fetches(server,
+                          lambda url: fetch_with_fetcher(fetcher, url),
+                          num_requests))]
+    finally:
+        fetcher.close()
+        server.stop()
+    for name, (elapsed, connections) in results:
+        out.write('%-40s %6d requests  %6.3fs  %8.1f req/s  %5d connections\n'
+                  % (name, num_requests, elapsed, num_requests / elapsed,
+                     connections))
+    return results
+
+
+if __name__ == '__main__':
+    options = {}
+    if len(sys.argv) > 1:
+        options['num_requests'] = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        options['connect_delay'] = float(sys.argv[2]) / 1000
+    run(**options)
@@ -0,0 +1,261 @@
+"""Benchmarks of the MetaImage hot paths: saving an image from a
+source_url (served by a local stub server, so no network is needed),
+from image_data and from an upload; is_str_an_image(); the
+generate_filename_*() methods; render() and render_linked() at every
+PhotoSize; and the feed views with 10, 1,000 and 100,000 images.
+
+Unlike the other benchmarks here this needs Django settings: it runs
+against a freshly created test database, and with the media storage
+pointed at a temporary directory.  Run it with "manage.py
+metaimage_benchmark", which can save the results as JSON and compare
+them with an earlier run's:
+
+    manage.py metaimage_benchmark --output=before.json
+    ... make changes ...
+    manage.py metaimage_benchmark --baseline=before.json
+
+From Python, run_suite() returns the results, and compare_results()
+compares two sets of them.
+"""
+
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+import platform
+import shutil
+import tempfile
+import time
+
+from PIL import Image
+
+import django
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test.client import Client
+from django.test.utils import setup_test_environment, \
+     teardown_test_environment
+
+from photologue.models import PhotoSizeCache
+
+from metaimage.models import MetaImage
+from metaimage.utils.stubserver import StubHTTPServer
+
+
+FEED_ROWS = (10, 1000, 100000)
+# A result more than this much slower than its baseline (as a fraction
+# of the baseline's time) is a regression:
+DEFAULT_TOLERANCE = 0.25
+
+
+def make_png(size=(300, 200), color=(255, 0, 0)):
+    buf = StringIO()
+    Image.new('RGB', size, color).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def measure(func, number=10, repeat=5, setup=None):
+    """Time func() called number times, repeat times over; returns a
+    result dict with the min and median seconds per call.  setup(),
+    if given, is called before each repeat, untimed."""
+    timings = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.time()
+        for j in range(number):
+            func()
+        timings.append((time.time() - started) / number)
+    timings.sort()
+    return {'min': timings[0],
+            'median': timings[len(timings) // 2],
+            'calls': number * repeat}
+
+
+class Counter(object):
+    """Hands out numbers, for making each saved image different."""
+
+    def __init__(self):
+        self.value = 0
+
+    def next(self):
+        self.value += 1
+        return self.value
+
+
+def bench_saves(results, creator, server):
+    counter = Counter()
+
+    def save_source_url():
+        MetaImage(title='Remote %s' % counter.next(), creator=creator,
+                  source_url=server.url('/image-%s.png' % counter.value)
+                  ).save()
+    results['save.source_url'] = measure(save_source_url)
+
+    # Distinct images each time, made before the timing starts:
+    images = [make_png(color=(i % 256, i // 256, 0)) for i in range(60)]
+
+    def save_image_data():
+        MetaImage(title='Data %s' % counter.next(), creator=creator).save(
+            image_data=images.pop())
+    results['save.image_data'] = measure(save_image_data)
+
+    uploads = [make_png(color=(0, i % 256, i // 256)) for i in range(60)]
+
+    def save_upload():
+        the_metaimage = MetaImage(title='Upload %s' % counter.next(),
+                                  creator=creator)
+        the_metaimage.image = SimpleUploadedFile(
+            'upload-%s.png' % counter.value, uploads.pop(), 'image/png')
+        the_metaimage.save()
+    results['save.upload'] = measure(save_upload)
+
+
+def bench_checks(results):
+    metaimage = MetaImage()
+    png = make_png()
+    results['is_str_an_image.png'] = measure(
+        lambda: metaimage.is_str_an_image(png), number=100)
+    junk = 'Not an image' * 1000
+    results['is_str_an_image.junk'] = measure(
+        lambda: metaimage.is_str_an_image(junk), number=100)
+    metaimage.source_url = 'http://www.example.com/images/2011/photo.jpg?size=large'
+    results['generate_filename_from_url'] = measure(
+        metaimage.generate_filename_from_url, number=1000)
+    results['generate_filename_from_data'] = measure(
+        lambda: metaimage.generate_filename_from_data(png), number=1000)
+
+
+def bench_render(results, creator):
+    the_metaimage = MetaImage(title='Render', creator=creator)
+    the_metaimage.save(image_data=make_png((800, 600)))
+    the_metaimage = MetaImage.objects.get(pk=the_metaimage.pk)
+    for name in sorted(PhotoSizeCache().sizes):
+        results['render.%s' % name] = measure(
+            lambda: the_metaimage.render(name), number=100)
+        results['render_linked.%s' % name] = measure(
+            lambda: the_metaimage.render_linked(name), number=100)
+    return the_metaimage
+
+
+def add_feed_rows(template, count, batch_size=1000):
+    """Insert count copies of the MetaImage template, with their own
+    ids, titles, slugs and created times, straight into the table."""
+    fields = [field for field in MetaImage._meta.fields
+              if not field.primary_key]
+    values = dict([(field.attname, field.get_db_prep_save(
+                        getattr(template, field.attname), connection=connection))
+                   for field in fields])
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        connection.ops.quote_name(MetaImage._meta.db_table),
+        ', '.join([connection.ops.quote_name(field.column)
+                   for field in fields]),
+        ', '.join(['%s'] * len(fields)))
+    start = MetaImage.objects.count()
+    created = datetime(2010, 1, 1)
+    cursor = connection.cursor()
+    for batch_start in range(start, start + count, batch_size):
+        rows = []
+        for i in range(batch_start, min(batch_start + batch_size,
+                                         start + count)):
+            values['title'] = u'Feed image %s' % i
+            values['slug'] = u'feed-image-%s' % i
+            values['created'] = values['updated'] = connection.ops.value_to_db_datetime(
+                created + timedelta(seconds=i))
+            rows.append([values[field.attname] for field in fields])
+        cursor.executemany(sql, rows)
+    transaction.commit_unless_managed()
+
+
+def bench_feeds(results, creator, template, feed_rows):
+    client = Client()
+    client.login(username=creator.username, password='benchmark')
+    url = reverse('show_metaimages')
+    # Start from the template alone, so the smallest feed is that size:
+    MetaImage.objects.exclude(pk=template.pk).delete()
+    existing = 1
+    for rows in feed_rows:
+        if rows > existing:
+            add_feed_rows(template, rows - existing)
+            existing = rows
+        results['feed.%s.first_page' % rows] = measure(
+            lambda: client.get(url), number=5)
+        # A page about halfway back:
+        middle = MetaImage.objects.order_by('-created', '-id')[rows // 2]
+        cursor = '%s.%s' % (middle.created.strftime('%Y%m%d%H%M%S%f'),
+                            middle.pk)
+        results['feed.%s.deep_page' % rows] = measure(
+            lambda: client.get(url, {'before': cursor}), number=5)
+
+
+def run_benchmarks(feed_rows=FEED_ROWS, progress=None):
+    """Run the benchmarks against the current database; returns a dict
+    of benchmark name -> result dict."""
+    results = {}
+    creator = User.objects.create_user(
+        'benchmark', 'benchmark@example.com', 'benchmark')
+    server = StubHTTPServer(dict([
+        ('/image-%s.png' % i, (200, {'Content-Type': 'image/png'},
+                               make_png(color=(i, 0, 0))))
+        for i in range(1, 51)])).start()
+    try:
+        steps = [
+            ('saves', lambda: bench_saves(results, creator, server)),
+            ('checks', lambda: bench_checks(results))]
+        for name, step in steps:
+            step()
+            if progress is not None:
+                progress(name)
+    finally:
+        server.stop()
+    template = bench_render(results, creator)
+    if progress is not None:
+        progress('render')
+    bench_feeds(results, creator, template, feed_rows)
+    if progress is not None:
+        progress('feeds')
+    return results
+
+
+def run_suite(feed_rows=FEED_ROWS, progress=None):
+    """Run the benchmarks in a new test database, with media stored in
+    a temporary directory; returns the results, with details of the
+    environment under "meta"."""
+    media_root = tempfile.mkdtemp()
+    old_location = default_storage.location
+    default_storage.location = media_root
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        results = run_benchmarks(feed_rows, progress)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+        default_storage.location = old_location
+        shutil.rmtree(media_root, ignore_errors=True)
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.settings_dict['ENGINE'],
+            'platform': platform.platform(),
+            'time': datetime.now().isoformat()},
+        'results': results}
+
+
+def compare_results(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Compare the median of each result with that in baseline (both
+    as returned by run_suite()); returns a list of (name, ratio,
+    regressed) sorted by name, ratio being the new time over the old,
+    for the benchmarks in both."""
+    comparisons = []
+    for name in sorted(results['results']):
+        if name not in baseline['results']:
+            continue
+        old = baseline['results'][name]['median']
+        new = results['results'][name]['median']
+        ratio = new / max(old, 1e-9)
+        comparisons.append((name, ratio, ratio > 1 + tolerance))
+    return comparisons
@@ -0,0 +1,119 @@
+"""Byte-size report of rendition variants: a corpus of images resized to
+a few widths and encoded the way photologue does by default (in the
+original format, or baseline JPEG), against optimized progressive
+JPEG and WebP, at 1x and 2x.  Needs no Django settings; run with,
+
+    python -m metaimage.benchmarks.variants [image_dir [quality]]
+
+Without image_dir, a small synthetic corpus is generated.  WebP is
+skipped if the installed PIL can't write it.
+"""
+
+import os
+import random
+import sys
+
+from PIL import Image, ImageDraw
+
+from metaimage.utils.encoding import encode_image, format_supported
+
+
+WIDTHS = (230, 500)
+DENSITIES = (1, 2)
+IMAGE_EXTENSIONS = ('.gif', '.jpg', '.jpeg', '.png')
+
+
+def synthetic_corpus(count=12, size=(1200, 900)):
+    """Photo-ish (gradient plus shapes plus noise) and chart-ish (flat
+    colours) images, in the formats a site would store them in."""
+    rng = random.Random(0)
+    images = []
+    for i in range(count):
+        im = Image.new('RGB', size)
+        draw = ImageDraw.Draw(im)
+        if i % 3 == 2:
+            im.format = 'PNG'
+            draw.rectangle([0, 0, size[0], size[1]], fill=(255, 255, 255))
+            for bar in range(10):
+                top = rng.randint(50, size[1] - 50)
+                draw.rectangle([bar * 110 + 40, top, bar * 110 + 120, size[1]],
+                               fill=(40, 90 + bar * 15, 200))
+        else:
+            for y in range(size[1]):
+                shade = 255 * y // size[1]
+                draw.line([(0, y), (size[0], y)],
+                          fill=(shade, 128 - shade // 2, 255 - shade))
+            for shape in range(30):
+                x, y = rng.randint(0, size[0]), rng.randint(0, size[1])
+                r = rng.randint(10, 150)
+                draw.ellipse([x - r, y - r, x + r, y + r],
+                             fill=tuple([rng.randint(0, 255)
+                                         for c in range(3)]))
+            # frombytes() in newer PILs, fromstring() in older ones:
+            frombytes = getattr(Image, 'frombytes', None) or Image.fromstring
+            noise = frombytes('L', size, os.urandom(size[0] * size[1]))
+            im = Image.blend(im, Image.merge('RGB', (noise,) * 3), 0.08)
+            im.format = 'JPEG'
+        images.append(('synthetic-%02d' % i, im))
+    return images
+
+
+def read_corpus(path):
+    images = []
+    for filename in sorted(os.listdir(path)):
+        if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+            im = Image.open(os.path.join(path, filename))
+            im.load()
+            images.append((filename, im))
+    return images
+
+
+def resized(im, width):
+    height = max(1, im.size[1] * width // im.size[0])
+    out = im.convert('RGB').resize((width, height), Image.ANTIALIAS)
+    out.format = im.format
+    return out
+
+
+def encoders(quality):
+    encoders = [
+        ('default (original format)', lambda im: encode_image(
+            im, im.format == 'JPEG' and 'JPEG' or 'PNG', quality,
+            progressive=False)),
+        ('progressive JPEG', lambda im: encode_image(im, 'JPEG', quality))]
+    if format_supported('WEBP'):
+        encoders.append(
+            ('WebP', lambda im: encode_image(im, 'WEBP', quality)))
+    return encoders
+
+
+def run(images, quality=75, out=sys.stdout):
+    totals = {}
+    for name, im in images:
+        for width in WIDTHS:
+            for density in DENSITIES:
+                rendition = resized(im, width * density)
+                for encoder_name, encode in encoders(quality):
+                    key = (width, density, encoder_name)
+                    totals[key] = totals.get(key, 0) + len(encode(rendition))
+    out.write('%d images, quality %d\n' % (len(images), quality))
+    for width in WIDTHS:
+        for density in DENSITIES:
+            baseline = totals[(width, density, 'default (original format)')]
+            for encoder_name, encode in encoders(quality):
+                size = totals[(width, density, encoder_name)]
+                out.write('width %4d %dx  %-28s %10d bytes  %5.1f%%\n'
+                          % (width, density, encoder_name, size,
+                             100.0 * size / baseline))
+    return totals
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        corpus = read_corpus(sys.argv[1])
+    else:
+        corpus = synthetic_corpus()
+    options = {}
+    if len(sys.argv) > 2:
+        options['quality'] = int(sys.argv[2])
+    run(corpus, **options)
@@ -0,0 +1,77 @@
+"""
+Conditional GET support for the MetaImage views: ETag and
+Last-Modified validators, worked out with a cheap query before the
+view runs, so that a repeat view answers 304 Not Modified without
+loading the images or rendering the template.
+
+Every MetaImage page is shown to a logged in user, and differs by user
+(links for the creator, private images), so the responses are marked
+private to that user's browser: shared caches never store them, and
+the ETags include the user's id.
+"""
+from django.conf import settings
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.functional import wraps
+from django.utils.hashcompat import md5_constructor
+from django.views.decorators.http import condition
+
+
+# Change this to have browsers fetch pages afresh, e.g. after changing
+# the templates:
+ETAG_VERSION = getattr(settings, 'METAIMAGE_ETAG_VERSION', '')
+
+
+def has_pending_messages(request):
+    """
+    Whether the user has messages waiting to be shown; the page they
+    next get has to be rendered to show them.
+    """
+    storage = getattr(request, '_messages', None)
+    if storage is not None and len(storage):
+        return True
+    return request.user.message_set.exists()
+
+
+def make_etag(request, *parts):
+    """
+    An ETag for the page for request's user that depends on parts.
+    """
+    key = repr((ETAG_VERSION, request.user.id,
+                getattr(request, 'LANGUAGE_CODE', None)) + parts)
+    return md5_constructor(key).hexdigest()
+
+
+def conditional_page(get_validators):
+    """
+    Decorator for a view answering GET with the page for one user;
+    get_validators(request, *args, **kwargs) returns the page's (etag,
+    last_modified), either of which can be None for none, and is
+    called once per request.  Works like Django's condition(), and adds
+    Cache-Control and Vary headers that keep the page private.
+    """
+    def decorator(view_func):
+        def validators(request, *args, **kwargs):
+            if not hasattr(request, '_metaimage_validators'):
+                if has_pending_messages(request):
+                    request._metaimage_validators = (None, None)
+                else:
+                    request._metaimage_validators = get_validators(
+                        request, *args, **kwargs)
+            return request._metaimage_validators
+
+        conditional_view = condition(
+            etag_func=lambda request, *args, **kwargs:
+                validators(request, *args, **kwargs)[0],
+            last_modified_func=lambda request, *args, **kwargs:
+                validators(request, *args, **kwargs)[1])(view_func)
+
+        def inner(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            # Revalidated on every view, and never stored by shared
+            # caches:
+            patch_cache_control(
+                response, private=True, max_age=0, must_revalidate=True)
+            patch_vary_headers(response, ('Cookie',))
+            return response
+        return wraps(view_func)(inner)
+    return decorator
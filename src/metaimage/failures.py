@@ -0,0 +1,254 @@
+"""
+A registry of recent fetch failures, so that a dead URL or a host
+that's down fails fast, rather than running through every retry each
+time someone saves a MetaImage pointing at it.
+
+- A URL that failed - a network error, an error response, or not an
+  image - is turned away for METAIMAGE_FAILED_URL_TTL seconds.
+- A host with METAIMAGE_HOST_FAILURE_THRESHOLD network errors or
+  server errors (5xx, 408, 429) within METAIMAGE_HOST_FAILURE_WINDOW
+  seconds has its circuit opened: fetches from it are turned away for
+  METAIMAGE_HOST_OPEN_SECONDS.  After that the circuit is half-open:
+  one fetch is let through as a probe, and if it succeeds the circuit
+  closes, while if it fails the circuit opens again.
+
+Failures are recorded in the process, and, so that every process sees
+them, in the site's default cache, or the backend URI in
+METAIMAGE_FAILURE_CACHE_BACKEND (None for the process alone).  The
+registry is the FetchEngine's breaker, see utils/fetchengine.py.
+"""
+import threading
+import time
+import urlparse
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.utils.hashcompat import md5_constructor
+
+
+FAILURE_CACHE_BACKEND = getattr(
+    settings, 'METAIMAGE_FAILURE_CACHE_BACKEND', 'default')
+FAILED_URL_TTL = getattr(settings, 'METAIMAGE_FAILED_URL_TTL', 300)  # seconds
+HOST_FAILURE_THRESHOLD = getattr(
+    settings, 'METAIMAGE_HOST_FAILURE_THRESHOLD', 5)
+HOST_FAILURE_WINDOW = getattr(
+    settings, 'METAIMAGE_HOST_FAILURE_WINDOW', 60)  # seconds
+HOST_OPEN_SECONDS = getattr(settings, 'METAIMAGE_HOST_OPEN_SECONDS', 60)
+
+# Responses that say the host, rather than the URL, is in trouble:
+HOST_FAILURE_STATUSES = frozenset([408, 429])
+# The most failed URLs kept in the process, before expired ones are
+# cleared out:
+MAX_LOCAL_URLS = 10000
+
+
+def _get_backend():
+    if not FAILURE_CACHE_BACKEND:
+        return None
+    if FAILURE_CACHE_BACKEND == 'default':
+        from django.core.cache import cache
+        return cache
+    return get_cache(FAILURE_CACHE_BACKEND)
+
+
+def get_host(url):
+    """The host (and port) of an http or https URL, else None."""
+    parsed_url = urlparse.urlsplit(url)
+    if parsed_url.scheme.lower() not in ('http', 'https') \
+           or not parsed_url.hostname:
+        return None
+    return '%s:%s' % (parsed_url.hostname, parsed_url.port or '')
+
+
+def classify(result):
+    """
+    Whether a fetch_to_file() result is a success ('ok'), a failure of
+    the URL ('url') or a failure of its host ('host').
+    """
+    if not result:
+        return 'host'
+    status = result.get('status', 200)
+    if status >= 500 or status in HOST_FAILURE_STATUSES:
+        return 'host'
+    if status >= 400 or result.get('rejected') or result.get('truncated'):
+        return 'url'
+    return 'ok'
+
+
+class HostState(object):
+
+    def __init__(self):
+        self.failures = []
+        self.open_until = None
+        self.probing_until = None
+
+
+class FailureRegistry(object):
+    """
+    Recent failures of URLs and hosts, kept in the process and in
+    cache, a Django cache backend, if one is given.  Safe to share
+    between threads.
+    """
+
+    def __init__(self, cache=None, url_ttl=FAILED_URL_TTL,
+                 threshold=HOST_FAILURE_THRESHOLD, window=HOST_FAILURE_WINDOW,
+                 open_seconds=HOST_OPEN_SECONDS):
+        self.cache = cache
+        self.url_ttl = url_ttl
+        self.threshold = threshold
+        self.window = window
+        self.open_seconds = open_seconds
+        self._failed_urls = {}
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _key(self, *parts):
+        # Hashed, as memcached keys can't have spaces and are limited in
+        # length:
+        return 'metaimage.failure.%s' % md5_constructor(
+            repr(parts)).hexdigest()
+
+    def _host_state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = HostState()
+        return state
+
+    def _open_until(self, host):
+        """When host's circuit is (or was) open until, or None if it's
+        closed."""
+        open_until = self._hosts.get(host, HostState()).open_until
+        if open_until is None and self.cache is not None:
+            open_until = self.cache.get(self._key('open', host))
+        return open_until
+
+    def _claim_probe(self, host, now):
+        self._lock.acquire()
+        try:
+            state = self._host_state(host)
+            if state.probing_until is not None and now < state.probing_until:
+                return False
+            state.probing_until = now + self.open_seconds
+        finally:
+            self._lock.release()
+        if self.cache is None:
+            return True
+        # Only one process gets to probe:
+        return self.cache.add(self._key('probe', host), 1, self.open_seconds)
+
+    def check(self, url):
+        """
+        None if url can be fetched now, else why not.
+        """
+        now = time.time()
+        expires = self._failed_urls.get(url)
+        if expires is not None and now < expires:
+            return 'Recently failed: %s' % url
+        if expires is None and self.cache is not None \
+               and self.cache.get(self._key('url', url)):
+            return 'Recently failed: %s' % url
+        host = get_host(url)
+        if host is None:
+            return None
+        open_until = self._open_until(host)
+        if open_until is None:
+            return None
+        if now < open_until or not self._claim_probe(host, now):
+            return 'Too many recent failures at %s' % host
+        # The circuit is half-open, and this fetch is its probe.
+        return None
+
+    def record(self, url, result):
+        """
+        Record the outcome of a fetch of url, given its fetch_to_file()
+        result.
+        """
+        host = get_host(url)
+        if host is None:
+            return
+        outcome = classify(result)
+        if outcome == 'ok':
+            self._succeeded(url, host)
+            return
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if len(self._failed_urls) >= MAX_LOCAL_URLS:
+                self._failed_urls = dict([
+                    (failed_url, expires)
+                    for failed_url, expires in self._failed_urls.items()
+                    if expires > now])
+            self._failed_urls[url] = now + self.url_ttl
+        finally:
+            self._lock.release()
+        if self.cache is not None:
+            self.cache.set(self._key('url', url), 1, self.url_ttl)
+        if outcome == 'host':
+            self._host_failed(host, now)
+
+    def _succeeded(self, url, host):
+        if url in self._failed_urls:
+            self._lock.acquire()
+            try:
+                self._failed_urls.pop(url, None)
+            finally:
+                self._lock.release()
+        if self._open_until(host) is None and not self._hosts.get(
+                host, HostState()).failures:
+            return
+        # Close the circuit:
+        self._lock.acquire()
+        try:
+            self._hosts.pop(host, None)
+        finally:
+            self._lock.release()
+        if self.cache is not None:
+            self.cache.delete_many([self._key(part, host)
+                                    for part in ('open', 'probe', 'count')])
+
+    def _host_failed(self, host, now):
+        self._lock.acquire()
+        try:
+            state = self._host_state(host)
+            state.failures = [failed for failed in state.failures
+                              if failed > now - self.window] + [now]
+            failures = len(state.failures)
+            # A failed probe opens the circuit straight away:
+            probe_failed = state.open_until is not None \
+                           and now >= state.open_until
+        finally:
+            self._lock.release()
+        if self.cache is not None:
+            count_key = self._key('count', host)
+            self.cache.add(count_key, 0, self.window)
+            try:
+                failures = max(failures, self.cache.incr(count_key))
+            except ValueError:
+                # The count expired in between.
+                pass
+            if not probe_failed:
+                probe_failed = self.cache.get(self._key('open', host)) \
+                               is not None
+        if failures >= self.threshold or probe_failed:
+            self._open(host, now)
+
+    def _open(self, host, now):
+        open_until = now + self.open_seconds
+        self._lock.acquire()
+        try:
+            state = self._host_state(host)
+            state.open_until = open_until
+            state.probing_until = None
+            state.failures = []
+        finally:
+            self._lock.release()
+        if self.cache is not None:
+            # Kept past open_until, so the circuit is known to be
+            # half-open, rather than closed, once that has passed:
+            self.cache.set(self._key('open', host), open_until,
+                           self.open_seconds * 3)
+            self.cache.delete_many([self._key('probe', host),
+                                    self._key('count', host)])
+
+
+registry = FailureRegistry(_get_backend())
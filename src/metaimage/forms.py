@@ -1,6 +1,6 @@
 from django import forms
 
-from metaimage.models import MetaImage
+from metaimage.models import MetaImage, MAX_IMAGE_PIXELS
 
 
 # These are the MetaImage (and base-class ImageModel) fields that
@@ -43,6 +43,16 @@ class MetaImageUploadForm(forms.ModelForm):
         self.user = user
         super(forms.ModelForm, self).__init__(*args, **kwargs)
 
+    def clean_image(self):
+        # Turn down images too big to decode from their headers, before
+        # save() would try to:
+        local_image = self.cleaned_data.get('image')
+        if local_image and not MetaImage().is_file_an_image(local_image):
+            raise forms.ValidationError(
+                'Upload a valid image, of at most %s pixels.' %
+                MAX_IMAGE_PIXELS)
+        return local_image
+
     def clean(self):
         """
         The key inter/multi-fields condition to check is: if a local
@@ -0,0 +1,167 @@
+"""
+A cache of rendered HTML fragments for MetaImages - the thumbnails of
+a gallery, the body of a details page - keyed by image id, its updated
+time and the PhotoSize shown, so that saving an image (or changing its
+tags, which counts as updating it) leaves its old fragments unused,
+while every other image's stay put.
+
+The cache is the site's default one, or the backend URI in
+METAIMAGE_FRAGMENT_CACHE_BACKEND, e.g. "locmem://",
+"file:///var/tmp/metaimage" or "memcached://127.0.0.1:11211/"; set it
+to None to turn fragment caching off.
+
+Rendering an image at a PhotoSize with increment_count set counts as
+a view, so cache hits at such sizes still increment the view count.
+
+The keys also carry the version of the PhotoSizes, sizes_version,
+which changes whenever a PhotoSize is saved, so that no fragment (or
+rendition manifest entry, see renditions.py) made with the old sizes
+is used after that, in any process.  It is shared through the site's
+default cache, or the backend URI in METAIMAGE_SIZES_VERSION_BACKEND
+(None for the process alone), and read from there at most every
+METAIMAGE_SIZES_VERSION_CHECK_INTERVAL seconds.
+"""
+from datetime import datetime
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.utils.hashcompat import md5_constructor
+from django.utils.safestring import mark_safe
+
+from photologue.models import PhotoSizeCache
+
+
+FRAGMENT_CACHE_BACKEND = getattr(
+    settings, 'METAIMAGE_FRAGMENT_CACHE_BACKEND', 'default')
+FRAGMENT_CACHE_TIMEOUT = getattr(
+    settings, 'METAIMAGE_FRAGMENT_CACHE_TIMEOUT', 86400)  # seconds
+SIZES_VERSION_BACKEND = getattr(
+    settings, 'METAIMAGE_SIZES_VERSION_BACKEND', 'default')
+SIZES_VERSION_CHECK_INTERVAL = getattr(
+    settings, 'METAIMAGE_SIZES_VERSION_CHECK_INTERVAL', 10)  # seconds
+
+SIZES_VERSION_KEY = 'metaimage.sizes_version'
+# As long as memcached keeps anything:
+SIZES_VERSION_TIMEOUT = 30 * 86400
+
+
+def _get_backend(uri):
+    if not uri:
+        return None
+    if uri == 'default':
+        from django.core.cache import cache
+        return cache
+    return get_cache(uri)
+
+
+backend = _get_backend(FRAGMENT_CACHE_BACKEND)
+
+
+class SizesVersion(object):
+    """
+    A number that changes whenever bump() is called, i.e. whenever a
+    PhotoSize is saved, shared between processes through cache, if
+    given.  Every process that sees it change also resets photologue's
+    PhotoSizeCache, so that it reads the new sizes.
+    """
+
+    def __init__(self, cache=None,
+                 check_interval=SIZES_VERSION_CHECK_INTERVAL):
+        self.cache = cache
+        self.check_interval = check_interval
+        self._version = int(time.time() * 1000)
+        self._checked = None
+
+    def get(self):
+        if self.cache is None:
+            return self._version
+        now = time.time()
+        if self._checked is not None \
+               and now - self._checked < self.check_interval:
+            return self._version
+        version = self.cache.get(SIZES_VERSION_KEY)
+        if version is None:
+            # Not set yet, or evicted: share this process's.
+            self.cache.add(SIZES_VERSION_KEY, self._version,
+                           SIZES_VERSION_TIMEOUT)
+            version = self.cache.get(SIZES_VERSION_KEY) or self._version
+        if version != self._version:
+            PhotoSizeCache().reset()
+        self._version, self._checked = version, now
+        return version
+
+    def bump(self):
+        PhotoSizeCache().reset()
+        self._version = max(int(time.time() * 1000), self._version + 1)
+        self._checked = time.time()
+        if self.cache is not None:
+            self.cache.set(SIZES_VERSION_KEY, self._version,
+                           SIZES_VERSION_TIMEOUT)
+
+
+sizes_version = SizesVersion(_get_backend(SIZES_VERSION_BACKEND))
+
+
+def fragment_key(metaimage, name, the_size=None, vary_on=()):
+    # Hashed, as memcached keys can't have spaces and are limited in
+    # length:
+    return 'metaimage.fragment.%s' % md5_constructor(repr(
+        (metaimage.pk, str(metaimage.updated), sizes_version.get(), name,
+         the_size) + tuple(vary_on))).hexdigest()
+
+
+def _count_views(metaimages, the_size):
+    photosize = PhotoSizeCache().sizes.get(the_size)
+    if photosize is not None and photosize.increment_count:
+        for metaimage in metaimages:
+            metaimage.increment_count()
+
+
+def get_fragments(metaimages, name, the_size=None, vary_on=()):
+    """
+    Returns a dict of MetaImage id -> cached HTML of the fragment name
+    showing it at the_size, for those of metaimages that have one.
+    """
+    if backend is None:
+        return {}
+    keys = dict([(fragment_key(metaimage, name, the_size, vary_on), metaimage)
+                 for metaimage in metaimages if metaimage.pk])
+    if not keys:
+        return {}
+    fragments = {}
+    for key, html in backend.get_many(keys.keys()).items():
+        fragments[keys[key].pk] = mark_safe(html)
+    _count_views([keys[key] for key in keys
+                  if keys[key].pk in fragments], the_size)
+    return fragments
+
+
+def set_fragments(fragments, name, the_size=None, vary_on=()):
+    """
+    Caches fragments, a list of (metaimage, html) pairs.
+    """
+    if backend is None:
+        return
+    values = dict([(fragment_key(metaimage, name, the_size, vary_on),
+                    unicode(html))
+                   for metaimage, html in fragments if metaimage.pk])
+    if values:
+        backend.set_many(values, FRAGMENT_CACHE_TIMEOUT)
+
+
+def touch_tagged_metaimage(sender, instance, **kwargs):
+    """
+    post_save/post_delete handler for taggit's TaggedItem, connected in
+    models.py: when a MetaImage's tags change, so does its updated
+    time, and with it the keys of its fragments.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from metaimage.models import MetaImage
+    # Set by the importer, for tags of just-created MetaImages:
+    if getattr(instance, 'metaimage_is_new', False):
+        return
+    if instance.content_type_id == \
+           ContentType.objects.get_for_model(MetaImage).id:
+        MetaImage.objects.filter(pk=instance.object_id).update(
+            updated=datetime.now())
@@ -0,0 +1,481 @@
+"""
+Bulk creation of MetaImages, from a manifest of remote image URLs, or
+from a directory or a zip or tar archive of image files.
+
+Images are fetched and verified by a pool of threads, while the
+database rows, their image files and tags are written in batches, one
+transaction per batch.  Progress can be recorded in a state file, so
+that an interrupted import picks up where it left off.  The
+metaimage_import management command wraps this; from Python,
+
+    importer = MetaImageImporter(default_creator=some_user)
+    report = importer.run(read_manifest('images.csv'))
+
+A manifest is either CSV, with a header row, or JSON lines, one object
+per image.  The fields are url (required), then optionally title,
+tags, privacy, creator (a username), caption and source_note.
+"""
+from cStringIO import StringIO
+import csv
+from datetime import datetime
+import logging
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils import simplejson
+
+from taggit.models import Tag, TaggedItem
+from taggit.utils import parse_tags
+
+from metaimage.models import check_fetched_image, get_fetch_timeouts, \
+     MetaImage, MetaImageSourceURLNotAnImage, \
+     MetaImageUnableToRetrieveSourceURL, FETCH_ENGINE, IMAGE_FETCH_OPTIONS, \
+     ImageBlob, PRIVACY_CHOICES, SourceURL
+from metaimage.utils.imageinfo import file_digest
+from metaimage.utils.workers import run_in_threads
+
+
+IMPORT_WORKERS = getattr(settings, 'METAIMAGE_IMPORT_WORKERS', 8)
+IMPORT_BATCH_SIZE = getattr(settings, 'METAIMAGE_IMPORT_BATCH_SIZE', 100)
+# Time allowed for fetching each image, retries included:
+IMPORT_FETCH_DEADLINE = getattr(
+    settings, 'METAIMAGE_IMPORT_FETCH_DEADLINE', 120)  # seconds
+IMAGE_EXTENSIONS = ('.gif', '.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+logger = logging.getLogger('metaimage.importer')
+
+
+class ImportItem(object):
+    """
+    One image to import.  key identifies it in the state file: the
+    manifest line number, or the file's path within the directory or
+    archive.  An image from an archive has no path, but a filename and
+    extract, a callable returning an open file of its data and its
+    size, which is called by the importer's own thread.
+    """
+
+    def __init__(self, key, url=None, path=None, title=None, tags=(),
+                 privacy=None, creator=None, caption='', source_note=None,
+                 filename=None, extract=None):
+        self.key = key
+        self.url = url
+        self.path = path
+        self.filename = filename
+        self.extract = extract
+        self.title = title
+        self.tags = tags
+        self.privacy = privacy
+        self.creator = creator
+        self.caption = caption
+        self.source_note = source_note
+        # Filled in by the fetching threads:
+        self.image_file = None
+        self.size = None
+        self.digest = None
+        self.image_info = None
+        self.etag = None
+        self.lastmodified = None
+
+
+def _parse_privacy(value):
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        for number, label in PRIVACY_CHOICES:
+            if unicode(label).lower() == value.lower():
+                return number
+    raise ValueError('Unknown privacy setting %r' % value)
+
+
+def _item_from_dict(key, row):
+    def text(name):
+        value = row.get(name)
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        return value or None
+    tags = row.get('tags') or ()
+    if isinstance(tags, basestring):
+        tags = parse_tags(text('tags'))
+    url = text('url')
+    return ImportItem(
+        key,
+        url=url,
+        title=text('title') or (url or '').rsplit('/', 1)[-1],
+        tags=tags,
+        privacy=_parse_privacy(row.get('privacy')),
+        creator=text('creator'),
+        caption=text('caption') or '',
+        source_note=text('source_note'))
+
+
+def read_manifest(path):
+    """
+    Yield an ImportItem for each row of the CSV or JSON lines manifest
+    at path; JSON lines files are recognized by a .jsonl or .json
+    extension.
+    """
+    manifest = open(path, 'rb')
+    try:
+        if os.path.splitext(path)[1].lower() in ('.jsonl', '.json'):
+            for line_num, line in enumerate(manifest):
+                if line.strip():
+                    yield _item_from_dict(
+                        str(line_num + 1), simplejson.loads(line))
+        else:
+            reader = csv.DictReader(manifest)
+            for row in reader:
+                yield _item_from_dict(str(reader.line_num), row)
+    finally:
+        manifest.close()
+
+
+def read_directory(path, tags=(), privacy=None):
+    """
+    Yield an ImportItem for each image file under the directory path,
+    titled after its filename.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            base, ext = os.path.splitext(filename)
+            if ext.lower() not in IMAGE_EXTENSIONS:
+                continue
+            file_path = os.path.join(dirpath, filename)
+            yield ImportItem(
+                os.path.relpath(file_path, path),
+                path=file_path,
+                title=base.replace('_', ' '),
+                tags=tags,
+                privacy=privacy)
+
+
+def _extract_to_file(source):
+    # Copied out, so the pool threads don't share the archive:
+    image_file = tempfile.TemporaryFile()
+    shutil.copyfileobj(source, image_file)
+    size = image_file.tell()
+    image_file.seek(0)
+    return image_file, size
+
+
+def read_archive(path, tags=(), privacy=None):
+    """
+    Yield an ImportItem for each image file in the zip or tar archive
+    (compressed or not) at path, titled after its filename.  The files
+    are extracted one at a time, as the import reaches them.
+    """
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        members = [(info.filename, info) for info in archive.infolist()
+                   if not info.filename.endswith('/')]
+
+        def extractor(info):
+            return lambda: _extract_to_file(
+                StringIO(archive.read(info.filename)))
+    elif tarfile.is_tarfile(path):
+        archive = tarfile.open(path)
+        members = [(member.name, member) for member in archive
+                   if member.isfile()]
+
+        def extractor(member):
+            return lambda: _extract_to_file(archive.extractfile(member))
+    else:
+        raise ValueError('%s is neither a zip nor a tar archive.' % path)
+    try:
+        for name, member in members:
+            filename = name.rsplit('/', 1)[-1]
+            base, ext = os.path.splitext(filename)
+            if ext.lower() not in IMAGE_EXTENSIONS:
+                continue
+            yield ImportItem(
+                name,
+                filename=filename,
+                extract=extractor(member),
+                title=base.replace('_', ' '),
+                tags=tags,
+                privacy=privacy)
+    finally:
+        archive.close()
+
+
+def is_archive(path):
+    """Whether path is a zip or tar archive, which read_archive() reads."""
+    return os.path.isfile(path) and (
+        zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+
+class ImportReport(object):
+
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+        self.failures = []
+        self.started = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def rate(self):
+        return self.imported / max(self.elapsed, 0.001)
+
+    def __unicode__(self):
+        return (u'%s imported, %s failed, %s already done; %.1fs, '
+                u'%.1f images/s' % (self.imported, len(self.failures),
+                                    self.skipped, self.elapsed, self.rate))
+
+
+class MetaImageImporter(object):
+    """
+    Creates MetaImages from ImportItems; see the module docstring.
+
+    default_creator is the User for items without a creator; with
+    pre_cache=False (the default) renditions are created on first use
+    rather than during the import.  If state_path is given, finished
+    items are recorded there, and skipped by later runs.  progress, if
+    given, is called with the ImportReport after every batch.
+    fetch_deadline is the time allowed for fetching each image, in
+    seconds.
+    """
+
+    def __init__(self, default_creator, num_workers=IMPORT_WORKERS,
+                 batch_size=IMPORT_BATCH_SIZE, state_path=None,
+                 pre_cache=False, default_privacy=1, progress=None,
+                 fetch_deadline=IMPORT_FETCH_DEADLINE):
+        self.default_creator = default_creator
+        self.fetch_timeouts = get_fetch_timeouts(deadline=fetch_deadline)
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.state_path = state_path
+        self.pre_cache = pre_cache
+        self.default_privacy = default_privacy
+        self.progress = progress
+        self._users = {}
+        self._tags = {}
+        # Names of the files stored by the batch being written:
+        self._stored = []
+        self._batch = []
+        self._failed = []
+        self._lock = threading.Lock()
+        self._state_file = None
+
+    def run(self, items):
+        self.report = ImportReport()
+        done_keys = self._read_state()
+        if self.state_path:
+            self._state_file = open(self.state_path, 'a')
+
+        # The pool threads only fetch; batches are written from this
+        # thread, in between handing out items, so that all the
+        # database work happens on one connection.
+        def pending_items():
+            for item in items:
+                if item.key in done_keys:
+                    self.report.skipped += 1
+                    continue
+                if len(self._batch) >= self.batch_size:
+                    self._flush()
+                if item.extract is not None:
+                    try:
+                        item.image_file, item.size = item.extract()
+                    except Exception:
+                        self._prepared(item, None, sys.exc_info())
+                        continue
+                yield item
+
+        try:
+            run_in_threads(self._prepare, pending_items(), self.num_workers,
+                           on_result=self._prepared)
+            self._flush()
+        finally:
+            if self._state_file is not None:
+                self._state_file.close()
+        return self.report
+
+    def _read_state(self):
+        done_keys = set()
+        if self.state_path and os.path.exists(self.state_path):
+            for line in open(self.state_path):
+                key, status = line.rstrip('\n').split('\t')[:2]
+                if status == 'ok':
+                    done_keys.add(key)
+        return done_keys
+
+    def _record(self, item, error=None):
+        if error is None:
+            self.report.imported += 1
+        else:
+            logger.warning('Importing %s failed: %s', item.key, error)
+            self.report.failures.append((item.key, error))
+        if self._state_file is not None:
+            message = error and unicode(error).replace('\n', ' ') or u''
+            self._state_file.write((u'%s\t%s\t%s\n' % (
+                item.key, error and 'failed' or 'ok', message)).encode('utf-8'))
+
+    def _prepare(self, item):
+        """
+        Fetch (or open) and verify an item's image; run by the pool
+        threads, so no database access happens here.
+        """
+        if item.image_file is not None:
+            # Already extracted from an archive:
+            image_file = item.image_file
+        elif not item.url and not item.path:
+            raise ValueError('No url given.')
+        elif item.path:
+            image_file = open(item.path, 'rb')
+            item.size = os.path.getsize(item.path)
+        else:
+            result = FETCH_ENGINE.fetch_to_file(
+                item.url, timeouts=self.fetch_timeouts, **IMAGE_FETCH_OPTIONS)
+            if not result or result.get('status', 200) >= 400:
+                raise MetaImageUnableToRetrieveSourceURL(
+                    'HTTP %s' % result.get('status'))
+            check_fetched_image(result)
+            image_file = result['file']
+            item.size = result['size']
+            item.etag = result.get('etag')
+            item.lastmodified = result.get('lastmodified')
+        item.image_info = MetaImage().inspect_image_file(image_file)
+        if item.image_info is None:
+            image_file.close()
+            raise MetaImageSourceURLNotAnImage
+        item.digest = file_digest(image_file)
+        item.image_file = image_file
+
+    def _prepared(self, item, result, exc_info):
+        self._lock.acquire()
+        try:
+            if exc_info is None:
+                self._batch.append(item)
+            else:
+                self._failed.append((item, exc_info[1]))
+        finally:
+            self._lock.release()
+
+    def _flush(self):
+        self._lock.acquire()
+        try:
+            batch, self._batch = self._batch, []
+            failed, self._failed = self._failed, []
+        finally:
+            self._lock.release()
+        for item, error in failed:
+            self._record(item, error)
+        if batch:
+            try:
+                self._write_batch(batch)
+                for item in batch:
+                    self._record(item)
+            except Exception, e:
+                # Find the culprit(s) by writing them one at a time:
+                logger.warning('Import batch failed (%r), retrying singly.', e)
+                for item in batch:
+                    try:
+                        self._write_batch([item])
+                        self._record(item)
+                    except Exception, e:
+                        self._record(item, e)
+            for item in batch:
+                item.image_file.close()
+        if self._state_file is not None:
+            self._state_file.flush()
+        if self.progress is not None and (batch or failed):
+            self.progress(self.report)
+
+    def _write_batch(self, batch):
+        # One transaction for the whole batch:
+        self._stored = []
+        try:
+            transaction.commit_on_success(self._create_all)(batch)
+        except Exception:
+            # Tags created in the rolled-back transaction are gone:
+            self._tags = {}
+            self._delete_stored()
+            raise
+
+    def _delete_stored(self):
+        # The files copied to storage for the rolled-back rows are
+        # referenced by nothing now; left in place, the retry would
+        # store copies under suffixed names beside them.
+        storage = MetaImage._meta.get_field('image').storage
+        for name in self._stored:
+            if not ImageBlob.objects.filter(name=name).exists():
+                try:
+                    storage.delete(name)
+                except (IOError, OSError), e:
+                    logger.warning('Could not delete %s: %s', name, e)
+        self._stored = []
+
+    def _create_all(self, batch):
+        for item in batch:
+            self._create(item)
+
+    def _get_user(self, username):
+        if not username:
+            return self.default_creator
+        if username not in self._users:
+            self._users[username] = User.objects.get(username=username)
+        return self._users[username]
+
+    def _get_tags(self, names):
+        missing = [name for name in names if name not in self._tags]
+        if missing:
+            for tag in Tag.objects.filter(name__in=missing):
+                self._tags[tag.name] = tag
+            for name in missing:
+                if name not in self._tags:
+                    self._tags[name] = Tag.objects.create(name=name)
+        return [self._tags[name] for name in names]
+
+    def _create(self, item):
+        metaimage = MetaImage(
+            title=item.title,
+            caption=item.caption,
+            source_url=item.url,
+            source_note=item.source_note,
+            privacy=item.privacy or self.default_privacy,
+            creator=self._get_user(item.creator),
+            source_etag=item.etag,
+            source_last_modified=item.lastmodified)
+        metaimage.skip_pre_cache = not self.pre_cache
+        if item.url:
+            filename = metaimage.generate_filename_from_url()
+        else:
+            filename = item.filename or os.path.basename(item.path)
+        try:
+            metaimage.store_image_file(
+                item.image_file, item.size, filename, digest=item.digest,
+                image_info=item.image_info)
+        finally:
+            if metaimage._stored_name:
+                self._stored.append(metaimage._stored_name)
+        metaimage.save()
+        if item.url:
+            SourceURL.objects.record(item.url, metaimage.blob, item.etag,
+                                     item.lastmodified, datetime.now())
+        if item.tags:
+            # Rows for a brand new MetaImage can't already exist, so
+            # skip taggit's get_or_create() for each tag:
+            content_type = ContentType.objects.get_for_model(MetaImage)
+            for tag in self._get_tags(item.tags):
+                tagged_item = TaggedItem(
+                    tag=tag, content_type=content_type,
+                    object_id=metaimage.pk)
+                # Nothing of the new image's is cached to be dropped:
+                tagged_item.metaimage_is_new = True
+                tagged_item.save()
+        return metaimage
@@ -0,0 +1,228 @@
+"""
+Workers for fetching remote images in the background.
+
+When MetaImage.save() is called with defer_fetch=True, or with
+METAIMAGE_DEFER_REMOTE_FETCH set, a MetaImage with a source_url is
+saved straight away in the pending state and an IngestJob row is
+queued.  The workers here claim those jobs, do the download, verify
+and store steps, and mark the MetaImage ready (or failed).  Run them
+with "manage.py metaimage_ingest"; several such processes can share
+one queue.
+
+revalidate_source_urls() checks already-fetched source_url images for
+changes, many at a time; see "manage.py metaimage_revalidate".
+"""
+from datetime import datetime, timedelta
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+
+from metaimage import signals
+from metaimage.failures import registry as failure_registry
+from metaimage.models import get_fetch_timeouts, IngestJob, MetaImage, \
+     MetaImageSourceURLUnavailable, INGEST_FAILED, \
+     INGEST_JOB_QUEUED, INGEST_JOB_DONE, INGEST_JOB_FAILED
+from metaimage.utils.workers import run_in_threads
+
+
+INGEST_WORKERS = getattr(settings, 'METAIMAGE_INGEST_WORKERS', 4)
+INGEST_MAX_ATTEMPTS = getattr(settings, 'METAIMAGE_INGEST_MAX_ATTEMPTS', 3)
+INGEST_POLL_INTERVAL = getattr(
+    settings, 'METAIMAGE_INGEST_POLL_INTERVAL', 2.0)  # seconds
+# Jobs running for longer than this are assumed to belong to a dead
+# worker, and are put back on the queue:
+INGEST_STALE_AFTER = timedelta(
+    seconds=getattr(settings, 'METAIMAGE_INGEST_STALE_AFTER', 600))
+REVALIDATE_WORKERS = getattr(settings, 'METAIMAGE_REVALIDATE_WORKERS', 8)
+# Nobody is waiting on a queued fetch, so it can take longer than one
+# made while saving:
+INGEST_FETCH_DEADLINE = getattr(
+    settings, 'METAIMAGE_INGEST_FETCH_DEADLINE', 120)  # seconds
+
+logger = logging.getLogger('metaimage.ingest')
+
+
+def process_job(job, max_attempts=INGEST_MAX_ATTEMPTS):
+    """
+    Fetch and store the image for an already-claimed IngestJob.
+    Returns True on success.  A failed job goes back on the queue
+    until it has been attempted max_attempts times, each time to wait
+    until its URL's failure, and any open circuit of its host, have
+    expired (see failures.py): until then it would only be turned
+    away.  Being turned away doesn't count as an attempt.
+    """
+    metaimage = job.metaimage
+    try:
+        metaimage.fetch_source_url(
+            timeouts=get_fetch_timeouts(deadline=INGEST_FETCH_DEADLINE))
+        metaimage.save()
+    except Exception, e:
+        logger.warning('Fetching %s for MetaImage %s failed: %r',
+                       metaimage.source_url, metaimage.pk, e)
+        job.last_error = repr(e)
+        job.finished = datetime.now()
+        if isinstance(e, MetaImageSourceURLUnavailable):
+            # Nothing was fetched:
+            job.attempts -= 1
+        if job.attempts >= max_attempts:
+            job.status = INGEST_JOB_FAILED
+            job.save()
+            # Update the row directly: save() would just queue the
+            # fetch all over again.  The new updated time keys fresh
+            # copies of its cached fragments and pages.
+            now = datetime.now()
+            MetaImage.objects.filter(pk=metaimage.pk).update(
+                ingest_status=INGEST_FAILED, updated=now)
+            metaimage.ingest_status = INGEST_FAILED
+            metaimage.updated = now
+            signals.ingest_failed.send(
+                sender=MetaImage, metaimage=metaimage, error=e)
+        else:
+            job.status = INGEST_JOB_QUEUED
+            job.not_before = job.finished + timedelta(seconds=max(
+                failure_registry.url_ttl, failure_registry.open_seconds))
+            job.save()
+        return False
+    job.status = INGEST_JOB_DONE
+    job.finished = datetime.now()
+    job.last_error = ''
+    job.save()
+    signals.ingest_completed.send(sender=MetaImage, metaimage=metaimage)
+    return True
+
+
+class IngestWorkerPool(object):
+    """
+    A pool of worker threads that claim and process IngestJobs.
+
+    With drain=True, each worker exits as soon as it finds the queue
+    empty; otherwise workers poll every poll_interval seconds until
+    stop() is called.
+    """
+
+    def __init__(self, num_workers=INGEST_WORKERS,
+                 poll_interval=INGEST_POLL_INTERVAL, drain=False):
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        self.drain = drain
+        self.processed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        IngestJob.objects.requeue_stale(INGEST_STALE_AFTER)
+        prefix = '%s-%s' % (socket.gethostname(), os.getpid())
+        for i in range(self.num_workers):
+            name = '%s-%s' % (prefix, i)
+            worker = threading.Thread(target=self._work, args=(name,), name=name)
+            worker.setDaemon(True)
+            worker.start()
+            self._threads.append(worker)
+
+    def stop(self):
+        self._stopping.set()
+
+    def join(self, timeout=None):
+        # Joining in short steps keeps the main thread responsive to
+        # KeyboardInterrupt.
+        for worker in self._threads:
+            while worker.isAlive():
+                worker.join(timeout or 1)
+                if timeout:
+                    break
+
+    def run(self):
+        self.start()
+        try:
+            self.join()
+        except KeyboardInterrupt:
+            self.stop()
+            self.join()
+
+    def _work(self, name):
+        while not self._stopping.isSet():
+            try:
+                job = IngestJob.objects.claim(name)
+                if job is None:
+                    if self.drain:
+                        return
+                    self._stopping.wait(self.poll_interval)
+                    continue
+                ok = process_job(job)
+                self._lock.acquire()
+                try:
+                    self.processed += 1
+                    if not ok:
+                        self.failed += 1
+                finally:
+                    self._lock.release()
+            finally:
+                # Django keeps one connection per thread; don't leave
+                # them open in between jobs.
+                connection.close()
+
+
+def iter_pks(queryset, batch_size=1000):
+    """
+    Yield the primary keys of queryset in order, a batch at a time, so
+    that huge tables are never loaded at once and no cursor is held
+    open while the rows are being worked on.
+    """
+    last_pk = 0
+    while True:
+        pks = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list(
+            'pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        for pk in pks:
+            yield pk
+        last_pk = pks[-1]
+
+
+def _revalidate(pk):
+    return MetaImage.objects.get(pk=pk).revalidate_source()
+
+
+def revalidate_source_urls(queryset=None, num_workers=REVALIDATE_WORKERS,
+                           checked_before=None):
+    """
+    Revalidate the source_url images in queryset (by default, all of
+    them), num_workers at a time, optionally only those last checked
+    before the datetime checked_before.  Unchanged images (304 Not
+    Modified) cost one conditional GET and one UPDATE; only changed
+    ones are stored and re-rendered.
+
+    Returns a dict of counts: unchanged, updated, failed, plus the
+    elapsed seconds.
+    """
+    if queryset is None:
+        queryset = MetaImage.objects.all()
+    queryset = queryset.exclude(source_url=None).exclude(source_url='')
+    if checked_before is not None:
+        queryset = queryset.filter(
+            Q(source_checked=None) | Q(source_checked__lt=checked_before))
+    counts = {'unchanged': 0, 'updated': 0, 'failed': 0}
+
+    def on_result(pk, changed, exc_info):
+        if exc_info is not None:
+            logger.warning('Revalidating MetaImage %s failed: %r',
+                           pk, exc_info[1])
+            counts['failed'] += 1
+        elif changed:
+            counts['updated'] += 1
+        else:
+            counts['unchanged'] += 1
+
+    started = time.time()
+    run_in_threads(_revalidate, iter_pks(queryset), num_workers,
+                   on_result=on_result, on_exit=connection.close)
+    counts['elapsed'] = time.time() - started
+    return counts
@@ -0,0 +1,85 @@
+"""
+Phase by phase timing of image ingest: when METAIMAGE_INGEST_TIMING is
+on, each MetaImage.save() that fetches, is given or is uploaded an
+image times its phases - waiting on another fetch of the same URL,
+connecting, waiting for the response, waiting between retries,
+downloading, gunzipping, writing the temporary file, verifying,
+digesting, storing, decoding, making renditions and saving the row -
+along with the bytes each handled.
+
+The timings are sent with the metaimage.signals.ingest_timed signal,
+and to METAIMAGE_INGEST_METRICS_HOOK, if set: a callable, or the
+dotted path of one, called as hook(metaimage, source, total, phases,
+error), e.g. to pass them on to statsd.  Ingests that took
+METAIMAGE_INGEST_SLOW_SECONDS or more are also kept as IngestRecords,
+to be looked at in the admin.
+
+With timing off (the default), ingest is timed with a NullTimer that
+keeps nothing, and none of this is called.
+"""
+import logging
+
+from django.conf import settings
+from django.utils import simplejson
+from django.utils.importlib import import_module
+
+from metaimage import signals
+from utils.timing import PhaseTimer, NULL_TIMER
+
+
+INGEST_TIMING = getattr(settings, 'METAIMAGE_INGEST_TIMING', False)
+INGEST_SLOW_SECONDS = getattr(settings, 'METAIMAGE_INGEST_SLOW_SECONDS', 5.0)
+INGEST_METRICS_HOOK = getattr(settings, 'METAIMAGE_INGEST_METRICS_HOOK', None)
+
+logger = logging.getLogger('metaimage.instrumentation')
+
+
+def _get_hook():
+    if isinstance(INGEST_METRICS_HOOK, basestring):
+        module_name, attr = INGEST_METRICS_HOOK.rsplit('.', 1)
+        return getattr(import_module(module_name), attr)
+    return INGEST_METRICS_HOOK
+
+
+metrics_hook = _get_hook()
+
+
+def start_ingest_timer():
+    """
+    A PhaseTimer for timing an ingest, or NULL_TIMER with timing off.
+    """
+    if not INGEST_TIMING:
+        return NULL_TIMER
+    return PhaseTimer()
+
+
+def report_ingest(metaimage, timer, source, error=None):
+    """
+    Send out the timings of metaimage's ingest from source ('url',
+    'data' or 'upload'), which failed with error if that is given.
+    Returns the IngestRecord kept of a slow ingest, or None.
+    """
+    if not timer.enabled:
+        return None
+    total = timer.elapsed()
+    phases = timer.as_list()
+    signals.ingest_timed.send(
+        sender=metaimage.__class__, metaimage=metaimage, source=source,
+        total=total, phases=phases, error=error)
+    if metrics_hook is not None:
+        try:
+            metrics_hook(metaimage, source, total, phases, error)
+        except Exception:
+            # Metrics going astray mustn't hold up ingest.
+            logger.exception('The ingest metrics hook failed')
+    if total < INGEST_SLOW_SECONDS:
+        return None
+    from metaimage.models import IngestRecord
+    return IngestRecord.objects.create(
+        metaimage=metaimage.pk and metaimage or None,
+        source=source,
+        source_url=metaimage.source_url or '',
+        total_seconds=total,
+        file_size=metaimage.file_size,
+        phases=simplejson.dumps(phases),
+        error=error is not None and repr(error) or '')
@@ -0,0 +1,68 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.utils import simplejson
+
+from metaimage.benchmarks.suite import compare_results, run_suite, \
+     DEFAULT_TOLERANCE, FEED_ROWS
+
+
+class Command(NoArgsCommand):
+    help = ('Benchmark saving, checking and rendering MetaImages, and the '
+            'feed views, in a new test database.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+                    help='Save the results as JSON to this file.'),
+        make_option('--baseline', dest='baseline', default=None,
+                    help='Compare the results with those saved in this '
+                    'file, and fail if any are slower.'),
+        make_option('--tolerance', dest='tolerance', type='float',
+                    default=DEFAULT_TOLERANCE,
+                    help='How much slower than the baseline (as a fraction '
+                    'of it) a result can be, before it is a regression.'),
+        make_option('--rows', dest='rows', type='int', action='append',
+                    default=None,
+                    help='Benchmark the feed views with this many images '
+                    '(may be given more than once); by default, %s.'
+                    % ', '.join([str(rows) for rows in FEED_ROWS])),
+        )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        baseline = None
+        if options['baseline']:
+            try:
+                baseline = simplejson.load(open(options['baseline']))
+            except (IOError, ValueError), e:
+                raise CommandError('Can\'t read the baseline %s: %s'
+                                   % (options['baseline'], e))
+
+        def progress(step):
+            if verbosity > 1:
+                print 'Done: %s' % step
+
+        results = run_suite(feed_rows=sorted(options['rows'] or FEED_ROWS),
+                            progress=progress)
+        if options['output']:
+            out = open(options['output'], 'w')
+            try:
+                simplejson.dump(results, out, indent=2, sort_keys=True)
+            finally:
+                out.close()
+        if verbosity > 0:
+            for name in sorted(results['results']):
+                result = results['results'][name]
+                print '%-40s %10.3f ms (min %.3f ms)' % (
+                    name, result['median'] * 1000, result['min'] * 1000)
+        if baseline is not None:
+            regressions = []
+            for name, ratio, regressed in compare_results(
+                    results, baseline, options['tolerance']):
+                if verbosity > 0:
+                    print '%-40s %6.2fx%s' % (
+                        name, ratio, regressed and '  REGRESSION' or '')
+                if regressed:
+                    regressions.append(name)
+            if regressions:
+                raise CommandError('Slower than the baseline: %s'
+                                   % ', '.join(regressions))
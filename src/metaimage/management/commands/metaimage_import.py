@@ -0,0 +1,83 @@
+import os
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from taggit.utils import parse_tags
+
+from metaimage.importer import is_archive, MetaImageImporter, \
+     read_archive, read_directory, read_manifest, IMPORT_BATCH_SIZE, \
+     IMPORT_WORKERS
+
+
+class Command(BaseCommand):
+    args = '<manifest.csv|manifest.jsonl|directory|archive>'
+    help = ('Create MetaImages in bulk from a manifest of image URLs, or '
+            'from the image files in a directory or a zip or tar archive.')
+    option_list = BaseCommand.option_list + (
+        make_option('--creator', dest='creator',
+                    help='Username of the creator, for images whose '
+                    'manifest row does not give one.'),
+        make_option('--workers', dest='workers', type='int',
+                    default=IMPORT_WORKERS,
+                    help='Number of images to fetch at once.'),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=IMPORT_BATCH_SIZE,
+                    help='Number of images written per transaction.'),
+        make_option('--state', dest='state',
+                    help='File recording progress; re-running with the '
+                    'same file skips images already imported.'),
+        make_option('--pre-cache', dest='pre_cache', action='store_true',
+                    default=False,
+                    help='Create renditions now, not on first use.'),
+        make_option('--tags', dest='tags', default='',
+                    help='Tags for images imported from a directory or '
+                    'archive.'),
+        make_option('--privacy', dest='privacy', type='int', default=1,
+                    help='Privacy for images that do not give one.'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give one manifest file, directory or '
+                               'archive.')
+        source = args[0]
+        default_creator = None
+        if options['creator']:
+            try:
+                default_creator = User.objects.get(username=options['creator'])
+            except User.DoesNotExist:
+                raise CommandError('No user named %s.' % options['creator'])
+        verbose = int(options.get('verbosity', 1)) > 0
+
+        def progress(report):
+            if verbose:
+                print unicode(report)
+
+        if os.path.isdir(source) or is_archive(source):
+            if default_creator is None:
+                raise CommandError('--creator is needed to import a '
+                                   'directory or archive.')
+            if os.path.isdir(source):
+                read_files = read_directory
+            else:
+                read_files = read_archive
+            items = read_files(
+                source, tags=parse_tags(options['tags']),
+                privacy=options['privacy'])
+        else:
+            items = read_manifest(source)
+        importer = MetaImageImporter(
+            default_creator,
+            num_workers=options['workers'],
+            batch_size=options['batch_size'],
+            state_path=options['state'],
+            pre_cache=options['pre_cache'],
+            default_privacy=options['privacy'],
+            progress=progress)
+        report = importer.run(items)
+        if verbose:
+            print 'Done: %s' % unicode(report)
+            for key, error in report.failures:
+                print '  %s: %s' % (key, error)
@@ -0,0 +1,31 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from metaimage.ingest import IngestWorkerPool, INGEST_WORKERS, \
+     INGEST_POLL_INTERVAL
+
+
+class Command(NoArgsCommand):
+    help = 'Fetch the remote images of MetaImages saved with a deferred fetch.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', dest='workers', type='int',
+                    default=INGEST_WORKERS,
+                    help='Number of worker threads.'),
+        make_option('--poll-interval', dest='poll_interval', type='float',
+                    default=INGEST_POLL_INTERVAL,
+                    help='Seconds to wait before re-checking an empty queue.'),
+        make_option('--once', dest='once', action='store_true',
+                    default=False,
+                    help='Exit when the queue is empty, instead of polling.'),
+        )
+
+    def handle_noargs(self, **options):
+        pool = IngestWorkerPool(
+            num_workers=options['workers'],
+            poll_interval=options['poll_interval'],
+            drain=options['once'])
+        pool.run()
+        if int(options.get('verbosity', 1)) > 0:
+            print 'Processed %s ingest jobs, %s failed.' % (
+                pool.processed, pool.failed)
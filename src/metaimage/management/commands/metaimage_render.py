@@ -0,0 +1,60 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from metaimage.rendering import render_pending, render_renditions, \
+     RENDER_BATCH_SIZE, RENDER_POLL_INTERVAL, RENDER_WORKERS
+
+
+class Command(NoArgsCommand):
+    help = ('Make the missing or out of date renditions of all MetaImages, '
+            'across a pool of processes.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', dest='workers', type='int',
+                    default=RENDER_WORKERS,
+                    help='Number of render processes.'),
+        make_option('--size', dest='sizes', action='append', default=None,
+                    help='Only make renditions of this PhotoSize (may be '
+                    'given more than once); by default, all pre_cache '
+                    'sizes.'),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=RENDER_BATCH_SIZE,
+                    help='Number of images to hand out at a time.'),
+        make_option('--pending', dest='pending', action='store_true',
+                    default=False,
+                    help='Only render images whose pre_cache renditions '
+                    'are not all made, e.g. those saved with '
+                    'METAIMAGE_RENDER_IN_BACKGROUND.'),
+        make_option('--watch', dest='watch', action='store_true',
+                    default=False,
+                    help='As --pending, but keep checking for more such '
+                    'images until interrupted.'),
+        make_option('--poll-interval', dest='poll_interval', type='float',
+                    default=RENDER_POLL_INTERVAL,
+                    help='Seconds between checks, with --watch.'),
+        )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        def progress(report):
+            if verbosity > 1:
+                print unicode(report)
+
+        if options['pending'] or options['watch']:
+            report = render_pending(
+                processes=options['workers'],
+                batch_size=options['batch_size'],
+                poll_interval=options['watch'] and options['poll_interval']
+                or None,
+                progress=progress)
+        else:
+            report = render_renditions(
+                size_names=options['sizes'],
+                processes=options['workers'],
+                batch_size=options['batch_size'],
+                progress=progress)
+        if verbosity > 0:
+            print 'Done: %s' % unicode(report)
+            for pk, error in report.failures:
+                print '  MetaImage %s: %s' % (pk, error)
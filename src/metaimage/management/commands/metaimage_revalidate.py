@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from metaimage.ingest import revalidate_source_urls, REVALIDATE_WORKERS
+
+
+class Command(NoArgsCommand):
+    help = ('Re-fetch source_url images that have changed at their origin, '
+            'using conditional GETs.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', dest='workers', type='int',
+                    default=REVALIDATE_WORKERS,
+                    help='Number of images to check at once.'),
+        make_option('--older-than', dest='older_than', type='float',
+                    default=None,
+                    help='Only check images not checked in this many hours.'),
+        )
+
+    def handle_noargs(self, **options):
+        checked_before = None
+        if options['older_than'] is not None:
+            checked_before = datetime.now() - timedelta(
+                hours=options['older_than'])
+        counts = revalidate_source_urls(
+            num_workers=options['workers'],
+            checked_before=checked_before)
+        if int(options.get('verbosity', 1)) > 0:
+            total = counts['unchanged'] + counts['updated'] + counts['failed']
+            print ('Checked %s images in %.1fs (%.1f/s): %s unchanged, '
+                   '%s updated, %s failed.' % (
+                       total, counts['elapsed'],
+                       total / max(counts['elapsed'], 0.001),
+                       counts['unchanged'], counts['updated'],
+                       counts['failed']))
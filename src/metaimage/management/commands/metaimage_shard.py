@@ -0,0 +1,44 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from metaimage.sharding import relocate_images, RELOCATE_BATCH_SIZE, \
+     SHARD_DEPTH, SHARD_WIDTH
+
+
+class Command(NoArgsCommand):
+    help = ('Move the stored image files, and their renditions, into the '
+            'sharded directory layout of METAIMAGE_SHARD_DEPTH and '
+            'METAIMAGE_SHARD_WIDTH, updating the MetaImages in batches.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--depth', dest='depth', type='int', default=SHARD_DEPTH,
+                    help='Levels of shard directories; 0 moves the files '
+                    'back out of them.'),
+        make_option('--width', dest='width', type='int', default=SHARD_WIDTH,
+                    help='Hex digits in each shard directory name.'),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=RELOCATE_BATCH_SIZE,
+                    help='Number of MetaImages to work through at a time.'),
+        make_option('--keep-old', dest='keep_old', action='store_true',
+                    default=False,
+                    help='Leave the files at their old places too, e.g. '
+                    'for pages cached with the old URLs.'),
+        )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        def progress(moved, missing):
+            if verbosity > 1:
+                print 'Moved %s images; %s missing or failed.' % (
+                    moved, missing)
+
+        moved, missing = relocate_images(
+            depth=options['depth'],
+            width=options['width'],
+            batch_size=options['batch_size'],
+            keep_old=options['keep_old'],
+            progress=progress)
+        if verbosity > 0:
+            print 'Done: moved %s images; %s missing or failed.' % (
+                moved, missing)
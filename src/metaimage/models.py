@@ -1,22 +1,45 @@
 from cStringIO import StringIO
+from datetime import datetime, timedelta
+import hashlib
+import math
+import os
 import re
-import tempfile
-from urlparse import urlparse
+import sys
+from urlparse import urlparse, urlsplit, urlunsplit
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.core.files import File
+from django.utils import simplejson
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
 from PIL import Image
 
 from autoslug import AutoSlugField
-from photologue.models import ImageModel, PHOTOLOGUE_DIR
+from photologue.models import ImageModel, PhotoSize, PhotoSizeCache, \
+     PHOTOLOGUE_DIR
 from taggit.managers import TaggableManager
+from taggit.models import TaggedItem
 
-from utils.openanything import fetch
+from failures import registry as failure_registry
+from fragments import touch_tagged_metaimage
+from instrumentation import report_ingest, start_ingest_timer
+from rendering import photosize_saved, RENDER_IN_BACKGROUND
+from renditions import get_rendition, invalidate_renditions
+from sharding import shard_filename, shard_name
+from singleflight import get_fetch_locks, FETCH_LOCK_WAIT
+from utils.encoding import save_image, FORMAT_EXTENSIONS, FORMAT_MIME_TYPES
+from utils.exif import exif_camera, exif_date_taken, exif_orientation, \
+     read_exif
+from utils.imageinfo import file_digest, sniff_image_format, SNIFF_SIZE
+from utils.fetchengine import FetchEngine, FetchUnavailable
+from utils.openanything import Fetcher, FetchTimeouts, REJECTED_TOO_LARGE, \
+     REJECTED_TOO_MANY_PIXELS
+from utils.timing import clock, NULL_TIMER
+from variants import get_policy, scale_photosize
 
 
 if getattr(settings, 'METAIMAGE_MAX_REMOTE_IMAGE_SIZE', False):
@@ -24,6 +47,53 @@ if getattr(settings, 'METAIMAGE_MAX_REMOTE_IMAGE_SIZE', False):
 else:
     MAX_REMOTE_IMAGE_SIZE = 1048576  # 1 MB
 
+# Images bigger than this many pixels (width times height) are turned
+# down from their headers - remote ones as soon as the start of the
+# file shows their size - and never decoded, as that would take too
+# much time and memory:
+MAX_IMAGE_PIXELS = getattr(settings, 'METAIMAGE_MAX_IMAGE_PIXELS', 50000000)
+# Responses whose Content-Type starts with none of these aren't images
+# (a response without one is still looked at):
+ACCEPTED_CONTENT_TYPES = tuple(getattr(
+    settings, 'METAIMAGE_ACCEPTED_CONTENT_TYPES',
+    ('image/', 'application/octet-stream', 'binary/octet-stream')))
+# The checks made on remote images while they are fetched, so that
+# what isn't an image, or is too big, is abandoned as early as possible:
+IMAGE_FETCH_OPTIONS = {
+    'max_size': MAX_REMOTE_IMAGE_SIZE,
+    'check_header': sniff_image_format,
+    'header_size': SNIFF_SIZE,
+    'accept_types': ACCEPTED_CONTENT_TYPES,
+    'max_pixels': MAX_IMAGE_PIXELS}
+
+# Remote images are fetched over keep-alive connections, with up to
+# METAIMAGE_HTTP_POOL_SIZE idle connections kept open per host:
+#
+# Each fetch has METAIMAGE_FETCH_CONNECT_TIMEOUT seconds to connect,
+# METAIMAGE_FETCH_READ_TIMEOUT for each read, and
+# METAIMAGE_FETCH_DEADLINE for the whole fetch, retries included; pass
+# connect_timeout, read_timeout or deadline to save() to change them
+# for one fetch.
+FETCH_TIMEOUTS = FetchTimeouts(
+    connect=getattr(settings, 'METAIMAGE_FETCH_CONNECT_TIMEOUT', 5),
+    read=getattr(settings, 'METAIMAGE_FETCH_READ_TIMEOUT', 10),
+    deadline=getattr(settings, 'METAIMAGE_FETCH_DEADLINE', 30))
+FETCHER = Fetcher(
+    pool_size=getattr(settings, 'METAIMAGE_HTTP_POOL_SIZE', 4),
+    timeouts=FETCH_TIMEOUTS)
+# Fetches, from any number of threads, are limited to
+# METAIMAGE_FETCH_MAX_CONCURRENCY at once, and METAIMAGE_FETCH_PER_HOST
+# at once to any one host.  URLs and hosts that have been failing are
+# turned away for a while without a fetch, see failures.py:
+FETCH_ENGINE = FetchEngine(
+    max_concurrency=getattr(settings, 'METAIMAGE_FETCH_MAX_CONCURRENCY', 32),
+    per_host=getattr(settings, 'METAIMAGE_FETCH_PER_HOST', 4),
+    fetcher=FETCHER,
+    breaker=failure_registry)
+# Only one thread or process at a time fetches any one source_url; see
+# singleflight.py:
+FETCH_LOCKS = get_fetch_locks()
+
 # The METAIMAGE_DIR parameter is referenced in tests.py when cleaning
 # up after unit-tests, otherwise old test images litter the directory:
 #
@@ -37,6 +107,23 @@ if getattr(settings, 'PHOTOLOGUE_DIR', False):
 else:
     METAIMAGE_DIR = PHOTOLOGUE_DIR
 
+# With METAIMAGE_DEFER_REMOTE_FETCH set to True, saving a MetaImage
+# that has a source_url only queues the download (see ingest.py), and
+# the row is saved straight away in the pending state.  Run "manage.py
+# metaimage_ingest" to work through the queue.
+DEFER_REMOTE_FETCH = getattr(settings, 'METAIMAGE_DEFER_REMOTE_FETCH', False)
+
+# A source_url fetched within METAIMAGE_SOURCE_URL_FRESH_SECONDS is
+# taken to be unchanged, so another MetaImage with the same source_url
+# uses the stored image without asking the origin; after that, the
+# origin is asked with a conditional GET.  See SourceURL.
+SOURCE_URL_FRESH_FOR = timedelta(
+    seconds=getattr(settings, 'METAIMAGE_SOURCE_URL_FRESH_SECONDS', 86400))
+
+# Optional image URL shown by render() while an image is pending.
+PENDING_PLACEHOLDER_URL = getattr(
+    settings, 'METAIMAGE_PENDING_PLACEHOLDER_URL', None)
+
 
 PRIVACY_CHOICES = (
     (1, _('Public')),
@@ -44,6 +131,22 @@ PRIVACY_CHOICES = (
     (3, _('Private')),
     )
 
+INGEST_READY = 1
+INGEST_PENDING = 2
+INGEST_FAILED = 3
+INGEST_STATUS_CHOICES = (
+    (INGEST_READY, _('Ready')),
+    (INGEST_PENDING, _('Pending')),
+    (INGEST_FAILED, _('Failed')),
+    )
+
+
+# The MetaImage fields that describe its image file, set by
+# set_image_info():
+IMAGE_INFO_FIELDS = ('width', 'height', 'image_format', 'image_mode',
+                     'file_size', 'exif_data', 'camera', 'orientation',
+                     'date_taken')
+
 
 class MetaImageException(Exception):
     pass
@@ -53,10 +156,45 @@ class MetaImageUnableToRetrieveSourceURL(MetaImageException):
     pass
 
 
+class MetaImageSourceURLUnavailable(MetaImageUnableToRetrieveSourceURL):
+    """The source_url, or its host, failed recently, so wasn't tried."""
+    pass
+
+
 class MetaImageSourceURLNotAnImage(MetaImageException):
     pass
 
 
+class MetaImageSourceURLTooLarge(MetaImageException):
+    pass
+
+
+def get_fetch_timeouts(connect_timeout=None, read_timeout=None, deadline=None):
+    """
+    FETCH_TIMEOUTS, but with whichever time limits are given instead.
+    """
+    return FetchTimeouts(
+        connect=connect_timeout or FETCH_TIMEOUTS.connect,
+        read=read_timeout or FETCH_TIMEOUTS.read,
+        deadline=deadline or FETCH_TIMEOUTS.deadline)
+
+
+def check_fetched_image(result):
+    """
+    Raise the right MetaImageException if a successful fetch_to_file()
+    result was rejected, or cut short at MAX_REMOTE_IMAGE_SIZE.
+    """
+    rejected = result.get('rejected')
+    if rejected in (REJECTED_TOO_LARGE, REJECTED_TOO_MANY_PIXELS):
+        raise MetaImageSourceURLTooLarge(rejected)
+    if rejected:
+        raise MetaImageSourceURLNotAnImage(rejected)
+    if result.get('truncated'):
+        result['file'].close()
+        raise MetaImageSourceURLTooLarge(
+            'More than %s bytes' % MAX_REMOTE_IMAGE_SIZE)
+
+
 class BaseModel(models.Model):
     """
     An abstract base class that provides standard fields for every
@@ -92,6 +230,247 @@ class ImageSet(BaseModel):
     tags = TaggableManager()
 
 
+class ImageBlobManager(models.Manager):
+
+    def retain(self, blob_id):
+        self.filter(pk=blob_id).update(ref_count=models.F('ref_count') + 1)
+
+    def release(self, blob_id):
+        """
+        Drop a reference to a blob; once nothing refers to it, its
+        file is deleted from storage, along with the row.
+        """
+        self.filter(pk=blob_id, ref_count__gt=0).update(
+            ref_count=models.F('ref_count') - 1)
+        unreferenced = self.filter(pk=blob_id, ref_count__lte=0)
+        for blob in unreferenced:
+            in_use = blob.metaimages.count()
+            if in_use:
+                # The count had drifted; deleting now would take the
+                # MetaImages with it.
+                self.filter(pk=blob.pk).update(ref_count=in_use)
+                continue
+            storage = MetaImage._meta.get_field('image').storage
+            if storage.exists(blob.name):
+                storage.delete(blob.name)
+            blob.delete()
+
+
+class ImageBlob(models.Model):
+    """
+    A stored image file, keyed by the SHA-256 digest of its contents,
+    so that MetaImages with identical image data share one file - and
+    with it, one set of photologue renditions.  ref_count is the number
+    of MetaImages using the file.
+    """
+    digest = models.CharField(max_length=64, unique=True)
+    # The file's name in the MetaImage.image storage:
+    name = models.CharField(max_length=255)
+    size = models.PositiveIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+
+    objects = ImageBlobManager()
+
+    def __unicode__(self):
+        return self.name
+
+
+def normalize_source_url(url):
+    """
+    url in a standard form, so that trivially different spellings of
+    the same URL are indexed as one: the scheme and host lower-cased,
+    a default port and the fragment dropped, and an empty path made /.
+    """
+    parsed_url = urlsplit(url.strip())
+    scheme = parsed_url.scheme.lower()
+    userinfo, at, host = parsed_url.netloc.rpartition('@')
+    host = host.lower()
+    default_port = {'http': ':80', 'https': ':443'}.get(scheme)
+    if default_port and host.endswith(default_port):
+        host = host[:-len(default_port)]
+    netloc = userinfo + at + host
+    return urlunsplit((scheme, netloc, parsed_url.path or '/',
+                       parsed_url.query, ''))
+
+
+def source_url_digest(url):
+    """The hex SHA-256 digest of url, normalized."""
+    return hashlib.sha256(
+        normalize_source_url(url).encode('utf-8')).hexdigest()
+
+
+class SourceURLManager(models.Manager):
+
+    def lookup(self, url):
+        """
+        The SourceURL for url, with its blob, or None if it hasn't been
+        fetched.
+        """
+        try:
+            return self.select_related('blob').get(
+                url_digest=source_url_digest(url))
+        except self.model.DoesNotExist:
+            return None
+
+    def record(self, url, blob, etag=None, last_modified=None, checked=None):
+        """
+        Record that url gave the image stored as blob, with the
+        validators etag and last_modified, when checked.
+        """
+        url_digest = source_url_digest(url)
+        values = dict(blob=blob, etag=etag, last_modified=last_modified,
+                      checked=checked or datetime.now())
+        if self.filter(url_digest=url_digest).update(**values):
+            return
+        savepoint_id = transaction.savepoint()
+        try:
+            self.create(url_digest=url_digest,
+                        url=normalize_source_url(url), **values)
+            transaction.savepoint_commit(savepoint_id)
+        except IntegrityError:
+            # Another process recorded it at the same time.
+            transaction.savepoint_rollback(savepoint_id)
+            self.filter(url_digest=url_digest).update(**values)
+
+
+class SourceURL(models.Model):
+    """
+    A source_url that has been fetched, and the blob its image was
+    stored as, so that another MetaImage with the same source_url can
+    use that image (and its renditions) rather than downloading it
+    again.  Looked up by the SHA-256 digest of the normalized URL;
+    etag and last_modified are the validators the image was sent with,
+    and checked when it was last fetched or found unchanged.
+    """
+    url_digest = models.CharField(max_length=64, unique=True)
+    url = models.TextField()
+    blob = models.ForeignKey(ImageBlob, related_name='source_urls')
+    etag = models.CharField(max_length=255, blank=True, null=True)
+    last_modified = models.CharField(max_length=64, blank=True, null=True)
+    checked = models.DateTimeField()
+
+    objects = SourceURLManager()
+
+    class Meta:
+        verbose_name = 'source URL'
+
+    def __unicode__(self):
+        return self.url
+
+    def is_fresh(self):
+        return self.checked >= datetime.now() - SOURCE_URL_FRESH_FOR
+
+    def get_metaimage(self):
+        """
+        A MetaImage using the blob, to copy the image's details from,
+        or None if there are none.
+        """
+        metaimages = MetaImage.objects.filter(
+            blob=self.blob, ingest_status=INGEST_READY)[:1]
+        return metaimages and metaimages[0] or None
+
+
+class FetchLock(models.Model):
+    """
+    A source_url being fetched, by owner, until expires, for the
+    'database' single-flight locks; see singleflight.py.
+    """
+    # The digest of the URL:
+    key = models.CharField(max_length=64, unique=True)
+    owner = models.CharField(max_length=32)
+    expires = models.DateTimeField()
+
+    def __unicode__(self):
+        return self.key
+
+
+class TagBatch(object):
+    """
+    The tags of a batch of MetaImages, loaded with one query for the
+    whole batch the first time any of them asks for its tags.
+    """
+
+    def __init__(self, metaimages):
+        self.metaimages = metaimages
+        self.tags = None
+
+    def tags_for(self, metaimage):
+        if self.tags is None:
+            self.tags = dict([(m.pk, []) for m in self.metaimages])
+            tagged_items = TaggedItem.objects.filter(
+                content_type=ContentType.objects.get_for_model(MetaImage),
+                object_id__in=self.tags.keys()).select_related('tag')
+            for tagged_item in tagged_items.order_by('tag__name'):
+                self.tags[tagged_item.object_id].append(tagged_item.tag)
+        return self.tags.get(metaimage.pk, [])
+
+
+class MetaImageQuerySet(models.query.QuerySet):
+    """
+    Adds with_tags(), which lets the MetaImages fetched share TagBatches,
+    so that listing every image's tags costs one query per batch of
+    images instead of one per image.
+    """
+    _tag_batches = False
+    tag_batch_size = 100
+
+    def with_tags(self):
+        return self._clone(_tag_batches=True)
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_tag_batches', self._tag_batches)
+        return super(MetaImageQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def iterator(self):
+        if not self._tag_batches:
+            for metaimage in super(MetaImageQuerySet, self).iterator():
+                yield metaimage
+            return
+        batch = []
+        for metaimage in super(MetaImageQuerySet, self).iterator():
+            batch.append(metaimage)
+            if len(batch) == self.tag_batch_size:
+                for metaimage in self._share_tag_batch(batch):
+                    yield metaimage
+                batch = []
+        for metaimage in self._share_tag_batch(batch):
+            yield metaimage
+
+    def _share_tag_batch(self, metaimages):
+        tag_batch = TagBatch(metaimages)
+        for metaimage in metaimages:
+            metaimage._tag_batch = tag_batch
+        return metaimages
+
+
+class MetaImageManager(models.Manager):
+
+    def get_query_set(self):
+        return MetaImageQuerySet(self.model, using=self._db)
+
+    def with_tags(self):
+        return self.get_query_set().with_tags()
+
+    def count_views(self, metaimages):
+        """
+        Count a view of each of metaimages, as increment_count() does,
+        but in one UPDATE for them all (one per repeat, for any listed
+        more than once).
+        """
+        views = {}
+        for metaimage in metaimages:
+            metaimage.view_count += 1
+            if metaimage.pk:
+                views[metaimage.pk] = views.get(metaimage.pk, 0) + 1
+        by_count = {}
+        for pk, count in views.items():
+            by_count.setdefault(count, []).append(pk)
+        for count, pks in by_count.items():
+            self.filter(pk__in=pks).update(
+                view_count=models.F('view_count') + count)
+
+
 class MetaImage(ImageModel, BaseModel):
     """
     An image with its useful details.  Parallels photologue's Photo
@@ -148,6 +527,63 @@ class MetaImage(ImageModel, BaseModel):
     imageset = models.ManyToManyField(
         ImageSet, blank=True, null=True, verbose_name=_('image set'))
     tags = TaggableManager(blank=True)  # taggit has blank=False by default.
+    # Whether the image file is in place yet; only deferred source_url
+    # fetches are ever pending.
+    ingest_status = models.IntegerField(
+        _('ingest status'),
+        choices=INGEST_STATUS_CHOICES, default=INGEST_READY,
+        editable=False, db_index=True)
+    # The content-addressed file behind image, if it was stored by
+    # store_image_file(); see ImageBlob.
+    blob = models.ForeignKey(
+        ImageBlob, blank=True, null=True, editable=False,
+        related_name='metaimages')
+    # Validators sent with the source_url image, for conditional GETs
+    # when revalidating it, and when that was last done:
+    source_etag = models.CharField(
+        max_length=255, blank=True, null=True, editable=False)
+    source_last_modified = models.CharField(
+        max_length=64, blank=True, null=True, editable=False)
+    source_checked = models.DateTimeField(
+        blank=True, null=True, editable=False, db_index=True)
+    # Facts about the image file, captured once when it is stored, so
+    # that rendering never has to open it:
+    width = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    height = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    image_format = models.CharField(max_length=10, blank=True, editable=False)
+    image_mode = models.CharField(max_length=10, blank=True, editable=False)
+    file_size = models.PositiveIntegerField(
+        blank=True, null=True, editable=False)
+    # Whether the pre_cache PhotoSize renditions have been created:
+    renditions_cached = models.BooleanField(default=False, editable=False)
+    # The image's EXIF data, as JSON, read along with the facts above;
+    # date_taken (from ImageModel) is filled in from it too.
+    exif_data = models.TextField(blank=True, default='', editable=False)
+    camera = models.CharField(
+        _('camera'), max_length=100, blank=True, default='', editable=False,
+        db_index=True)
+    orientation = models.PositiveSmallIntegerField(
+        blank=True, null=True, editable=False, db_index=True)
+
+    # Set by store_image_file() until the row is saved:
+    _new_blob = None
+    # The name of the file store_image_file() copied to storage, if it
+    # copied one:
+    _stored_name = None
+    # Set to True to leave renditions to be created on first use,
+    # rather than when saving:
+    skip_pre_cache = False
+    # Set on MetaImages fetched with MetaImage.objects.with_tags():
+    _tag_batch = None
+    # The parsed exif_data:
+    _exif = None
+    # Timing the ingest of an image, from the start of a fetch (or of
+    # save()) until the row is saved, and where the image came from;
+    # see instrumentation.py:
+    _ingest_timer = None
+    _ingest_source = None
+
+    objects = MetaImageManager()
 
     class Meta:
         verbose_name = 'MetaImage'
@@ -159,15 +595,78 @@ class MetaImage(ImageModel, BaseModel):
     def get_absolute_url(self):
         return ("metaimage_details", [self.pk])
 
+    def get_tag_list(self):
+        """
+        Returns this MetaImage's tags as a list; when it was fetched
+        with MetaImage.objects.with_tags(), without a query of its own.
+        """
+        if self._tag_batch is not None:
+            return self._tag_batch.tags_for(self)
+        return list(self.tags.order_by('name'))
+
     def is_str_an_image(self, the_string):
         # Verify that the data is, in fact, an image.
         assert isinstance(the_string, str)
-        the_image = Image.open(StringIO(the_string))
+        return self.is_file_an_image(StringIO(the_string))
+
+    def is_file_an_image(self, the_file):
+        return self.inspect_image_file(the_file) is not None
+
+    def inspect_image_file(self, the_file):
+        """
+        Check that the_file holds a valid image, of no more than
+        MAX_IMAGE_PIXELS pixels, and if so return a dict of its format,
+        width, height, mode and EXIF data; otherwise None.  Only the
+        image header is decoded.
+        """
+        the_file.seek(0)
         try:
+            the_image = Image.open(the_file)
+            if the_image.size[0] * the_image.size[1] > MAX_IMAGE_PIXELS:
+                return None
+            image_info = {
+                'format': the_image.format,
+                'width': the_image.size[0],
+                'height': the_image.size[1],
+                'mode': the_image.mode,
+                'exif': read_exif(the_image)}
             the_image.verify()
-            return True
         except Exception:
-            return False
+            return None
+        return image_info
+
+    def set_image_info(self, image_info, size):
+        self.width = image_info['width']
+        self.height = image_info['height']
+        self.image_format = image_info['format'] or ''
+        self.image_mode = image_info['mode'] or ''
+        self.file_size = size
+        exif = image_info.get('exif') or {}
+        self.exif_data = exif and simplejson.dumps(exif) or ''
+        self._exif = exif
+        self.camera = exif_camera(exif)[:100]
+        self.orientation = exif_orientation(exif)
+        # photologue's date_taken can be set by hand, so keep it unless
+        # the EXIF data has one:
+        date_taken = exif_date_taken(exif)
+        if date_taken is not None:
+            self.date_taken = date_taken
+
+    @property
+    def exif(self):
+        """
+        The image's EXIF data, as a dict of tag name -> value.
+        """
+        if self._exif is None:
+            self._exif = self.exif_data and simplejson.loads(
+                self.exif_data) or {}
+        return self._exif
+
+    @property
+    def EXIF(self):
+        # photologue reads this from the image file every time, e.g.
+        # on every save of an image without a date_taken:
+        return self.exif
 
     def save(self, *args, **kwargs):
         """
@@ -178,38 +677,624 @@ class MetaImage(ImageModel, BaseModel):
         For the other major use-case of server-side generated images,
         pass in the raw image data as a string with
         save(image_data=the_image_as_string).
+
+        Pass defer_fetch=True (or set METAIMAGE_DEFER_REMOTE_FETCH) to
+        save a source_url image right away in the pending state, and
+        leave the download to the ingest workers.
+
+        The time limits of fetching a source_url image, in seconds,
+        can be given as connect_timeout, read_timeout and deadline (for
+        the whole fetch, retries included), e.g. a short deadline for
+        a user waiting on an upload form; by default they are those of
+        the METAIMAGE_FETCH_* settings.
+        """
+        defer_fetch = kwargs.pop('defer_fetch', DEFER_REMOTE_FETCH)
+        timeouts = get_fetch_timeouts(
+            kwargs.pop('connect_timeout', None),
+            kwargs.pop('read_timeout', None),
+            kwargs.pop('deadline', None))
+        try:
+            queue_fetch = self._save(defer_fetch, timeouts, *args, **kwargs)
+        except Exception:
+            self._fail_ingest()
+        self._finish_ingest()
+        if queue_fetch:
+            IngestJob.objects.enqueue(self)
+
+    def _save(self, defer_fetch, timeouts, *args, **kwargs):
         """
-        raw_image_data = None
-        local_img_filename = None
+        The work of save(); returns whether to queue a fetch.
+        """
+        queue_fetch = False
         # There are three cases of how we get image data: 1) uploaded,
         # 2) remote image URL given, or 3) the raw image string is
         # passed in.  Cases 2) and 3) are handled below:
-        if getattr(self, 'source_url') and not getattr(self, 'image'):
-            # Download remote data, synchronously for now:
-            image_data_dct = fetch(
-                self.source_url,
-                max_size=MAX_REMOTE_IMAGE_SIZE)
-            if not image_data_dct:
-                raise MetaImageUnableToRetrieveSourceURL
-            raw_image_data = image_data_dct['data']
-            local_img_filename = self.generate_filename_from_url()
+        if getattr(self, 'source_url') and not getattr(self, 'image') \
+               and (self.pk is None or self.ingest_status not in (
+                   INGEST_PENDING, INGEST_FAILED)):
+            # An image already queued, or given up on, is left to the
+            # ingest queue: editing its title, say, mustn't fetch it.
+            if not defer_fetch:
+                self.fetch_source_url(timeouts=timeouts)
+            elif not self.attach_known_source(fresh_only=True):
+                self.ingest_status = INGEST_PENDING
+                queue_fetch = True
         elif 'image_data' in kwargs and not self.source_url and not self.image:
             # Alternatively, raw image data (as a string) was given:
             raw_image_data = kwargs.pop('image_data')
-            local_img_filename = self.generate_filename_from_data(
-                raw_image_data)
-        # Create and save the remote/given image if needed:
-        if raw_image_data and local_img_filename:
-            assert self.is_str_an_image(raw_image_data)
-            # Django's save() method must receive a Django File
-            # object, which in turn, must be wrapped around a real
-            # file (not StringIO) to work. Thus use tempfile:
-            tmp_file = tempfile.NamedTemporaryFile()
-            tmp_file.write(raw_image_data)
-            self.image.save(local_img_filename, File(tmp_file))
+            self._start_ingest('data')
+            self.store_image_data(
+                raw_image_data,
+                self.generate_filename_from_data(raw_image_data))
+        elif self.image and not self.image._committed:
+            # A newly uploaded file, still to be written to storage:
+            self._start_ingest('upload')
+            uploaded_file = self.image.file
+            self.store_image_file(
+                uploaded_file, uploaded_file.size, self.image.name)
+        elif self.image and shard_name(self.image.name) != self.image.name \
+                 and not self.image.storage.exists(self.image.name):
+            # Loaded before relocate_images() moved the file into the
+            # current layout (see sharding.py): don't point the row
+            # back to where it was.
+            sharded_name = shard_name(self.image.name)
+            if self.image.storage.exists(sharded_name):
+                self.image = sharded_name
         if self.creator and not self.updater:
             self.updater = self.creator
+        # ImageModel.save() finishes with pre_cache(), which clears
+        # this again if it can't make them:
+        self.renditions_cached = bool(self.image) and not (
+            self.skip_pre_cache or RENDER_IN_BACKGROUND)
+        replaced_blob_id = None
+        if self._new_blob is not None:
+            replaced_blob_id = self.blob_id
+            self.blob = self._new_blob
+        timer = self._ingest_timer or NULL_TIMER
+        started = clock()
+        rendering = timer.seconds('decode') + timer.seconds('renditions')
         super(MetaImage, self).save(*args, **kwargs)
+        # Less the time pre_cache() took:
+        timer.add('database', clock() - started - (
+            timer.seconds('decode') + timer.seconds('renditions') - rendering))
+        if self._new_blob is not None:
+            if self._new_blob.pk != replaced_blob_id:
+                ImageBlob.objects.retain(self._new_blob.pk)
+                if replaced_blob_id:
+                    ImageBlob.objects.release(replaced_blob_id)
+            self._new_blob = None
+        return queue_fetch
+
+    def _start_ingest(self, source):
+        if self._ingest_timer is None:
+            self._ingest_timer = start_ingest_timer()
+            self._ingest_source = source
+        return self._ingest_timer
+
+    def _finish_ingest(self, error=None):
+        timer = self._ingest_timer
+        if timer is None:
+            return
+        self._ingest_timer = None
+        report_ingest(self, timer, self._ingest_source, error)
+
+    def _fail_ingest(self):
+        """
+        Report the ingest as failed with the exception being handled,
+        then re-raise that.
+        """
+        exc_info = sys.exc_info()
+        self._finish_ingest(exc_info[1])
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    def delete(self):
+        blob_id = self.blob_id
+        super(MetaImage, self).delete()
+        if blob_id:
+            ImageBlob.objects.release(blob_id)
+
+    def fetch_source_url(self, conditional=False, timeouts=None):
+        """
+        Download the image at source_url into this MetaImage's image
+        field.  Does not save the row; called by save(), or by an
+        ingest worker for deferred fetches.
+
+        The download is streamed through a spooled temporary file, so
+        memory use stays flat however big MAX_REMOTE_IMAGE_SIZE is.
+        A response that isn't an image, or is too big, is abandoned as
+        soon as its headers or first chunk show it (see
+        IMAGE_FETCH_OPTIONS), and one that runs past
+        MAX_REMOTE_IMAGE_SIZE raises MetaImageSourceURLTooLarge rather
+        than being stored cut short.
+
+        timeouts, a utils.openanything.FetchTimeouts, default to
+        FETCH_TIMEOUTS.
+
+        With conditional=True the stored ETag/Last-Modified validators
+        are sent, and if the origin answers 304 Not Modified nothing
+        is changed.  Otherwise, if source_url has been fetched before
+        (see SourceURL), its stored image is used: straight away if it
+        is fresh, or if not, once a conditional GET shows it hasn't
+        changed.  Returns True if a new image was stored.
+        """
+        # Started here rather than in save(), as the ingest workers fetch
+        # before saving:
+        timer = self._start_ingest('url')
+        try:
+            return self._fetch_source_url(
+                conditional, timeouts or FETCH_TIMEOUTS, timer)
+        except Exception:
+            self._fail_ingest()
+
+    def _fetch_source_url(self, conditional, timeouts, timer):
+        if conditional or FETCH_LOCKS is None:
+            return self._fetch_source_url_once(conditional, timeouts, timer)
+        # If another thread or process is fetching the same URL, wait
+        # for it to finish, then use the image it stored:
+        timeouts = timeouts.start()
+        wait = FETCH_LOCK_WAIT
+        if timeouts.remaining() is not None:
+            wait = max(0, min(wait, timeouts.remaining()))
+        started = clock()
+        token = FETCH_LOCKS.acquire(source_url_digest(self.source_url), wait)
+        timer.add('lock_wait', clock() - started)
+        try:
+            return self._fetch_source_url_once(False, timeouts, timer)
+        finally:
+            FETCH_LOCKS.release(token)
+
+    def _fetch_source_url_once(self, conditional, timeouts, timer):
+        etag = lastmodified = None
+        known = None
+        if conditional:
+            etag = self.source_etag
+            lastmodified = self.source_last_modified
+        else:
+            known = SourceURL.objects.lookup(self.source_url)
+            if known is not None and known.is_fresh():
+                if self.attach_known_source(known):
+                    return True
+                known = None
+            elif known is not None:
+                etag = known.etag
+                lastmodified = known.last_modified
+        try:
+            image_data_dct = FETCH_ENGINE.fetch_to_file(
+                self.source_url,
+                etag=etag,
+                lastmodified=lastmodified,
+                timer=timer,
+                timeouts=timeouts,
+                **IMAGE_FETCH_OPTIONS)
+        except FetchUnavailable, e:
+            raise MetaImageSourceURLUnavailable(str(e))
+        if not image_data_dct:
+            raise MetaImageUnableToRetrieveSourceURL
+        self.source_checked = datetime.now()
+        if image_data_dct.get('status') == 304:
+            image_data_dct['file'].close()
+            if known is None:
+                if self.blob_id:
+                    SourceURL.objects.record(
+                        self.source_url, self.blob, self.source_etag,
+                        self.source_last_modified, self.source_checked)
+                return False
+            known.checked = self.source_checked
+            SourceURL.objects.filter(pk=known.pk).update(
+                checked=known.checked)
+            if self.attach_known_source(known):
+                return True
+            # The stored image has gone since it was looked up:
+            return self._fetch_source_url_once(True, timeouts, timer)
+        if image_data_dct.get('status', 200) >= 400:
+            raise MetaImageUnableToRetrieveSourceURL(
+                'HTTP %s' % image_data_dct['status'])
+        check_fetched_image(image_data_dct)
+        image_file = image_data_dct['file']
+        try:
+            self.store_image_file(
+                image_file,
+                image_data_dct['size'],
+                self.generate_filename_from_url())
+        finally:
+            image_file.close()
+        self.source_etag = image_data_dct.get('etag')
+        self.source_last_modified = image_data_dct.get('lastmodified')
+        self.ingest_status = INGEST_READY
+        SourceURL.objects.record(
+            self.source_url, self._new_blob, self.source_etag,
+            self.source_last_modified, self.source_checked)
+        return True
+
+    def attach_known_source(self, known=None, fresh_only=False):
+        """
+        Make the image stored for source_url by an earlier fetch this
+        MetaImage's image, along with its details and validators,
+        without fetching anything.  known is source_url's SourceURL,
+        looked up if not given; with fresh_only, a SourceURL that isn't
+        fresh is passed over.  Returns whether the image was attached.
+        """
+        if known is None:
+            known = SourceURL.objects.lookup(self.source_url)
+        if known is None or (fresh_only and not known.is_fresh()):
+            return False
+        storage = self.image.storage
+        if not storage.exists(known.blob.name):
+            return False
+        example = known.get_metaimage()
+        if example is not None:
+            for field in IMAGE_INFO_FIELDS:
+                setattr(self, field, getattr(example, field))
+            self._exif = None
+        else:
+            # Nothing saved uses the image yet, e.g. as the fetch that
+            # stored it has only just finished:
+            stored_file = storage.open(known.blob.name, 'rb')
+            try:
+                image_info = self.inspect_image_file(stored_file)
+            finally:
+                stored_file.close()
+            if image_info is None:
+                return False
+            self.set_image_info(image_info, known.blob.size)
+        self.image = known.blob.name
+        self._new_blob = known.blob
+        self.source_etag = known.etag
+        self.source_last_modified = known.last_modified
+        self.source_checked = known.checked
+        self.ingest_status = INGEST_READY
+        return True
+
+    def revalidate_source(self):
+        """
+        Check, with a conditional GET, whether the source_url image has
+        changed since it was fetched; if it has, store the new image
+        and re-create its renditions.  Returns True if it changed.
+        """
+        old_image_name = self.image.name
+        try:
+            changed = self.fetch_source_url(conditional=bool(self.image))
+        except MetaImageException:
+            MetaImage.objects.filter(pk=self.pk).update(
+                source_checked=datetime.now())
+            raise
+        if not changed or self.image.name == old_image_name:
+            # Cheap path: the image file is the same, so just record
+            # the check and the validators.
+            self._new_blob = None
+            MetaImage.objects.filter(pk=self.pk).update(
+                source_checked=self.source_checked,
+                source_etag=self.source_etag,
+                source_last_modified=self.source_last_modified)
+            self._finish_ingest()
+            return False
+        if old_image_name:
+            # Renditions are named after the image file, so the old
+            # ones have to be cleared under the old name:
+            new_image_name = self.image.name
+            self.image = old_image_name
+            self.clear_cache()
+            self.image = new_image_name
+        self.save()
+        return True
+
+    def store_image_data(self, raw_image_data, local_img_filename):
+        self.store_image_file(
+            StringIO(raw_image_data),
+            len(raw_image_data),
+            local_img_filename)
+
+    def store_image_file(self, image_file, size, local_img_filename, digest=None, image_info=None):
+        """
+        Verify that image_file (size bytes long) holds an image, and
+        make it this MetaImage's image.  If identical data is already
+        stored, the existing file (and its renditions) are used;
+        otherwise it is copied to storage as local_img_filename, in
+        its shard directories if the storage is sharded (see
+        sharding.py).
+
+        A caller that has already inspected the file and taken its
+        SHA-256 digest can pass in both, to skip doing so again.
+        """
+        timer = self._ingest_timer or NULL_TIMER
+        if digest is None:
+            started = clock()
+            image_info = self.inspect_image_file(image_file)
+            timer.add('verify', clock() - started, size)
+            assert image_info is not None
+            started = clock()
+            digest = file_digest(image_file)
+            timer.add('digest', clock() - started, size)
+        if image_info is not None:
+            self.set_image_info(image_info, size)
+        storage = self.image.storage
+        try:
+            blob = ImageBlob.objects.get(digest=digest)
+        except ImageBlob.DoesNotExist:
+            blob = None
+        if blob is not None and storage.exists(blob.name):
+            self.image = blob.name
+            self._new_blob = blob
+            return
+        image_file.seek(0)
+        # Django can't work out the size of a file object that isn't
+        # on disk, so tell it:
+        django_file = File(image_file)
+        django_file.size = size
+        # The row itself is saved by our caller:
+        started = clock()
+        self.image.save(shard_filename(os.path.basename(local_img_filename)),
+                        django_file, save=False)
+        timer.add('storage', clock() - started, size)
+        self._stored_name = self.image.name
+        if blob is not None:
+            # The blob's file had gone missing from storage:
+            blob.name = self.image.name
+            blob.save()
+            self._new_blob = blob
+            return
+        savepoint_id = transaction.savepoint()
+        try:
+            blob = ImageBlob.objects.create(
+                digest=digest, name=self.image.name, size=size)
+            transaction.savepoint_commit(savepoint_id)
+        except IntegrityError:
+            # Another process stored the same data at the same time;
+            # use its file rather than our copy.
+            transaction.savepoint_rollback(savepoint_id)
+            storage.delete(self.image.name)
+            self._stored_name = None
+            blob = ImageBlob.objects.get(digest=digest)
+            self.image = blob.name
+        self._new_blob = blob
+
+    def pre_cache(self):
+        """
+        Create the renditions of all pre_cache PhotoSizes, decoding the
+        original image only once for all of them.
+        """
+        # Nothing to pre-cache until a deferred fetch has landed, and
+        # nothing to do here if the render processes will do it:
+        if not self.image or self.skip_pre_cache or RENDER_IN_BACKGROUND:
+            return
+        photosizes = [photosize
+                      for photosize in PhotoSizeCache().sizes.values()
+                      if photosize.pre_cache
+                      and not self.renditions_exist(photosize)]
+        if not photosizes:
+            return
+        timer = self._ingest_timer or NULL_TIMER
+        started = clock()
+        source_image = self.open_original(photosizes)
+        if source_image is None:
+            # Leave the renditions to be made on first use, rather
+            # than link to files that don't exist:
+            if self.renditions_cached:
+                self.renditions_cached = False
+                MetaImage.objects.filter(pk=self.pk).update(
+                    renditions_cached=False)
+            return
+        timer.add('decode', clock() - started)
+        started = clock()
+        for photosize in photosizes:
+            self.create_size(photosize, source_image)
+        timer.add('renditions', clock() - started)
+
+    def open_original(self, photosizes=()):
+        """
+        Decode the original image, for making its renditions for
+        photosizes; None if it can't be, or has more than
+        MAX_IMAGE_PIXELS pixels.  The header is read first, and a JPEG
+        is decoded at 1/2, 1/4 or 1/8 scale if that still has all the
+        pixels the renditions (and their variants) need, so that
+        making small renditions of a big photo takes time and memory
+        in proportion to the renditions, not the photo.
+        """
+        try:
+            source_image = Image.open(self.image.path)
+            if source_image.format == 'JPEG':
+                decode_size = self.get_decode_size(
+                    photosizes, source_image.size)
+                if decode_size is not None:
+                    source_image.draft(source_image.mode, decode_size)
+            if source_image.size[0] * source_image.size[1] > MAX_IMAGE_PIXELS:
+                return None
+            source_image.load()
+        except IOError:
+            return None
+        return source_image
+
+    def get_decode_size(self, photosizes, image_size):
+        """
+        The smallest (width, height) an image of image_size can be
+        scaled down to while still having every pixel needed for its
+        renditions for photosizes, including their higher density
+        variants; None if one of them needs the image at full size.
+        """
+        width, height = image_size
+        needed_width = needed_height = 0
+        for photosize in photosizes:
+            densities = [density for format, density, filename
+                         in self.get_rendition_variants(photosize)]
+            for density in set([1] + densities):
+                new_width, new_height = scale_photosize(
+                    photosize, density).size
+                if photosize.crop and new_width and new_height:
+                    # Scaled to cover the size, then cropped:
+                    ratio = max(float(new_width) / width,
+                                float(new_height) / height)
+                elif new_width and new_height:
+                    ratio = min(float(new_width) / width,
+                                float(new_height) / height)
+                elif new_width:
+                    ratio = float(new_width) / width
+                elif new_height:
+                    ratio = float(new_height) / height
+                else:
+                    return None
+                if ratio >= 1:
+                    return None
+                needed_width = max(needed_width, int(math.ceil(width * ratio)))
+                needed_height = max(needed_height,
+                                    int(math.ceil(height * ratio)))
+        if not needed_width:
+            return None
+        return needed_width, needed_height
+
+    def get_rendition_variants(self, photosize):
+        """
+        Returns the (format, density, filename) of each variant of this
+        image's photosize rendition that its RenditionPolicy asks for;
+        format None means the original's, and densities the image is
+        too small for are left out.
+        """
+        base, ext = os.path.splitext(
+            self._get_filename_for_size(photosize.name))
+        one_x_size = self.calculate_rendition_size(photosize)
+        variants = []
+        for format, density in get_policy(photosize).variants():
+            if format == self.image_format:
+                continue
+            if density > 1:
+                scaled_size = self.calculate_rendition_size(
+                    scale_photosize(photosize, density))
+                if one_x_size is None or scaled_size is None \
+                       or scaled_size[0] <= one_x_size[0]:
+                    continue
+                suffix = '@%sx' % density
+            else:
+                suffix = ''
+            if format is not None:
+                extension = '.' + FORMAT_EXTENSIONS[format]
+            else:
+                extension = ext
+            variants.append((format, density, base + suffix + extension))
+        return variants
+
+    def get_rendition_paths(self, photosize):
+        """
+        The paths of the files of this image's photosize rendition,
+        the plain one first and then its variants.
+        """
+        return [getattr(self, "get_%s_filename" % photosize.name)()] + [
+            os.path.join(self.cache_path(), filename)
+            for format, density, filename
+            in self.get_rendition_variants(photosize)]
+
+    def renditions_exist(self, photosize):
+        return all([os.path.isfile(path)
+                    for path in self.get_rendition_paths(photosize)])
+
+    def create_size(self, photosize, source_image=None):
+        """
+        As photologue's create_size(), but given an already decoded
+        source_image it works from a copy of that, rather than opening
+        the original again.  Also makes whichever variants of the
+        rendition its RenditionPolicy asks for are missing.
+        """
+        missing_variants = [
+            (format, density, filename)
+            for format, density, filename
+            in self.get_rendition_variants(photosize)
+            if not os.path.isfile(os.path.join(self.cache_path(), filename))]
+        if self.size_exists(photosize) and not missing_variants:
+            return
+        if source_image is None:
+            source_image = self.open_original([photosize])
+            if source_image is None:
+                return
+        if not os.path.isdir(self.cache_path()):
+            os.makedirs(self.cache_path())
+        # Save the original format
+        im_format = source_image.format == 'JPEG' and 'JPEG' or None
+        processed = {}
+        if not self.size_exists(photosize):
+            processed[1] = self.process_rendition(source_image, photosize)
+            self.save_rendition(
+                processed[1],
+                getattr(self, "get_%s_filename" % photosize.name)(),
+                im_format, photosize)
+        for format, density, filename in missing_variants:
+            if density not in processed:
+                processed[density] = self.process_rendition(
+                    source_image, scale_photosize(photosize, density))
+            self.save_rendition(
+                processed[density], os.path.join(self.cache_path(), filename),
+                format or im_format, photosize)
+
+    def process_rendition(self, source_image, photosize):
+        """
+        Returns source_image (left as it was) resized, cropped and with
+        effects applied, for photosize, as photologue does.
+        """
+        im = source_image.copy()
+        # Apply effect if found
+        if self.effect is not None:
+            im = self.effect.pre_process(im)
+        elif photosize.effect is not None:
+            im = photosize.effect.pre_process(im)
+        # Resize/crop image
+        if im.size != photosize.size and photosize.size != (0, 0):
+            rendition_size = None
+            if not photosize.crop and im.size != (self.width, self.height):
+                # Decoded at reduced scale (see open_original()):
+                # scaling from that size can round to a pixel off the
+                # size the full image gives, and get_rendition_size()
+                # reports.
+                rendition_size = self.calculate_rendition_size(photosize)
+            if rendition_size is not None:
+                im = im.resize(rendition_size, Image.ANTIALIAS)
+            else:
+                im = self.resize_image(im, photosize)
+        # Apply watermark if found
+        if photosize.watermark is not None:
+            im = photosize.watermark.post_process(im)
+        # Apply effect if found
+        if self.effect is not None:
+            im = self.effect.post_process(im)
+        elif photosize.effect is not None:
+            im = photosize.effect.post_process(im)
+        return im
+
+    def save_rendition(self, im, im_filename, im_format, photosize):
+        """
+        Save a rendition in im_format; for None, in the format its
+        filename suggests, or as a JPEG if PIL can't write that.
+        """
+        policy = get_policy(photosize)
+        try:
+            if im_format != 'JPEG':
+                try:
+                    if im_format is None:
+                        im.save(im_filename)
+                    else:
+                        save_image(im, im_filename, im_format,
+                                   policy.get_quality(im_format, photosize))
+                    return
+                except KeyError:
+                    pass
+            save_image(im, im_filename, 'JPEG',
+                       policy.get_quality('JPEG', photosize),
+                       policy.progressive)
+        except IOError, e:
+            if os.path.isfile(im_filename):
+                os.unlink(im_filename)
+            raise e
+
+    def remove_size(self, photosize, *args, **kwargs):
+        for path in self.get_rendition_paths(photosize)[1:]:
+            if os.path.isfile(path):
+                os.unlink(path)
+        super(MetaImage, self).remove_size(photosize, *args, **kwargs)
+
+    def clear_cache(self):
+        if not self.image:
+            return
+        # Renditions of a blob shared with other MetaImages stay put:
+        if self.blob_id and ImageBlob.objects.filter(
+                pk=self.blob_id, ref_count__gt=1).exists():
+            return
+        super(MetaImage, self).clear_cache()
 
     def generate_filename_from_url(self, the_url=None):
         """
@@ -225,8 +1310,9 @@ class MetaImage(ImageModel, BaseModel):
         return the_filename
 
     def generate_filename_from_data(self, the_data):
-        # Assume only PNG files for now:
-        return '%s.png' % hash(the_data)
+        # Assume only PNG files for now.  Unlike hash(), the digest is
+        # the same in every process:
+        return '%s.png' % hashlib.sha256(the_data).hexdigest()
 
     def get_public_status(self):
         """
@@ -236,17 +1322,157 @@ class MetaImage(ImageModel, BaseModel):
 
     is_public = property(get_public_status)
 
-    def render(self, the_size='width500', linked=False):
+    @property
+    def is_ready(self):
+        return self.ingest_status == INGEST_READY
+
+    @property
+    def is_pending(self):
+        return self.ingest_status == INGEST_PENDING
+
+    @property
+    def is_failed(self):
+        return self.ingest_status == INGEST_FAILED
+
+    def render_placeholder(self, the_size='width500'):
+        """
+        Returns the HTML shown in place of an image whose source_url
+        has not been fetched (yet, or ever, if fetching failed).
+        """
+        css_class = 'metaimage-%s' % (
+            self.is_failed and 'failed' or 'pending')
+        if not PENDING_PLACEHOLDER_URL:
+            return mark_safe(
+                '<span class="%s">%s</span>' % (css_class, str(self.title)))
+        attrs = ''
+        photosize = PhotoSizeCache().sizes.get(the_size)
+        if photosize is not None:
+            the_width, the_height = photosize.size
+            if the_height:
+                attrs += ' height="%s"' % the_height
+            if the_width:
+                attrs += ' width="%s"' % the_width
+        return mark_safe(
+            '<img src="%s" class="%s"%s alt="%s">'
+            % (PENDING_PLACEHOLDER_URL, css_class, attrs, str(self.title)))
+
+    def calculate_rendition_size(self, photosize):
+        """
+        Returns the (width, height) of this image's rendition for
+        photosize, worked out from the stored image dimensions just as
+        photologue's resize_image() would, without opening any file.
+        Returns None if the dimensions were never recorded.
+        """
+        if not self.width or not self.height:
+            return None
+        cur_width, cur_height = self.width, self.height
+        new_width, new_height = photosize.size
+        if (cur_width, cur_height) == (new_width, new_height) \
+               or (new_width, new_height) == (0, 0):
+            return cur_width, cur_height
+        if photosize.crop:
+            return new_width, new_height
+        if new_width and new_height:
+            ratio = min(float(new_width) / cur_width,
+                        float(new_height) / cur_height)
+        elif new_width == 0:
+            ratio = float(new_height) / cur_height
+        else:
+            ratio = float(new_width) / cur_width
+        new_dimensions = (int(round(cur_width * ratio)),
+                          int(round(cur_height * ratio)))
+        if (new_dimensions[0] > cur_width or new_dimensions[1] > cur_height) \
+               and not photosize.upscale:
+            return cur_width, cur_height
+        return new_dimensions
+
+    def get_rendition_size(self, the_size):
+        photosize = PhotoSizeCache().sizes.get(the_size)
+        if photosize is not None:
+            rendition_size = self.calculate_rendition_size(photosize)
+            if rendition_size is not None:
+                return rendition_size
+        # Fall back to photologue, which opens the rendition file:
+        return getattr(self, 'get_%s_size' % the_size)()
+
+    def get_rendition_url(self, the_size):
+        photosize = PhotoSizeCache().sizes.get(the_size)
+        if photosize is not None and photosize.pre_cache \
+               and self.renditions_cached:
+            # The rendition was made when the image was saved, so
+            # there's no need to check for the file:
+            if photosize.increment_count:
+                self.increment_count()
+            return '/'.join([self.cache_url(),
+                             self._get_filename_for_size(photosize.name)])
+        # Otherwise photologue checks, and creates it if need be:
+        return getattr(self, 'get_%s_url' % the_size)()
+
+    def increment_count(self):
         """
-        Returns the HTML to display this MetaImage instance.
+        As photologue's, but as an UPDATE of view_count alone: a view
+        isn't a change to the image, and saving it as one would change
+        its updated time, and so the keys of its cached fragments and
+        pages, on every view.
         """
-        get_url_method_name = 'get_%s_url' % the_size
-        mimage_url = getattr(self, get_url_method_name)()
-        get_size_method_name = 'get_%s_size' % the_size
-        the_width, the_height = getattr(self, get_size_method_name)()
-        img_html = mark_safe(
-            '<img src="%s" height="%s" width="%s" alt="%s">'
-            % (mimage_url, the_height, the_width, str(self.title)))
+        self.view_count += 1
+        if self.pk:
+            MetaImage.objects.filter(pk=self.pk).update(
+                view_count=models.F('view_count') + 1)
+
+    def get_rendition_sources(self, the_size, url):
+        """
+        For the_size rendition at url, returns a list of (MIME type,
+        srcset) for the other formats it comes in, and the srcset of
+        its other pixel densities (or None), as its RenditionPolicy
+        has them made.
+        """
+        photosize = PhotoSizeCache().sizes.get(the_size)
+        if photosize is None:
+            return [], None
+        variants = self.get_rendition_variants(photosize)
+        if not variants:
+            return [], None
+        if not (photosize.pre_cache and self.renditions_cached):
+            # Make any that are missing:
+            self.create_size(photosize)
+        base_url = url.rsplit('/', 1)[0]
+        srcsets = {None: ['%s 1x' % url]}
+        formats = []
+        for format, density, filename in variants:
+            if format not in srcsets:
+                srcsets[format] = []
+                formats.append(format)
+            srcsets[format].append('%s/%s %sx' % (base_url, filename, density))
+        sources = [(FORMAT_MIME_TYPES[format], ', '.join(srcsets[format]))
+                   for format in formats]
+        srcset = None
+        if len(srcsets[None]) > 1:
+            srcset = ', '.join(srcsets[None])
+        return sources, srcset
+
+    def render(self, the_size='width500', linked=False, rendition=None):
+        """
+        Returns the HTML to display this MetaImage instance.  rendition
+        is the (url, width, height) to show, if it has already been
+        looked up, e.g. by renditions.render_metaimages().
+        """
+        if self.image:
+            if rendition is None:
+                rendition = get_rendition(self, the_size)
+            mimage_url, the_width, the_height = rendition
+            sources, srcset = self.get_rendition_sources(the_size, mimage_url)
+            img_html = mark_safe(
+                '<img src="%s"%s height="%s" width="%s" alt="%s">'
+                % (mimage_url, srcset and ' srcset="%s"' % srcset or '',
+                   the_height, the_width, str(self.title)))
+            if sources:
+                img_html = mark_safe('<picture>%s%s</picture>' % (
+                    ''.join(['<source type="%s" srcset="%s">' % source
+                             for source in sources]),
+                    img_html))
+        else:
+            img_html = self.render_placeholder(the_size)
         if linked:
             return mark_safe(
                 '<a href="%s" class="invisible">%s</a>'
@@ -259,3 +1485,145 @@ class MetaImage(ImageModel, BaseModel):
 
     def render_thumbnail_linked(self):
         return self.render_linked(the_size='square25')
+
+
+# Keep the rendition manifest cache (see renditions.py) up to date:
+models.signals.post_save.connect(invalidate_renditions, sender=MetaImage)
+models.signals.post_delete.connect(invalidate_renditions, sender=MetaImage)
+models.signals.post_save.connect(photosize_saved, sender=PhotoSize)
+# Changing an image's tags updates it, for the fragment cache (see
+# fragments.py):
+models.signals.post_save.connect(touch_tagged_metaimage, sender=TaggedItem)
+models.signals.post_delete.connect(touch_tagged_metaimage, sender=TaggedItem)
+
+
+INGEST_JOB_QUEUED = 1
+INGEST_JOB_RUNNING = 2
+INGEST_JOB_DONE = 3
+INGEST_JOB_FAILED = 4
+INGEST_JOB_STATUS_CHOICES = (
+    (INGEST_JOB_QUEUED, _('Queued')),
+    (INGEST_JOB_RUNNING, _('Running')),
+    (INGEST_JOB_DONE, _('Done')),
+    (INGEST_JOB_FAILED, _('Failed')),
+    )
+
+
+class IngestJobManager(models.Manager):
+
+    def enqueue(self, metaimage):
+        """
+        Queue a fetch of metaimage's source_url, unless one is already
+        queued or running.
+        """
+        outstanding = self.filter(
+            metaimage=metaimage,
+            status__in=(INGEST_JOB_QUEUED, INGEST_JOB_RUNNING))
+        if outstanding.exists():
+            return None
+        return self.create(metaimage=metaimage)
+
+    def claim(self, worker_name, batch_size=10):
+        """
+        Take the oldest queued job for worker_name that's due, or
+        return None if there are none.  The status check in the UPDATE
+        means that only one worker - thread or process - can win a
+        given job.
+        """
+        queued_ids = self.filter(status=INGEST_JOB_QUEUED).filter(
+            models.Q(not_before=None)
+            | models.Q(not_before__lte=datetime.now())).order_by(
+            'id').values_list('id', flat=True)[:batch_size]
+        for job_id in queued_ids:
+            claimed = self.filter(pk=job_id, status=INGEST_JOB_QUEUED).update(
+                status=INGEST_JOB_RUNNING,
+                claimed=datetime.now(),
+                worker=worker_name[:100],
+                attempts=models.F('attempts') + 1)
+            if claimed:
+                return self.get(pk=job_id)
+        return None
+
+    def requeue_stale(self, max_age):
+        """
+        Put jobs back on the queue whose worker has been running them
+        for longer than max_age (a timedelta), i.e. whose worker most
+        likely died.
+        """
+        return self.filter(
+            status=INGEST_JOB_RUNNING,
+            claimed__lt=datetime.now() - max_age).update(
+            status=INGEST_JOB_QUEUED)
+
+
+class IngestJob(models.Model):
+    """
+    A queued download of a MetaImage's source_url.  The database
+    table is the queue, so no outside message broker is needed; see
+    ingest.py for the workers.
+    """
+    metaimage = models.ForeignKey(MetaImage, related_name='ingest_jobs')
+    status = models.IntegerField(
+        _('status'),
+        choices=INGEST_JOB_STATUS_CHOICES, default=INGEST_JOB_QUEUED,
+        db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    claimed = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    # A requeued job isn't claimed again until then:
+    not_before = models.DateTimeField(blank=True, null=True)
+    worker = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+
+    objects = IngestJobManager()
+
+    class Meta:
+        verbose_name = 'ingest job'
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.metaimage, self.get_status_display())
+
+
+INGEST_SOURCE_CHOICES = (
+    ('url', _('Source URL')),
+    ('data', _('Image data')),
+    ('upload', _('Upload')),
+    )
+
+
+class IngestRecord(models.Model):
+    """
+    The phase by phase timings of an ingest that was slow, kept with
+    METAIMAGE_INGEST_TIMING on; see instrumentation.py.
+    """
+    metaimage = models.ForeignKey(
+        MetaImage, blank=True, null=True, related_name='ingest_records')
+    source = models.CharField(max_length=10, choices=INGEST_SOURCE_CHOICES)
+    source_url = models.CharField(max_length=500, blank=True)
+    created = models.DateTimeField(
+        auto_now_add=True, editable=False, db_index=True)
+    total_seconds = models.FloatField()
+    file_size = models.PositiveIntegerField(blank=True, null=True)
+    # JSON list of [name, seconds, bytes, count] of each phase:
+    phases = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name = 'ingest record'
+        ordering = ('-created',)
+
+    def __unicode__(self):
+        return u'%s (%.2fs)' % (self.metaimage or self.source_url,
+                                self.total_seconds)
+
+    def get_phases(self):
+        return [tuple(phase)
+                for phase in simplejson.loads(self.phases or '[]')]
+
+    def slowest_phase(self):
+        phases = self.get_phases()
+        if not phases:
+            return ''
+        name, seconds = max(phases, key=lambda phase: phase[1])[:2]
+        return u'%s (%.2fs)' % (name, seconds)
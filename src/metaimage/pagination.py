@@ -0,0 +1,95 @@
+"""
+Keyset pagination of MetaImage feeds, newest first.
+
+Rather than an offset and a page number, each page is identified by a
+cursor, the (created, id) of the last image on the page before it, so
+fetching any page is one indexed range query - no COUNT(*), and no
+scanning past the rows of earlier pages.
+"""
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+
+FEED_PAGE_SIZE = getattr(settings, 'METAIMAGE_FEED_PAGE_SIZE', 30)
+CURSOR_DATETIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(metaimage):
+    return '%s.%s' % (
+        metaimage.created.strftime(CURSOR_DATETIME_FORMAT), metaimage.pk)
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (created, id) in cursor, or raises InvalidCursor.
+    """
+    try:
+        created, pk = cursor.split('.')
+        return datetime.strptime(created, CURSOR_DATETIME_FORMAT), int(pk)
+    except ValueError:
+        raise InvalidCursor('Invalid cursor %r' % cursor)
+
+
+class KeysetPage(object):
+    """
+    One page of a feed: object_list, plus next_cursor to pass for the
+    page after it, None if this is the last.
+    """
+
+    def __init__(self, object_list, cursor=None, next_cursor=None):
+        self.object_list = object_list
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def is_first(self):
+        return not self.cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def _after_cursor(queryset, cursor):
+    queryset = queryset.order_by('-created', '-id')
+    if cursor:
+        created, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(created__lt=created) | Q(created=created, id__lt=pk))
+    return queryset
+
+
+def keyset_page_versions(queryset, cursor=None, per_page=FEED_PAGE_SIZE):
+    """
+    Returns the (id, created, updated) of the rows that keyset_page()
+    would, plus the first of the next page if any: a cheaper query,
+    for telling whether the page has changed.
+    """
+    return list(_after_cursor(queryset, cursor).values_list(
+        'id', 'created', 'updated')[:per_page + 1])
+
+
+def keyset_page(queryset, cursor=None, per_page=FEED_PAGE_SIZE):
+    """
+    Returns the KeysetPage of queryset, ordered newest first, that
+    follows cursor (or the first page, for no cursor).
+    """
+    # One more than a page, to tell whether there's another after it:
+    object_list = list(_after_cursor(queryset, cursor)[:per_page + 1])
+    next_cursor = None
+    if len(object_list) > per_page:
+        object_list = object_list[:per_page]
+        next_cursor = encode_cursor(object_list[-1])
+    return KeysetPage(object_list, cursor, next_cursor)
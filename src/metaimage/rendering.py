@@ -0,0 +1,269 @@
+"""
+Making MetaImage renditions ahead of time, in a pool of processes.
+
+By default MetaImage.save() makes the renditions for every pre_cache
+PhotoSize there and then, in the saving process.  render_renditions()
+instead makes whatever renditions are missing or older than their
+original, for many images at once, across a process pool; "manage.py
+metaimage_render" wraps it, e.g. to backfill the renditions of a newly
+added PhotoSize:
+
+    manage.py metaimage_render --size=thumbnail
+
+With METAIMAGE_RENDER_IN_BACKGROUND set, saving a MetaImage skips the
+in-process pre-caching, leaving renditions_cached unset, and
+render_pending() ("manage.py metaimage_render --watch") makes the
+renditions of such images from a separate process.  The MetaImage
+table is the queue, so nothing is lost while no render process is
+running, and no process is forked from the one serving requests.
+
+Nothing here imports metaimage.models at module level, as models.py
+connects the signal handlers below.
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from photologue.models import PhotoSizeCache
+
+
+RENDER_WORKERS = getattr(
+    settings, 'METAIMAGE_RENDER_WORKERS', multiprocessing.cpu_count())
+RENDER_BATCH_SIZE = getattr(settings, 'METAIMAGE_RENDER_BATCH_SIZE', 500)
+RENDER_IN_BACKGROUND = getattr(
+    settings, 'METAIMAGE_RENDER_IN_BACKGROUND', False)
+RENDER_POLL_INTERVAL = getattr(
+    settings, 'METAIMAGE_RENDER_POLL_INTERVAL', 5.0)  # seconds
+
+logger = logging.getLogger('metaimage.rendering')
+
+
+def get_photosizes(size_names=None):
+    """
+    The PhotoSizes named in size_names, or by default all those with
+    pre_cache set.
+    """
+    sizes = PhotoSizeCache().sizes
+    if size_names is None:
+        return [photosize for photosize in sizes.values()
+                if photosize.pre_cache]
+    return [sizes[name] for name in size_names]
+
+
+def stale_photosizes(metaimage, photosizes):
+    """
+    Those of photosizes for which metaimage's rendition, or any of its
+    variants, is missing or older than its original image file.
+    """
+    try:
+        original_mtime = os.path.getmtime(metaimage.image.path)
+    except OSError:
+        return []
+    stale = []
+    for photosize in photosizes:
+        for path in metaimage.get_rendition_paths(photosize):
+            try:
+                if os.path.getmtime(path) >= original_mtime:
+                    continue
+            except OSError:
+                pass
+            stale.append(photosize)
+            break
+    return stale
+
+
+def render_metaimage(metaimage, size_names=None):
+    """
+    Make metaimage's missing or out of date renditions at the sizes
+    named (by default, all pre_cache PhotoSizes), decoding its original
+    only once.  Returns a dict of size name -> seconds spent, with the
+    decoding under "decode".
+    """
+    from metaimage.models import MetaImage
+    timings = {}
+    stale = stale_photosizes(metaimage, get_photosizes(size_names))
+    if stale:
+        started = time.time()
+        source_image = metaimage.open_original(stale)
+        if source_image is None:
+            raise IOError('Cannot decode %s' % metaimage.image.name)
+        timings['decode'] = time.time() - started
+        for photosize in stale:
+            started = time.time()
+            for path in metaimage.get_rendition_paths(photosize):
+                if os.path.isfile(path):
+                    os.unlink(path)
+            metaimage.create_size(photosize, source_image)
+            timings[photosize.name] = time.time() - started
+    if not metaimage.renditions_cached \
+           and not stale_photosizes(metaimage, get_photosizes()):
+        # Every pre_cache rendition is now in place, so rendering can
+        # skip checking for them:
+        MetaImage.objects.filter(pk=metaimage.pk).update(
+            renditions_cached=True)
+        metaimage.renditions_cached = True
+    return timings
+
+
+def _init_worker():
+    # Each process needs its own database connection; drop, rather
+    # than close, the one inherited from the parent, which is still
+    # using it.
+    connection.connection = None
+
+
+def _render_task(args):
+    pk, size_names = args
+    from metaimage.models import MetaImage
+    try:
+        return pk, render_metaimage(MetaImage.objects.get(pk=pk),
+                                    size_names), None
+    except Exception, e:
+        logger.warning('Rendering MetaImage %s failed: %r', pk, e)
+        return pk, {}, repr(e)
+
+
+class RenderReport(object):
+    """
+    Counts, per PhotoSize, of the renditions made and the time they
+    took, for the rate of each.
+    """
+
+    def __init__(self):
+        self.images = 0
+        self.failures = []
+        self.counts = {}
+        self.seconds = {}
+        self.started = time.time()
+
+    def add(self, pk, timings, error=None):
+        self.images += 1
+        if error is not None:
+            self.failures.append((pk, error))
+        for name, seconds in timings.items():
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    def rate(self, size_name):
+        """
+        Images per second of one render process making size_name.
+        """
+        return self.counts.get(size_name, 0) / max(
+            self.seconds.get(size_name, 0.0), 0.001)
+
+    def __unicode__(self):
+        lines = [u'%s images checked, %s failed; %.1fs, %.1f images/s' % (
+            self.images, len(self.failures), self.elapsed,
+            self.images / max(self.elapsed, 0.001))]
+        for name in sorted(self.counts):
+            lines.append(u'  %s: %s made, %.1f images/s per process' % (
+                name, self.counts[name], self.rate(name)))
+        return u'\n'.join(lines)
+
+
+def render_renditions(queryset=None, size_names=None,
+                      processes=RENDER_WORKERS, batch_size=RENDER_BATCH_SIZE,
+                      progress=None):
+    """
+    Make the missing or out of date renditions of the MetaImages in
+    queryset (by default, all of them) at the sizes named (by default,
+    all pre_cache PhotoSizes), in processes worker processes (or in
+    this one, for processes=1).  Images are worked through batch_size
+    at a time, in primary key order, so an interrupted run loses
+    little; progress, if given, is called with the RenderReport after
+    every batch.  Returns the RenderReport.
+    """
+    from metaimage.ingest import iter_pks
+    from metaimage.models import MetaImage, INGEST_READY
+    if queryset is None:
+        queryset = MetaImage.objects.all()
+    queryset = queryset.filter(ingest_status=INGEST_READY).exclude(image='')
+    report = RenderReport()
+    pool = None
+    try:
+        pks = iter_pks(queryset, batch_size)
+        while True:
+            tasks = [(pk, size_names)
+                     for pk in itertools.islice(pks, batch_size)]
+            if not tasks:
+                break
+            # Only started once there's something to render:
+            if pool is None and processes > 1:
+                pool = multiprocessing.Pool(
+                    processes, initializer=_init_worker)
+            if pool is None:
+                results = itertools.imap(_render_task, tasks)
+            else:
+                results = pool.imap_unordered(
+                    _render_task, tasks,
+                    max(1, len(tasks) // (processes * 4)))
+            for pk, timings, error in results:
+                report.add(pk, timings, error)
+            if progress is not None:
+                progress(report)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return report
+
+
+def render_pending(processes=RENDER_WORKERS, batch_size=RENDER_BATCH_SIZE,
+                   poll_interval=None, progress=None):
+    """
+    Make the pre_cache renditions of the MetaImages that don't have
+    them all (renditions_cached unset): those saved with
+    METAIMAGE_RENDER_IN_BACKGROUND or skip_pre_cache, and every image
+    after a pre_cache PhotoSize is added or changed.  Until then their
+    renditions are made on first use.
+
+    With poll_interval None, this looks for them once and returns the
+    RenderReport.  Otherwise it looks again every poll_interval
+    seconds until interrupted, leaving images that failed out of the
+    later passes.
+    """
+    from metaimage.models import MetaImage
+    failed = set()
+    while True:
+        queryset = MetaImage.objects.filter(renditions_cached=False)
+        if failed:
+            queryset = queryset.exclude(pk__in=failed)
+        report = render_renditions(queryset, processes=processes,
+                                   batch_size=batch_size, progress=progress)
+        if poll_interval is None:
+            return report
+        failed.update([pk for pk, error in report.failures])
+        time.sleep(poll_interval)
+
+
+def photosize_saved(sender, instance, **kwargs):
+    """
+    post_save handler for PhotoSize, connected in models.py.  The
+    cached fragments and rendition manifest entries made with the old
+    sizes are left unused, in every process.  A new or changed
+    pre_cache PhotoSize's renditions may not be there yet, so
+    renditions have to be checked for until the backfill has run.
+    """
+    from metaimage.fragments import sizes_version
+    from metaimage.ingest import iter_pks
+    from metaimage.models import MetaImage
+    sizes_version.bump()
+    if instance.pre_cache:
+        # A batch at a time, rather than in one UPDATE of every row:
+        pks = iter_pks(MetaImage.objects.filter(renditions_cached=True),
+                       RENDER_BATCH_SIZE)
+        while True:
+            batch = list(itertools.islice(pks, RENDER_BATCH_SIZE))
+            if not batch:
+                break
+            MetaImage.objects.filter(pk__in=batch).update(
+                renditions_cached=False)
@@ -0,0 +1,249 @@
+"""
+Resolving the renditions of MetaImages - the URL, width and height of
+an image at a given PhotoSize - for many images at once, as a gallery
+page needs.
+
+Resolved renditions are kept in a manifest cache: an in-process LRU,
+plus optionally a Django cache backend shared between processes, set
+with METAIMAGE_RENDITION_CACHE_BACKEND (a backend URI such as
+"memcached://127.0.0.1:11211/", or "default" for the site's cache).
+Entries are keyed by MetaImage id and checked against the image's
+file name and updated time, and the version of the PhotoSizes (see
+fragments.py), and are dropped when a MetaImage is saved or deleted.
+"""
+from collections import deque
+import threading
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from photologue.models import PhotoSizeCache
+
+from metaimage.fragments import get_fragments, set_fragments, \
+     sizes_version
+
+
+RENDITION_CACHE_SIZE = getattr(settings, 'METAIMAGE_RENDITION_CACHE_SIZE', 10000)
+RENDITION_CACHE_BACKEND = getattr(
+    settings, 'METAIMAGE_RENDITION_CACHE_BACKEND', None)
+RENDITION_CACHE_TIMEOUT = getattr(
+    settings, 'METAIMAGE_RENDITION_CACHE_TIMEOUT', 86400)  # seconds
+
+
+class LRUCache(object):
+    """
+    A thread-safe dict holding at most max_size items, dropping the
+    least recently used ones first.
+
+    Each use of a key appends it to a queue, oldest use first, and
+    counts it; a key is dropped when the last of its uses reaches the
+    front.  The queue is compacted to one use per key when it grows to
+    twice the size of the dict.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = {}
+        self._order = deque()
+        self._uses = {}
+        self._lock = threading.Lock()
+
+    def _use(self, key):
+        self._order.append(key)
+        self._uses[key] = self._uses.get(key, 0) + 1
+        if len(self._order) > 2 * max(len(self._items), 16):
+            seen = set()
+            order = deque()
+            for used in reversed(self._order):
+                if used in self._items and used not in seen:
+                    seen.add(used)
+                    order.appendleft(used)
+            self._order = order
+            self._uses = dict.fromkeys(order, 1)
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            if key not in self._items:
+                return default
+            self._use(key)
+            return self._items[key]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._items[key] = value
+            self._use(key)
+            while len(self._items) > self.max_size:
+                oldest = self._order.popleft()
+                self._uses[oldest] -= 1
+                if not self._uses[oldest]:
+                    del self._uses[oldest]
+                    self._items.pop(oldest, None)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            # Its uses stay queued, and are dropped as they come up.
+            self._items.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._items.clear()
+            self._order.clear()
+            self._uses.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class RenditionManifest(object):
+    """
+    For each MetaImage, a dict of size name -> (url, width, height),
+    cached in-process and, if backend (a Django cache) is given, in
+    that too.
+    """
+
+    def __init__(self, max_size=RENDITION_CACHE_SIZE, backend=None,
+                 timeout=RENDITION_CACHE_TIMEOUT):
+        self.local = LRUCache(max_size)
+        self.backend = backend
+        self.timeout = timeout
+
+    def _key(self, pk):
+        return 'metaimage.renditions.%s' % pk
+
+    def _version(self, metaimage):
+        return u'%s|%s|%s' % (metaimage.image.name, metaimage.updated,
+                              sizes_version.get())
+
+    def resolve(self, metaimages, the_size):
+        """
+        Returns a list of (url, width, height), one per MetaImage in
+        metaimages, or None for those that have no image file yet.
+        """
+        metaimages = [metaimage for metaimage in metaimages]
+        entries = {}
+        for metaimage in metaimages:
+            if not metaimage.pk or not metaimage.image:
+                continue
+            entry = self.local.get(metaimage.pk)
+            if entry is not None and entry['version'] == self._version(metaimage):
+                entries[metaimage.pk] = entry
+        if self.backend is not None:
+            wanted = dict([(self._key(metaimage.pk), metaimage)
+                           for metaimage in metaimages
+                           if metaimage.pk and metaimage.image
+                           and metaimage.pk not in entries])
+            if wanted:
+                for key, entry in self.backend.get_many(wanted.keys()).items():
+                    metaimage = wanted[key]
+                    if entry['version'] == self._version(metaimage):
+                        entries[metaimage.pk] = entry
+                        self.local.set(metaimage.pk, entry)
+        photosize = PhotoSizeCache().sizes.get(the_size)
+        changed = {}
+        viewed = []
+        renditions = []
+        for metaimage in metaimages:
+            if not metaimage.image:
+                renditions.append(None)
+                continue
+            entry = entries.get(metaimage.pk)
+            if entry is not None and the_size in entry['sizes']:
+                if photosize is not None and photosize.increment_count:
+                    # As photologue does whenever the URL is asked for:
+                    viewed.append(metaimage)
+                renditions.append(entry['sizes'][the_size])
+                continue
+            rendition = (metaimage.get_rendition_url(the_size),) \
+                        + tuple(metaimage.get_rendition_size(the_size))
+            renditions.append(rendition)
+            if not metaimage.pk:
+                continue
+            if entry is None:
+                entry = {'version': self._version(metaimage), 'sizes': {}}
+                entries[metaimage.pk] = entry
+            entry['sizes'][the_size] = rendition
+            changed[metaimage.pk] = entry
+        if viewed:
+            from metaimage.models import MetaImage
+            MetaImage.objects.count_views(viewed)
+        for pk, entry in changed.items():
+            self.local.set(pk, entry)
+        if self.backend is not None and changed:
+            self.backend.set_many(
+                dict([(self._key(pk), entry) for pk, entry in changed.items()]),
+                self.timeout)
+        return renditions
+
+    def invalidate(self, pk):
+        self.local.delete(pk)
+        if self.backend is not None:
+            self.backend.delete(self._key(pk))
+
+
+def _get_backend():
+    if not RENDITION_CACHE_BACKEND:
+        return None
+    if RENDITION_CACHE_BACKEND == 'default':
+        from django.core.cache import cache
+        return cache
+    return get_cache(RENDITION_CACHE_BACKEND)
+
+
+manifest = RenditionManifest(backend=_get_backend())
+
+
+def resolve_renditions(metaimages, the_size):
+    """
+    Returns a list of (url, width, height) for the_size rendition of
+    each of metaimages (None for any without an image file), resolved
+    in one pass through the manifest cache.
+    """
+    return manifest.resolve(metaimages, the_size)
+
+
+def get_rendition(metaimage, the_size):
+    return manifest.resolve([metaimage], the_size)[0]
+
+
+def render_metaimages(metaimages, the_size, linked=False):
+    """
+    Returns a list of (metaimage, html) pairs, the html as from
+    metaimage.render(the_size, linked), from the fragment cache where
+    it can be.
+    """
+    metaimages = list(metaimages)
+    fragments = get_fragments(metaimages, 'render', the_size, (linked,))
+    missing = [metaimage for metaimage in metaimages
+               if metaimage.pk not in fragments]
+    renditions = resolve_renditions(missing, the_size)
+    rendered = [(metaimage, metaimage.render(the_size, linked, rendition))
+                for metaimage, rendition in zip(missing, renditions)]
+    # Images still pending have only placeholders to show:
+    set_fragments([(metaimage, html) for metaimage, html in rendered
+                   if metaimage.image],
+                  'render', the_size, (linked,))
+    rendered = iter(rendered)
+    return [metaimage.pk in fragments
+            and (metaimage, fragments[metaimage.pk]) or rendered.next()
+            for metaimage in metaimages]
+
+
+def invalidate_renditions(sender, instance, **kwargs):
+    """
+    post_save/post_delete handler for MetaImage, connected in
+    models.py.
+    """
+    if instance.pk:
+        manifest.invalidate(instance.pk)
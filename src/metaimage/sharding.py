@@ -0,0 +1,206 @@
+"""
+A sharded storage layout: with METAIMAGE_SHARD_DEPTH set, each image
+file is stored METAIMAGE_SHARD_DEPTH directories down from where
+photologue would put it, in directories named after successive
+METAIMAGE_SHARD_WIDTH hex digits of the MD5 digest of its filename,
+e.g. with a depth of 2:
+
+    photologue/photos/3f/a2/example.com_logo.png
+
+rather than photologue/photos/example.com_logo.png, so no directory
+ends up with more than a few thousand files in it.  Renditions are
+kept in a cache/ directory beside their original, so they are sharded
+along with it.
+
+Changing the layout only changes where new images are stored;
+relocate_images() moves the existing ones, in batches, while the site
+keeps running - see "manage.py metaimage_shard".  A MetaImage loaded
+before its file was moved, and saved after, has MetaImage.save() put
+its image where the file is now, rather than back where it was.
+
+Nothing here imports metaimage.models at module level, as models.py
+uses shard_filename().
+"""
+from datetime import datetime
+import errno
+import logging
+import os
+import posixpath
+import shutil
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.hashcompat import md5_constructor
+
+
+SHARD_DEPTH = getattr(settings, 'METAIMAGE_SHARD_DEPTH', 0)
+SHARD_WIDTH = getattr(settings, 'METAIMAGE_SHARD_WIDTH', 2)
+RELOCATE_BATCH_SIZE = getattr(settings, 'METAIMAGE_RELOCATE_BATCH_SIZE', 500)
+
+logger = logging.getLogger('metaimage.sharding')
+
+
+def shard_dirs(filename, depth=SHARD_DEPTH, width=SHARD_WIDTH):
+    """The shard directories of filename (a name without directories),
+    outermost first."""
+    digest = md5_constructor(filename.encode('utf-8')).hexdigest()
+    return [digest[level * width:(level + 1) * width]
+            for level in range(depth)]
+
+
+def shard_filename(filename, depth=None, width=None):
+    """
+    filename, a name without directories, with its shard directories
+    in front, for passing to the image field's save(); photologue's
+    upload_to puts the lot under its photos directory.  The depth and
+    width default to the current layout's.
+    """
+    if depth is None:
+        depth = SHARD_DEPTH
+    if width is None:
+        width = SHARD_WIDTH
+    return posixpath.join(*shard_dirs(filename, depth, width) + [filename])
+
+
+def shard_name(name, depth=None, width=None):
+    """
+    Where the stored file name belongs in the layout of depth and
+    width (by default, the current layout): its shard directories, if
+    it is in any, are replaced with those of the layout.
+    """
+    if depth is None:
+        depth = SHARD_DEPTH
+    if width is None:
+        width = SHARD_WIDTH
+    directory, filename = posixpath.split(name)
+    parts = directory and directory.split('/') or []
+    # Strip the shard directories of the current layout, or of a
+    # shallower or deeper one of the same width:
+    digest = md5_constructor(filename.encode('utf-8')).hexdigest()
+    for level in range(len(parts), 0, -1):
+        if parts[-level:] == [digest[i * width:(i + 1) * width]
+                              for i in range(level)]:
+            parts = parts[:-level]
+            break
+    return posixpath.join(
+        *parts + shard_dirs(filename, depth, width) + [filename])
+
+
+def _link(old_path, new_path):
+    """
+    Make the file at old_path available at new_path too: hard linked
+    if it can be, so the two are the same file, otherwise copied.
+    """
+    new_dir = os.path.dirname(new_path)
+    if not os.path.isdir(new_dir):
+        try:
+            os.makedirs(new_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    if os.path.exists(new_path):
+        if os.path.getsize(new_path) == os.path.getsize(old_path):
+            # Left by an earlier, interrupted run.
+            return
+        os.unlink(new_path)
+    try:
+        os.link(old_path, new_path)
+    except (OSError, AttributeError):
+        # On another filesystem, or no hard links here:
+        shutil.copy2(old_path, new_path)
+
+
+def _file_pairs(metaimage, new_name, photosizes):
+    """
+    (old path, new path) of metaimage's original, and of each of its
+    renditions there is, for moving its image to new_name.
+    """
+    old_paths = [metaimage.image.path]
+    for photosize in photosizes:
+        old_paths.extend(metaimage.get_rendition_paths(photosize))
+    old_name = metaimage.image.name
+    metaimage.image = new_name
+    try:
+        new_paths = [metaimage.image.path]
+        for photosize in photosizes:
+            new_paths.extend(metaimage.get_rendition_paths(photosize))
+    finally:
+        metaimage.image = old_name
+    return [(old_path, new_path)
+            for old_path, new_path in zip(old_paths, new_paths)
+            if os.path.isfile(old_path)]
+
+
+def _switch(old_name, new_name):
+    from metaimage.models import ImageBlob, MetaImage
+    # updated moves on too, which re-keys the cached fragments and
+    # renditions of the MetaImages:
+    MetaImage.objects.filter(image=old_name).update(
+        image=new_name, updated=datetime.now())
+    ImageBlob.objects.filter(name=old_name).update(name=new_name)
+
+
+def relocate_image(old_name, new_name, photosizes, keep_old=False):
+    """
+    Move the image file stored as old_name, and its renditions, to
+    new_name, and point the MetaImages and ImageBlob using it there.
+    Returns False if there is no such file.
+
+    The files are linked (or copied) to their new places before any
+    row is changed, and the old ones only removed afterwards, so that
+    every row points to a file throughout.
+    """
+    from metaimage.models import MetaImage
+    metaimages = list(MetaImage.objects.filter(image=old_name)[:1])
+    if not metaimages or not os.path.isfile(metaimages[0].image.path):
+        return False
+    pairs = _file_pairs(metaimages[0], new_name, photosizes)
+    for old_path, new_path in pairs:
+        _link(old_path, new_path)
+    transaction.commit_on_success(_switch)(old_name, new_name)
+    if keep_old:
+        return True
+    # Catch a MetaImage saved with the old name in the meantime:
+    transaction.commit_on_success(_switch)(old_name, new_name)
+    for old_path, new_path in pairs:
+        os.unlink(old_path)
+    return True
+
+
+def relocate_images(depth=SHARD_DEPTH, width=SHARD_WIDTH,
+                    batch_size=RELOCATE_BATCH_SIZE, keep_old=False,
+                    progress=None):
+    """
+    Move every stored image file, and its renditions, to where the
+    layout of depth and width puts it, a batch of MetaImages at a time,
+    and update their rows; see relocate_image().  Safe to stop and run
+    again.  progress(moved, missing), if given, is called after each
+    batch.  Returns the number of files moved, and of those missing.
+    """
+    from photologue.models import PhotoSizeCache
+    from metaimage.models import MetaImage
+    photosizes = PhotoSizeCache().sizes.values()
+    moved = missing = 0
+    last_pk = 0
+    while True:
+        rows = list(MetaImage.objects.filter(pk__gt=last_pk).exclude(
+            image='').order_by('pk').values_list('pk', 'image')[:batch_size])
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+        names = set([name for pk, name in rows])
+        for old_name in sorted(names):
+            new_name = shard_name(old_name, depth, width)
+            if new_name == old_name:
+                continue
+            try:
+                if relocate_image(old_name, new_name, photosizes, keep_old):
+                    moved += 1
+                else:
+                    missing += 1
+            except (IOError, OSError), e:
+                logger.warning('Relocating %s failed: %r', old_name, e)
+                missing += 1
+        if progress is not None:
+            progress(moved, missing)
+    return moved, missing
@@ -0,0 +1,16 @@
+from django.dispatch import Signal
+
+
+# Sent by the ingest workers (see ingest.py) when a deferred
+# source_url fetch has stored its image, or has finally given up.
+# Views and templates can use MetaImage.is_pending/is_ready/is_failed
+# instead, these are for code that wants to react straight away.
+ingest_completed = Signal(providing_args=['metaimage'])
+ingest_failed = Signal(providing_args=['metaimage', 'error'])
+
+# Sent, with METAIMAGE_INGEST_TIMING on, when MetaImage.save() has
+# ingested an image (fetched, given as data or uploaded) or failed to;
+# phases is a list of (name, seconds, bytes, count), see
+# instrumentation.py.
+ingest_timed = Signal(
+    providing_args=['metaimage', 'source', 'total', 'phases', 'error'])
@@ -0,0 +1,182 @@
+"""
+Single-flight fetching: when many threads or processes save
+MetaImages with the same source_url at once (a link going viral,
+say), only one of them downloads the image, while the rest wait for
+it, and then use the image it stored (see SourceURL in models.py)
+rather than downloading it again.
+
+Fetches of a URL are serialized with a lock on the digest of the URL,
+held for the fetch step of MetaImage.save(), from one of two backends,
+neither of which needs an outside service; METAIMAGE_FETCH_LOCK picks
+one:
+
+- 'file' (the default): flock()ed files, in METAIMAGE_FETCH_LOCK_DIR,
+  for processes on the one host.  The lock is let go when its holder
+  exits, however it exits.
+- 'database': a FetchLock row per URL being fetched, for processes on
+  many hosts sharing a database.  A row left behind by a process that
+  died lapses after LOCK_LEASE seconds.
+- None turns single-flight fetching off.
+
+A fetch waits for the lock for at most METAIMAGE_FETCH_LOCK_WAIT
+seconds (and no longer than its deadline), then goes ahead anyway.
+
+Single-flight only works for saves made outside of a transaction,
+which Django commits as they go.  Inside one (e.g. with
+TransactionMiddleware, or commit_on_success), the rows written by the
+fetch - the SourceURL, and for the 'database' backend the FetchLock
+itself, which is written in a savepoint of the caller's transaction -
+aren't seen by other processes until the transaction commits.  That is
+after the lock is let go, so the fetches waiting on it download the
+image again.  Nothing worse comes of it than the extra downloads.
+"""
+from datetime import datetime, timedelta
+import errno
+import os
+import tempfile
+from time import sleep
+import uuid
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+
+from utils.timing import clock
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows.
+    fcntl = None
+
+
+FETCH_LOCK = getattr(settings, 'METAIMAGE_FETCH_LOCK', 'file')
+FETCH_LOCK_DIR = getattr(
+    settings, 'METAIMAGE_FETCH_LOCK_DIR',
+    os.path.join(tempfile.gettempdir(), 'metaimage-fetch-locks'))
+FETCH_LOCK_WAIT = getattr(settings, 'METAIMAGE_FETCH_LOCK_WAIT', 60)  # seconds
+
+# The URLs are spread over this many lock files, rather than one file
+# per URL, so that they don't pile up:
+LOCK_STRIPES = 4096
+# How long a FetchLock row is good for, in seconds; longer than any
+# fetch takes:
+LOCK_LEASE = 300
+# Seconds between tries for a lock that is held, doubling up to the
+# maximum:
+POLL_INTERVAL = 0.05
+POLL_INTERVAL_MAX = 0.5
+
+
+class FileLocks(object):
+    """
+    Locks on flock()ed files in directory, shared by the threads and
+    processes of one host.
+    """
+
+    def __init__(self, directory=FETCH_LOCK_DIR, stripes=LOCK_STRIPES):
+        self.directory = directory
+        self.stripes = stripes
+
+    def _path(self, key):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError, e:
+                # Another process made it at the same time:
+                if e.errno != errno.EEXIST:
+                    raise
+        return os.path.join(self.directory, '%04d.lock' % (
+            int(key[:8], 16) % self.stripes))
+
+    def acquire(self, key, timeout):
+        """
+        Take the lock for key, a hex digest, waiting at most timeout
+        seconds; returns a token for release(), or None if it timed
+        out.
+        """
+        lock_file = open(self._path(key), 'a')
+        give_up = clock() + timeout
+        interval = POLL_INTERVAL
+        while True:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    lock_file.close()
+                    raise
+            if clock() >= give_up:
+                lock_file.close()
+                return None
+            sleep(interval)
+            interval = min(interval * 2, POLL_INTERVAL_MAX)
+
+    def release(self, token):
+        if token is None:
+            return
+        try:
+            fcntl.flock(token.fileno(), fcntl.LOCK_UN)
+        finally:
+            token.close()
+
+
+class DatabaseLocks(object):
+    """
+    Locks held as FetchLock rows, shared by every process using the
+    database.  A row is good for lease seconds, after which its lock
+    can be taken over.
+    """
+
+    def __init__(self, lease=LOCK_LEASE):
+        self.lease = lease
+
+    def acquire(self, key, timeout):
+        """
+        Take the lock for key, waiting at most timeout seconds; returns
+        a token for release(), or None if it timed out.
+        """
+        from metaimage.models import FetchLock
+        owner = uuid.uuid4().hex
+        give_up = clock() + timeout
+        interval = POLL_INTERVAL
+        while True:
+            now = datetime.now()
+            expires = now + timedelta(seconds=self.lease)
+            savepoint_id = transaction.savepoint()
+            try:
+                FetchLock.objects.create(key=key, owner=owner, expires=expires)
+                transaction.savepoint_commit(savepoint_id)
+                return key, owner
+            except IntegrityError:
+                transaction.savepoint_rollback(savepoint_id)
+            # Take over a lock whose holder has died:
+            if FetchLock.objects.filter(key=key, expires__lt=now).update(
+                    owner=owner, expires=expires):
+                return key, owner
+            if clock() >= give_up:
+                return None
+            sleep(interval)
+            interval = min(interval * 2, POLL_INTERVAL_MAX)
+
+    def release(self, token):
+        if token is None:
+            return
+        from metaimage.models import FetchLock
+        key, owner = token
+        FetchLock.objects.filter(key=key, owner=owner).delete()
+
+
+def get_fetch_locks(backend=FETCH_LOCK):
+    """
+    The locks to fetch with, from backend ('file', 'database' or
+    None), or None for none.
+    """
+    if backend == 'file':
+        if fcntl is None:
+            return None
+        return FileLocks()
+    if backend == 'database':
+        return DatabaseLocks()
+    if backend:
+        raise ValueError('Unknown METAIMAGE_FETCH_LOCK: %r' % backend)
+    return None
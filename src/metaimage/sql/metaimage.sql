@@ -0,0 +1,9 @@
+-- Run by syncdb after creating the metaimage_metaimage table.  The feed
+-- views page through images newest first, by (created, id), filtered
+-- by privacy or by creator; these let each page be read straight off
+-- an index, however deep it is.
+CREATE INDEX metaimage_metaimage_privacy_created ON metaimage_metaimage (privacy, created, id);
+CREATE INDEX metaimage_metaimage_creator_created ON metaimage_metaimage (creator_id, created, id);
+-- For finding images by when they were taken, as read from their EXIF
+-- data (camera and orientation are indexed by the model):
+CREATE INDEX metaimage_metaimage_date_taken ON metaimage_metaimage (date_taken);
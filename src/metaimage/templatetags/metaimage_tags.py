@@ -1,7 +1,9 @@
-import re
-
 from django import template
-#from photologue.utils import EXIF
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+from metaimage.fragments import get_fragments, set_fragments
+from metaimage.renditions import render_metaimages
 
 
 register = template.Library()
@@ -9,6 +11,11 @@ register = template.Library()
 
 @register.tag(name="print_exif")
 def do_print_exif(parser, token):
+    """
+    Renders a MetaImage's stored EXIF data (or any dict) as a table:
+
+        {% print_exif the_metaimage %}
+    """
     try:
         tag_name, exif = token.contents.split()
     except ValueError:
@@ -25,13 +32,110 @@ class PrintExifNode(template.Node):
 
     def render(self, context):
         try:
-            exif = unicode(self.exif.resolve(context, True))
+            exif = self.exif.resolve(context, True)
         except template.VariableDoesNotExist:
-            exif = u''
-        EXPR = "'(?P<key>[^:]*)'\:(?P<value>[^,]*),"
-        expr = re.compile(EXPR)
-        msg = "<table>"
-        for i in expr.findall(exif):
-            msg += "<tr><td>%s</td><td>%s</td></tr>" % (i[0], i[1])
-        msg += "</table>"
-        return u'<div id="exif">%s</div>' % (msg)
+            exif = None
+        # Given a MetaImage, show its EXIF data:
+        exif = getattr(exif, 'exif', exif)
+        if not isinstance(exif, dict):
+            exif = {}
+        rows = []
+        for key, value in sorted(exif.items()):
+            if isinstance(value, list):
+                value = u', '.join([unicode(part) for part in value])
+            rows.append(u'<tr><td>%s</td><td>%s</td></tr>' % (
+                conditional_escape(key), conditional_escape(value)))
+        return u'<div id="exif"><table>%s</table></div>' % u''.join(rows)
+
+
+@register.tag(name="render_metaimages")
+def do_render_metaimages(parser, token):
+    """
+    Renders a whole list or queryset of MetaImages at one PhotoSize,
+    looking up all their renditions in one go:
+
+        {% render_metaimages metaimages "square25" %}
+        {% render_metaimages metaimages "square25" linked %}
+
+    or, to lay the images out yourself,
+
+        {% render_metaimages metaimages "square25" linked as thumbnails %}
+        {% for metaimage, thumbnail in thumbnails %}...{% endfor %}
+    """
+    bits = token.split_contents()
+    varname = None
+    if len(bits) > 2 and bits[-2] == 'as':
+        varname = bits[-1]
+        bits = bits[:-2]
+    linked = False
+    if len(bits) == 4 and bits[-1] == 'linked':
+        linked = True
+        bits = bits[:-1]
+    if len(bits) != 3:
+        msg = ('%r tag requires a list of MetaImages and a size, optionally '
+               'followed by "linked" and/or "as varname"' % bits[0])
+        raise template.TemplateSyntaxError(msg)
+    return RenderMetaImagesNode(
+        parser.compile_filter(bits[1]), parser.compile_filter(bits[2]),
+        linked, varname)
+
+
+class RenderMetaImagesNode(template.Node):
+
+    def __init__(self, metaimages, the_size, linked, varname):
+        self.metaimages = metaimages
+        self.the_size = the_size
+        self.linked = linked
+        self.varname = varname
+
+    def render(self, context):
+        metaimages = self.metaimages.resolve(context, True) or []
+        rendered = render_metaimages(
+            metaimages, self.the_size.resolve(context), self.linked)
+        if self.varname:
+            context[self.varname] = rendered
+            return u''
+        return mark_safe(u''.join([html for metaimage, html in rendered]))
+
+
+@register.tag(name="metaimage_fragment")
+def do_metaimage_fragment(parser, token):
+    """
+    Caches the enclosed template fragment for one MetaImage until the
+    image changes (see metaimage.fragments):
+
+        {% metaimage_fragment the_metaimage "details" "width500" %}
+            {{ the_metaimage.render }} ...
+        {% endmetaimage_fragment %}
+
+    The third argument, the PhotoSize the fragment shows the image at,
+    is optional; any further arguments are also part of the cache key.
+    """
+    bits = token.split_contents()
+    if len(bits) < 3:
+        msg = ('%r tag requires a MetaImage and a fragment name, optionally '
+               'followed by a size and other values to vary on' % bits[0])
+        raise template.TemplateSyntaxError(msg)
+    nodelist = parser.parse(('endmetaimage_fragment',))
+    parser.delete_first_token()
+    return MetaImageFragmentNode(
+        nodelist, [parser.compile_filter(bit) for bit in bits[1:]])
+
+
+class MetaImageFragmentNode(template.Node):
+
+    def __init__(self, nodelist, args):
+        self.nodelist = nodelist
+        self.args = args
+
+    def render(self, context):
+        args = [arg.resolve(context) for arg in self.args]
+        metaimage, name = args[:2]
+        the_size = len(args) > 2 and args[2] or None
+        vary_on = tuple(args[3:])
+        html = get_fragments([metaimage], name, the_size, vary_on).get(
+            metaimage.pk)
+        if html is None:
+            html = self.nodelist.render(context)
+            set_fragments([(metaimage, html)], name, the_size, vary_on)
+        return html
@@ -1,11 +1,60 @@
+from cStringIO import StringIO
+from datetime import datetime
+import gzip
+import hashlib
+import os
 import shutil
+import socket
+import struct
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
 
+from PIL import Image
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.contrib import admin
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
+from django.core.urlresolvers import reverse
+from django.db import connection, reset_queries
+from django.template import Context, Template
+from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
 
+from photologue.models import PhotoSize, PhotoSizeCache
+
+from metaimage.admin import MetaImageAdmin
+from metaimage.benchmarks.suite import compare_results, measure
+from metaimage.fragments import get_fragments
+from metaimage.importer import MetaImageImporter, read_archive, \
+     read_directory
+from metaimage.ingest import process_job
+from metaimage.pagination import keyset_page
+from metaimage.rendering import render_pending, render_renditions
+from metaimage.renditions import get_rendition, manifest, \
+     render_metaimages, resolve_renditions, LRUCache
+from metaimage.sharding import relocate_images, shard_name
+from metaimage.singleflight import DatabaseLocks, FileLocks
+from metaimage.failures import FailureRegistry
+from metaimage.utils.fetchengine import FetchEngine, FetchUnavailable
+from metaimage.utils.exif import read_exif
+from metaimage.utils.imageinfo import sniff_image_format
+from metaimage.utils.openanything import fetch, fetch_to_file, iter_body, \
+     Fetcher, FetchTimeouts, REJECTED_CONTENT_TYPE, REJECTED_HEADER, REJECTED_TOO_LARGE, \
+     REJECTED_TOO_MANY_PIXELS
+from metaimage.utils.stubserver import StubHTTPServer
 from metaimage.forms import MetaImageUploadForm, MetaImageEditForm
-from metaimage.models import MetaImage, METAIMAGE_DIR
+from metaimage import instrumentation, models, sharding, signals, \
+     variants
+from metaimage.models import ImageBlob, IngestJob, IngestRecord, MetaImage, \
+     MetaImageSourceURLTooLarge, MetaImageSourceURLUnavailable, \
+     MetaImageUnableToRetrieveSourceURL, \
+     SourceURL, source_url_digest, METAIMAGE_DIR, \
+     INGEST_FAILED, INGEST_JOB_QUEUED, INGEST_JOB_RUNNING, INGEST_PENDING
 
 
 class TestMetaImage(TestCase):
@@ -55,6 +104,1371 @@ class TestMetaImage(TestCase):
         shutil.rmtree(METAIMAGE_DIR)
 
 
+class TestDeferredIngest(TestCase):
+    """
+    Saving with defer_fetch=True queues the download instead of doing
+    it; none of these tests touch the network.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        self.test_metaimage = MetaImage(
+            title='Deferred logo',
+            source_url='http://media.djangoproject.com/img/site/hdr_logo.gif',
+            creator=self.foo)
+        self.test_metaimage.save(defer_fetch=True)
+
+    def test_saved_as_pending(self):
+        the_metaimage = MetaImage.objects.get(slug='deferred-logo')
+        assert the_metaimage.is_pending
+        assert not the_metaimage.image
+        assert (the_metaimage.render()
+                == '<span class="metaimage-pending">Deferred logo</span>')
+
+    def test_job_queued_once(self):
+        self.test_metaimage.save(defer_fetch=True)
+        self.assertEqual(
+            IngestJob.objects.filter(metaimage=self.test_metaimage).count(), 1)
+
+    def test_claim(self):
+        job = IngestJob.objects.claim('test-worker')
+        self.assertEqual(job.metaimage, self.test_metaimage)
+        self.assertEqual(job.status, INGEST_JOB_RUNNING)
+        self.assertEqual(job.attempts, 1)
+        # Nothing else is queued:
+        self.assertEqual(IngestJob.objects.claim('test-worker'), None)
+
+    def test_edit_doesnt_fetch(self):
+        # Saving a pending or failed image, e.g. from the edit form,
+        # leaves the fetch to the queue:
+        for status in (INGEST_PENDING, INGEST_FAILED):
+            the_metaimage = MetaImage.objects.get(pk=self.test_metaimage.pk)
+            the_metaimage.ingest_status = status
+            the_metaimage.title = 'Renamed logo'
+            the_metaimage.save(defer_fetch=False)
+            the_metaimage = MetaImage.objects.get(pk=the_metaimage.pk)
+            self.assertEqual(the_metaimage.ingest_status, status)
+            assert not the_metaimage.image
+
+    def test_failed(self):
+        updated = self.test_metaimage.updated
+
+        def fetch_source_url(self, *args, **kwargs):
+            raise MetaImageUnableToRetrieveSourceURL('Unreachable')
+
+        old_fetch_source_url = MetaImage.fetch_source_url
+        MetaImage.fetch_source_url = fetch_source_url
+        try:
+            job = IngestJob.objects.claim('test-worker')
+            assert not process_job(job, max_attempts=1)
+        finally:
+            MetaImage.fetch_source_url = old_fetch_source_url
+        the_metaimage = MetaImage.objects.get(pk=self.test_metaimage.pk)
+        self.assertEqual(the_metaimage.ingest_status, INGEST_FAILED)
+        # So that its cached fragments aren't used any more:
+        assert the_metaimage.updated > updated
+
+    def test_turned_away(self):
+        def fetch_source_url(self, *args, **kwargs):
+            raise MetaImageSourceURLUnavailable('Recently failed')
+
+        old_fetch_source_url = MetaImage.fetch_source_url
+        MetaImage.fetch_source_url = fetch_source_url
+        try:
+            job = IngestJob.objects.claim('test-worker')
+            assert not process_job(job, max_attempts=1)
+        finally:
+            MetaImage.fetch_source_url = old_fetch_source_url
+        # Not counted as an attempt, and not tried again straight away:
+        job = IngestJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, INGEST_JOB_QUEUED)
+        self.assertEqual(job.attempts, 0)
+        assert job.not_before > datetime.now()
+        self.assertEqual(IngestJob.objects.claim('test-worker'), None)
+        assert MetaImage.objects.get(pk=self.test_metaimage.pk).is_pending
+
+
+def make_image_data(size=(10, 10), format='PNG'):
+    """
+    Return a small image, as a string, for tests that don't want to
+    go out to the network.
+    """
+    buf = StringIO()
+    Image.new('RGB', size, (255, 0, 0)).save(buf, format)
+    return buf.getvalue()
+
+
+def make_exif_jpeg(size=(10, 10), make='Canon', model='Canon EOS 5D',
+                   orientation=6, date_taken='2010:06:15 14:30:00'):
+    """
+    Return a small JPEG, as a string, with EXIF camera, orientation
+    and date taken tags.
+    """
+    def ifd(entries, offset):
+        # The entries, then the (longer than 4 byte) ASCII values:
+        data_offset = offset + 2 + 12 * len(entries) + 4
+        fields, data = [struct.pack('<H', len(entries))], ''
+        for tag, field_type, value in entries:
+            if field_type == 2:
+                value += '\x00'
+                fields.append(struct.pack(
+                    '<HHII', tag, 2, len(value), data_offset + len(data)))
+                data += value
+            elif field_type == 3:
+                fields.append(struct.pack('<HHIHH', tag, 3, 1, value, 0))
+            else:
+                fields.append(struct.pack('<HHII', tag, 4, 1, value))
+        return ''.join(fields) + struct.pack('<I', 0) + data
+    exif_offset = 8 + 2 + 12 * 4 + 4 + len(make) + 1 + len(model) + 1
+    tiff = ('II*\x00' + struct.pack('<I', 8)
+            + ifd([(0x010f, 2, make), (0x0110, 2, model),
+                   (0x0112, 3, orientation), (0x8769, 4, exif_offset)], 8)
+            + ifd([(0x9003, 2, date_taken)], exif_offset))
+    app1 = 'Exif\x00\x00' + tiff
+    jpeg = make_image_data(size, 'JPEG')
+    return (jpeg[:2] + '\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1
+            + jpeg[2:])
+
+
+class TestExif(TestCase):
+    """
+    EXIF data read once when an image is stored.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        self.the_metaimage = MetaImage(title='Photo', creator=self.foo)
+        self.the_metaimage.save(image_data=make_exif_jpeg())
+
+    def test_stored(self):
+        the_metaimage = MetaImage.objects.get(camera='Canon EOS 5D')
+        self.assertEqual(the_metaimage.orientation, 6)
+        self.assertEqual(the_metaimage.date_taken,
+                         datetime(2010, 6, 15, 14, 30))
+        self.assertEqual(the_metaimage.exif['Make'], 'Canon')
+
+    def test_print_exif(self):
+        html = Template('{% load metaimage_tags %}{% print_exif mi %}').render(
+            Context({'mi': MetaImage.objects.get(pk=self.the_metaimage.pk)}))
+        assert html.startswith('<div id="exif"><table>')
+        assert '<tr><td>Model</td><td>Canon EOS 5D</td></tr>' in html
+
+    def test_no_exif(self):
+        the_metaimage = MetaImage(title='Chart', creator=self.foo)
+        the_metaimage.save(image_data=make_image_data())
+        the_metaimage = MetaImage.objects.get(pk=the_metaimage.pk)
+        self.assertEqual((the_metaimage.exif, the_metaimage.camera),
+                         ({}, ''))
+
+    def test_new_image_without_exif(self):
+        # The date taken is kept when the image is replaced by one
+        # without EXIF data:
+        the_metaimage = MetaImage.objects.get(pk=self.the_metaimage.pk)
+        the_metaimage.store_image_data(make_image_data(), 'chart.png')
+        the_metaimage.save()
+        the_metaimage = MetaImage.objects.get(pk=the_metaimage.pk)
+        self.assertEqual(the_metaimage.date_taken,
+                         datetime(2010, 6, 15, 14, 30))
+
+    def test_rationals(self):
+        class ExifImage(object):
+            def _getexif(self):
+                # YCbCrSubSampling is a pair of SHORTs, ExposureTime a
+                # RATIONAL:
+                return {0x0212: (2, 1), 0x829a: (1, 250)}
+        self.assertEqual(read_exif(ExifImage()),
+                         {'YCbCrSubSampling': [2, 1], 'ExposureTime': 0.004})
+
+    def tearDown(self):
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestFetchToFile(TestCase):
+    """
+    Tests of the streaming fetch in utils/openanything.py, using local
+    files rather than URLs.
+    """
+
+    def setUp(self):
+        self.png_data = make_image_data()
+        self.png_file = tempfile.NamedTemporaryFile()
+        self.png_file.write(self.png_data)
+        self.png_file.flush()
+
+    def test_fetch_to_file(self):
+        result = fetch_to_file(self.png_file.name,
+                               check_header=sniff_image_format)
+        self.assertEqual(result['size'], len(self.png_data))
+        self.assertEqual(result['file'].read(), self.png_data)
+
+    def test_max_size(self):
+        result = fetch_to_file(self.png_file.name, max_size=20, chunk_size=7)
+        self.assertEqual(result['size'], 20)
+        self.assertEqual(result['file'].read(), self.png_data[:20])
+        self.assertTrue(result['truncated'])
+        result = fetch_to_file(self.png_file.name,
+                               max_size=len(self.png_data), chunk_size=7)
+        self.assertFalse(result.get('truncated'))
+
+    def test_rejected(self):
+        text_file = tempfile.NamedTemporaryFile()
+        text_file.write('<html><body>Not an image</body></html>')
+        text_file.flush()
+        result = fetch_to_file(text_file.name,
+                               check_header=sniff_image_format)
+        self.assertEqual(result['rejected'], REJECTED_HEADER)
+        assert 'file' not in result
+
+    def test_too_many_pixels(self):
+        result = fetch_to_file(self.png_file.name, max_pixels=99)
+        self.assertEqual(result['rejected'], REJECTED_TOO_MANY_PIXELS)
+        result = fetch_to_file(self.png_file.name, max_pixels=100)
+        self.assertFalse(result.get('rejected'))
+
+    def test_iter_body_gzipped(self):
+        buf = StringIO()
+        gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+        gzip_file.write(self.png_data * 100)
+        gzip_file.close()
+        chunks = list(iter_body(StringIO(buf.getvalue()), gzipped=True,
+                                chunk_size=64))
+        assert max([len(chunk) for chunk in chunks]) <= 64
+        self.assertEqual(''.join(chunks), self.png_data * 100)
+
+
+class TestFetcher(TestCase):
+    """
+    Tests of the pooled Fetcher against a local HTTP server.
+    """
+
+    def setUp(self):
+        self.png_data = make_image_data()
+        self.server = StubHTTPServer({
+            '/logo.png': (200, {'Content-Type': 'image/png'}, self.png_data),
+            '/moved.png': (301, {'Location': '/logo.png'}, ''),
+            '/page.html': (200, {'Content-Type': 'text/html'}, '<html>'),
+            '/closed.png': (200, {'Content-Type': 'image/png',
+                                  'Connection': 'close'}, self.png_data),
+            # Just the header of a 30000 x 20000 PNG:
+            '/huge.png': (200, {'Content-Type': 'image/png'},
+                          '\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR'
+                          + struct.pack('>II', 30000, 20000)),
+            }).start()
+        self.fetcher = Fetcher()
+
+    def test_connection_reuse(self):
+        for i in range(5):
+            result = fetch(self.server.url('/logo.png'), fetcher=self.fetcher)
+            self.assertEqual(result['data'], self.png_data)
+            self.assertEqual(result['status'], 200)
+        self.assertEqual(self.server.requests, 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_redirect(self):
+        result = fetch(self.server.url('/moved.png'), fetcher=self.fetcher)
+        self.assertEqual(result['data'], self.png_data)
+        self.assertEqual(result['status'], 301)
+        self.assertEqual(result['url'], self.server.url('/logo.png'))
+
+    def test_not_found(self):
+        result = fetch(self.server.url('/missing.png'), fetcher=self.fetcher)
+        self.assertEqual(result['status'], 404)
+
+    def test_timeouts(self):
+        # Fetching doesn't change the timeout of every other socket:
+        self.assertEqual(socket.getdefaulttimeout(), None)
+        slow_server = StubHTTPServer({
+            '/logo.png': (200, {'Content-Type': 'image/png'}, self.png_data),
+            }, connect_delay=1).start()
+        try:
+            started = time.time()
+            result = fetch(slow_server.url('/logo.png'), retry_attempts=5,
+                           retry_delay=0.1, fetcher=self.fetcher,
+                           timeouts=FetchTimeouts(read=0.2, deadline=0.5))
+            self.assertEqual(result, {})
+            # The deadline covers every attempt:
+            self.assertTrue(time.time() - started < 0.9)
+        finally:
+            slow_server.stop()
+
+    def test_deadline_closed_connection(self):
+        # The body of a response whose connection closes after it is
+        # read with the deadline applied all the same:
+        timeouts = FetchTimeouts(deadline=5)
+        result = fetch(self.server.url('/closed.png'), fetcher=self.fetcher,
+                       timeouts=timeouts)
+        self.assertEqual(result['data'], self.png_data)
+        old_server = StubHTTPServer({
+            '/logo.png': (200, {'Content-Type': 'image/png'}, self.png_data),
+            }, protocol_version='HTTP/1.0').start()
+        try:
+            result = fetch(old_server.url('/logo.png'), fetcher=self.fetcher,
+                           timeouts=timeouts)
+            self.assertEqual(result['data'], self.png_data)
+        finally:
+            old_server.stop()
+
+    def test_early_rejection(self):
+        result = fetch_to_file(self.server.url('/logo.png'),
+                               max_size=len(self.png_data) - 1,
+                               fetcher=self.fetcher)
+        self.assertEqual(result['rejected'], REJECTED_TOO_LARGE)
+        result = fetch_to_file(self.server.url('/page.html'),
+                               accept_types=('image/',), fetcher=self.fetcher)
+        self.assertEqual(result['rejected'], REJECTED_CONTENT_TYPE)
+        the_metaimage = MetaImage(source_url=self.server.url('/huge.png'))
+        self.assertRaises(MetaImageSourceURLTooLarge, the_metaimage.save)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.stop()
+
+
+class TestFetchEngine(TestCase):
+    """
+    Concurrent fetching, within global and per-host caps.
+    """
+
+    def setUp(self):
+        self.png_data = make_image_data()
+        routes = {'/busy.png': (503, {'Content-Type': 'text/plain'}, 'Busy')}
+        for i in range(20):
+            routes['/image-%s.png' % i] = (
+                200, {'Content-Type': 'image/png'}, self.png_data)
+        self.server = StubHTTPServer(routes).start()
+        self.fetcher = Fetcher(pool_size=10)
+        self.engine = FetchEngine(max_concurrency=10, per_host=2,
+                                  retry_attempts=3, backoff_base=0.01,
+                                  fetcher=self.fetcher)
+
+    def test_fetch_many(self):
+        urls = [self.server.url('/image-%s.png' % i) for i in range(20)]
+        results = self.engine.fetch_many(urls)
+        self.assertEqual(sorted(results.keys()), sorted(urls))
+        for url in urls:
+            self.assertEqual(results[url]['data'], self.png_data)
+            self.assertEqual(results[url]['status'], 200)
+            self.assertEqual(results[url]['url'], url)
+        # No more than two fetches at a time went to the one host:
+        self.assertTrue(self.fetcher.connections_opened <= 2)
+
+    def test_retries(self):
+        result = self.engine.fetch(self.server.url('/busy.png'))
+        self.assertEqual(result['status'], 503)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_backoff(self):
+        for retry_num in range(1, 20):
+            delay = self.engine.backoff(retry_num)
+            self.assertTrue(0 <= delay <= min(
+                self.engine.backoff_max, 0.01 * 2 ** (retry_num - 1)))
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.stop()
+
+
+class TestFailureRegistry(TestCase):
+    """
+    Failing URLs and hosts are turned away for a while, without a fetch.
+    """
+    url = 'http://images.example.com/a.png'
+
+    def test_failed_url(self):
+        registry = FailureRegistry(url_ttl=0.2)
+        self.assertEqual(registry.check(self.url), None)
+        registry.record(self.url, {'status': 404})
+        self.assertNotEqual(registry.check(self.url), None)
+        # Other URLs on the host are fine:
+        self.assertEqual(
+            registry.check('http://images.example.com/b.png'), None)
+        time.sleep(0.3)
+        self.assertEqual(registry.check(self.url), None)
+
+    def test_circuit(self):
+        registry = FailureRegistry(threshold=3, window=10, open_seconds=0.2)
+        for i in range(3):
+            registry.record('http://images.example.com/%s.png' % i, {})
+        self.assertNotEqual(
+            registry.check('http://images.example.com/b.png'), None)
+        self.assertEqual(registry.check('http://example.org/b.png'), None)
+        # Half-open: a single probe is let through, and if it fails the
+        # circuit opens again.
+        time.sleep(0.3)
+        self.assertEqual(registry.check(self.url), None)
+        self.assertNotEqual(
+            registry.check('http://images.example.com/b.png'), None)
+        registry.record(self.url, {'status': 503})
+        time.sleep(0.1)
+        self.assertNotEqual(
+            registry.check('http://images.example.com/b.png'), None)
+        # A successful probe closes it:
+        time.sleep(0.2)
+        self.assertEqual(
+            registry.check('http://images.example.com/b.png'), None)
+        registry.record('http://images.example.com/b.png', {'status': 200})
+        self.assertEqual(
+            registry.check('http://images.example.com/c.png'), None)
+        self.assertEqual(
+            registry.check('http://images.example.com/d.png'), None)
+
+    def test_shared(self):
+        # Failures seen by one process are seen by the others:
+        cache = get_cache('locmem://')
+        one = FailureRegistry(cache, threshold=2)
+        other = FailureRegistry(cache, threshold=2)
+        one.record(self.url, {'status': 404})
+        self.assertNotEqual(other.check(self.url), None)
+        one.record('http://images.example.com/b.png', {})
+        other.record('http://images.example.com/c.png', {})
+        self.assertNotEqual(
+            one.check('http://images.example.com/d.png'), None)
+
+    def test_engine(self):
+        png_data = make_image_data()
+        server = StubHTTPServer({
+            '/image.png': (200, {'Content-Type': 'image/png'}, png_data),
+            '/busy.png': (503, {'Content-Type': 'text/plain'}, 'Busy'),
+            }).start()
+        fetcher = Fetcher()
+        engine = FetchEngine(retry_attempts=1, fetcher=fetcher,
+                             breaker=FailureRegistry(threshold=2))
+        try:
+            self.assertEqual(engine.fetch(server.url('/busy.png'))['status'],
+                             503)
+            self.assertRaises(FetchUnavailable, engine.fetch,
+                              server.url('/busy.png'))
+            self.assertEqual(server.requests, 1)
+            engine.fetch(server.url('/busy.png?again'))
+            self.assertRaises(FetchUnavailable, engine.fetch,
+                              server.url('/image.png'))
+            self.assertEqual(server.requests, 2)
+        finally:
+            fetcher.close()
+            server.stop()
+
+
+class TestIngestTiming(TestCase):
+    """
+    Phase by phase timing of ingest, with METAIMAGE_INGEST_TIMING on.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        self.png_data = make_image_data()
+        self.server = StubHTTPServer({
+            '/logo.png': (200, {'Content-Type': 'image/png'}, self.png_data),
+            }).start()
+        self.old_settings = (instrumentation.INGEST_TIMING,
+                             instrumentation.INGEST_SLOW_SECONDS)
+        instrumentation.INGEST_TIMING = True
+        instrumentation.INGEST_SLOW_SECONDS = 0
+        self.timed = []
+        signals.ingest_timed.connect(self.record_timing)
+
+    def record_timing(self, sender, **kwargs):
+        self.timed.append(kwargs)
+
+    def test_source_url(self):
+        the_metaimage = MetaImage(title='Logo', creator=self.foo,
+                                  source_url=self.server.url('/logo.png'))
+        the_metaimage.save()
+        self.assertEqual(len(self.timed), 1)
+        self.assertEqual(self.timed[0]['source'], 'url')
+        phases = dict([(phase[0], phase[1:])
+                       for phase in self.timed[0]['phases']])
+        for name in ('connect', 'response', 'download', 'spool', 'verify',
+                     'digest', 'storage', 'database'):
+            self.assertTrue(name in phases, name)
+        self.assertEqual(phases['download'][1], len(self.png_data))
+        record = IngestRecord.objects.get(metaimage=the_metaimage)
+        self.assertEqual(record.source_url, the_metaimage.source_url)
+        self.assertEqual(record.get_phases(), [
+            tuple(phase) for phase in self.timed[0]['phases']])
+        # Saving again ingests nothing:
+        the_metaimage.save()
+        self.assertEqual(len(self.timed), 1)
+
+    def test_failure(self):
+        the_metaimage = MetaImage(title='Missing', creator=self.foo,
+                                  source_url=self.server.url('/missing.png'))
+        self.assertRaises(Exception, the_metaimage.save)
+        self.assertEqual(len(self.timed), 1)
+        self.assertTrue(self.timed[0]['error'] is not None)
+        self.assertTrue(IngestRecord.objects.get(metaimage=None).error)
+
+    def test_disabled(self):
+        instrumentation.INGEST_TIMING = False
+        the_metaimage = MetaImage(title='Chart', creator=self.foo)
+        the_metaimage.save(image_data=self.png_data)
+        self.assertEqual(self.timed, [])
+        self.assertEqual(IngestRecord.objects.count(), 0)
+
+    def tearDown(self):
+        signals.ingest_timed.disconnect(self.record_timing)
+        (instrumentation.INGEST_TIMING,
+         instrumentation.INGEST_SLOW_SECONDS) = self.old_settings
+        self.server.stop()
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestImageBlobs(TestCase):
+    """
+    Identical image data is stored once, and shared between
+    MetaImages.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        self.png_data = make_image_data()
+
+    def make_metaimage(self, title):
+        the_metaimage = MetaImage(title=title, creator=self.foo)
+        the_metaimage.save(image_data=self.png_data)
+        return the_metaimage
+
+    def test_dedup(self):
+        first = self.make_metaimage('First chart')
+        second = self.make_metaimage('Second chart')
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(first.blob, second.blob)
+        self.assertEqual(ImageBlob.objects.get().ref_count, 2)
+        first.delete()
+        self.assertEqual(ImageBlob.objects.get().ref_count, 1)
+        assert second.image.storage.exists(second.image.name)
+        second.delete()
+        self.assertEqual(ImageBlob.objects.count(), 0)
+        assert not second.image.storage.exists(second.image.name)
+
+    def test_filename_from_data(self):
+        the_metaimage = MetaImage()
+        self.assertEqual(
+            the_metaimage.generate_filename_from_data('abc'),
+            'ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad.png')
+
+    def tearDown(self):
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestRevalidation(TestCase):
+    """
+    Conditional re-fetching of source_url images, from a local server.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        self.server = StubHTTPServer({
+            '/logo.png': (200, {'ETag': '"v1"'}, make_image_data()),
+            }).start()
+        self.test_metaimage = MetaImage(
+            title='Local logo',
+            source_url=self.server.url('/logo.png'),
+            creator=self.foo)
+        self.test_metaimage.save()
+
+    def test_validators_saved(self):
+        the_metaimage = MetaImage.objects.get(slug='local-logo')
+        self.assertEqual(the_metaimage.source_etag, '"v1"')
+        assert the_metaimage.source_checked is not None
+
+    def test_not_modified(self):
+        old_name = self.test_metaimage.image.name
+        assert not self.test_metaimage.revalidate_source()
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(MetaImage.objects.get().image.name, old_name)
+
+    def test_modified(self):
+        old_name = self.test_metaimage.image.name
+        self.server.routes['/logo.png'] = (
+            200, {'ETag': '"v2"'}, make_image_data(size=(20, 20)))
+        assert self.test_metaimage.revalidate_source()
+        the_metaimage = MetaImage.objects.get()
+        self.assertEqual(the_metaimage.source_etag, '"v2"')
+        self.assertNotEqual(the_metaimage.image.name, old_name)
+        # Nothing refers to the old image any more:
+        assert not the_metaimage.image.storage.exists(old_name)
+
+    def test_known_source(self):
+        # The same URL, spelled a little differently:
+        the_metaimage = MetaImage(
+            title='Same logo', creator=self.foo,
+            source_url=self.server.url('/logo.png').upper().replace(
+                '/LOGO.PNG', '/logo.png#top'))
+        the_metaimage.save()
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(the_metaimage.image.name,
+                         self.test_metaimage.image.name)
+        self.assertEqual(the_metaimage.width, self.test_metaimage.width)
+        self.assertEqual(the_metaimage.source_etag, '"v1"')
+        self.assertEqual(ImageBlob.objects.get().ref_count, 2)
+
+    def test_stale_known_source(self):
+        SourceURL.objects.update(checked=datetime(2000, 1, 1))
+        the_metaimage = MetaImage(title='Same logo', creator=self.foo,
+                                  source_url=self.test_metaimage.source_url)
+        the_metaimage.save()
+        # Asked whether it had changed, and it hadn't:
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(the_metaimage.image.name,
+                         self.test_metaimage.image.name)
+        assert SourceURL.objects.get().is_fresh()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestSingleFlight(TestCase):
+    """
+    Only one fetch of a URL at a time; the others wait, then use the
+    image it stored.
+    """
+    key = source_url_digest('http://images.example.com/a.png')
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        self.lock_dir = tempfile.mkdtemp()
+        self.old_locks = models.FETCH_LOCKS
+        models.FETCH_LOCKS = FileLocks(self.lock_dir)
+        self.server = StubHTTPServer({
+            '/logo.png': (200, {'ETag': '"v1"'}, make_image_data()),
+            }).start()
+
+    def check_locks(self, locks):
+        token = locks.acquire(self.key, 1)
+        assert token is not None
+        started = time.time()
+        self.assertEqual(locks.acquire(self.key, 0.2), None)
+        self.assertTrue(time.time() - started >= 0.2)
+        locks.release(token)
+        token = locks.acquire(self.key, 0)
+        assert token is not None
+        locks.release(token)
+
+    def test_file_locks(self):
+        self.check_locks(FileLocks(self.lock_dir))
+
+    def test_database_locks(self):
+        self.check_locks(DatabaseLocks())
+        # A lock whose holder died without letting go lapses:
+        assert DatabaseLocks(lease=-1).acquire(self.key, 0) is not None
+        assert DatabaseLocks().acquire(self.key, 0) is not None
+
+    def test_waits(self):
+        source_url = self.server.url('/logo.png')
+        # Another process is fetching the URL:
+        token = FileLocks(self.lock_dir).acquire(
+            source_url_digest(source_url), 1)
+        threading.Timer(0.3, models.FETCH_LOCKS.release, [token]).start()
+        started = time.time()
+        first = MetaImage(title='Logo', creator=self.foo, source_url=source_url)
+        first.save()
+        self.assertTrue(time.time() - started >= 0.3)
+        self.assertEqual(self.server.requests, 1)
+        # What it stored is used by those that waited:
+        second = MetaImage(title='Same logo', creator=self.foo,
+                           source_url=source_url)
+        second.save()
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(second.image.name, first.image.name)
+
+    def tearDown(self):
+        models.FETCH_LOCKS = self.old_locks
+        self.server.stop()
+        shutil.rmtree(self.lock_dir, ignore_errors=True)
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestImageInfo(TestCase):
+    """
+    Image facts are recorded at ingest, and rendition sizes worked out
+    from them.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        self.png_data = make_image_data(size=(300, 100))
+        self.test_metaimage = MetaImage(title='Wide chart', creator=self.foo)
+        self.test_metaimage.save(image_data=self.png_data)
+
+    def test_image_info(self):
+        the_metaimage = MetaImage.objects.get(slug='wide-chart')
+        self.assertEqual((the_metaimage.width, the_metaimage.height),
+                         (300, 100))
+        self.assertEqual(the_metaimage.image_format, 'PNG')
+        self.assertEqual(the_metaimage.image_mode, 'RGB')
+        self.assertEqual(the_metaimage.file_size, len(self.png_data))
+
+    def test_rendition_sizes(self):
+        for photosize, rendition_size in (
+                (PhotoSize(width=25, height=25, crop=True), (25, 25)),
+                (PhotoSize(width=0, height=50, upscale=True), (150, 50)),
+                (PhotoSize(width=150, height=150), (150, 50)),
+                (PhotoSize(width=500, height=0, upscale=False), (300, 100)),
+                (PhotoSize(width=600, height=0, upscale=True), (600, 200))):
+            self.assertEqual(
+                self.test_metaimage.calculate_rendition_size(photosize),
+                rendition_size)
+
+    def test_rendition_size_matches_file(self):
+        # What's calculated is what photologue made:
+        self.assertEqual(self.test_metaimage.get_rendition_size('height230'),
+                         self.test_metaimage.get_height230_size())
+
+    def test_decode_size(self):
+        for photosize, decode_size in (
+                (PhotoSize(name='tiny', width=25, height=25, crop=True),
+                 (75, 25)),
+                (PhotoSize(name='small', width=150, height=150), (150, 50)),
+                (PhotoSize(name='big', width=600, height=0, upscale=True),
+                 None)):
+            self.assertEqual(self.test_metaimage.get_decode_size(
+                [photosize], (300, 100)), decode_size)
+
+    def test_draft_decoding(self):
+        the_metaimage = MetaImage(title='Photo', creator=self.foo)
+        the_metaimage.save(
+            image_data=make_image_data(size=(800, 600), format='JPEG'))
+        square = PhotoSize(name='tiny', width=25, height=25, crop=True)
+        source_image = the_metaimage.open_original([square])
+        # Only as many pixels as the thumbnail needs were decoded:
+        self.assertTrue(34 <= source_image.size[0] < 800)
+        self.assertTrue(25 <= source_image.size[1] < 600)
+        self.assertEqual(
+            the_metaimage.process_rendition(source_image, square).size,
+            (25, 25))
+        self.assertEqual(the_metaimage.open_original().size, (800, 600))
+
+    def test_draft_rendition_size(self):
+        the_metaimage = MetaImage(title='Photo', creator=self.foo)
+        the_metaimage.save(
+            image_data=make_image_data(size=(200, 359), format='JPEG'))
+        PhotoSize.objects.create(name='fit', width=150, height=150)
+        # Decoded at half size, which scaled gives 83x150:
+        self.assertEqual(the_metaimage.open_original(
+            [PhotoSizeCache().sizes['fit']]).size, (100, 180))
+        the_metaimage.create_size(PhotoSizeCache().sizes['fit'])
+        rendition = Image.open(the_metaimage.get_fit_filename())
+        self.assertEqual(rendition.size, (84, 150))
+        self.assertEqual(the_metaimage.get_rendition_size('fit'), (84, 150))
+
+    def test_pixel_budget(self):
+        old_max_pixels = models.MAX_IMAGE_PIXELS
+        models.MAX_IMAGE_PIXELS = 1000
+        try:
+            assert not self.test_metaimage.is_str_an_image(self.png_data)
+            self.assertEqual(self.test_metaimage.open_original(), None)
+        finally:
+            models.MAX_IMAGE_PIXELS = old_max_pixels
+        assert self.test_metaimage.is_str_an_image(self.png_data)
+
+    def tearDown(self):
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestSharding(TestCase):
+    """
+    Image files, and their renditions, moved into shard directories.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        self.test_metaimage = MetaImage(title='Chart', creator=self.foo)
+        self.test_metaimage.save(image_data=make_image_data())
+        self.photosizes = PhotoSize.objects.filter(pre_cache=True)
+
+    def test_shard_name(self):
+        digest = hashlib.md5('logo.png').hexdigest()
+        sharded = 'photologue/photos/%s/%s/logo.png' % (digest[:2],
+                                                        digest[2:4])
+        self.assertEqual(shard_name('photologue/photos/logo.png', 2, 2),
+                         sharded)
+        self.assertEqual(shard_name(sharded, 2, 2), sharded)
+        self.assertEqual(shard_name(sharded, 0, 2),
+                         'photologue/photos/logo.png')
+
+    def test_relocate(self):
+        old_name = self.test_metaimage.image.name
+        old_path = self.test_metaimage.image.path
+        self.assertEqual(relocate_images(depth=2, batch_size=1), (1, 0))
+        the_metaimage = MetaImage.objects.get()
+        self.assertEqual(the_metaimage.image.name, shard_name(old_name, 2))
+        self.assertEqual(ImageBlob.objects.get().name,
+                         the_metaimage.image.name)
+        assert os.path.isfile(the_metaimage.image.path)
+        assert not os.path.isfile(old_path)
+        for photosize in self.photosizes:
+            assert the_metaimage.renditions_exist(photosize), photosize.name
+        # Already in place:
+        self.assertEqual(relocate_images(depth=2), (0, 0))
+        # And back again:
+        self.assertEqual(relocate_images(depth=0), (1, 0))
+        self.assertEqual(MetaImage.objects.get().image.name, old_name)
+        assert os.path.isfile(old_path)
+
+    def test_stale_save(self):
+        old_name = self.test_metaimage.image.name
+        old_sharding_depth = sharding.SHARD_DEPTH
+        sharding.SHARD_DEPTH = 2
+        try:
+            relocate_images(depth=2)
+            # Saving the copy loaded before the move keeps the new name:
+            self.test_metaimage.title = 'Renamed chart'
+            self.test_metaimage.save()
+        finally:
+            sharding.SHARD_DEPTH = old_sharding_depth
+        the_metaimage = MetaImage.objects.get()
+        self.assertEqual(the_metaimage.image.name, shard_name(old_name, 2))
+        assert os.path.isfile(the_metaimage.image.path)
+
+    def test_store_sharded(self):
+        old_sharding_depth = sharding.SHARD_DEPTH
+        sharding.SHARD_DEPTH = 2
+        try:
+            the_metaimage = MetaImage(title='Wide chart', creator=self.foo)
+            the_metaimage.save(image_data=make_image_data(size=(30, 10)))
+        finally:
+            sharding.SHARD_DEPTH = old_sharding_depth
+        name = the_metaimage.image.name
+        self.assertEqual(name, shard_name(name, 2))
+        self.assertNotEqual(name, shard_name(name, 0))
+        assert os.path.isfile(the_metaimage.image.path)
+        for photosize in self.photosizes:
+            assert the_metaimage.renditions_exist(photosize), photosize.name
+
+    def tearDown(self):
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestRenditionManifest(TestCase):
+    """
+    Batch rendering of MetaImages through the rendition manifest.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        for i, size in enumerate(((10, 10), (40, 20), (20, 40))):
+            the_metaimage = MetaImage(title='Chart %s' % i, creator=self.foo)
+            the_metaimage.save(image_data=make_image_data(size=size))
+        manifest.local.clear()
+
+    def test_render_metaimages(self):
+        metaimages = MetaImage.objects.order_by('id')
+        rendered = render_metaimages(metaimages, 'square50', linked=True)
+        self.assertEqual(
+            [html for metaimage, html in rendered],
+            [metaimage.render_linked('square50') for metaimage in metaimages])
+        self.assertEqual(len(manifest.local), 3)
+
+    def test_invalidated_on_save(self):
+        the_metaimage = MetaImage.objects.get(title='Chart 1')
+        the_metaimage.render('square50')
+        assert manifest.local.get(the_metaimage.pk) is not None
+        the_metaimage.caption = 'Now with a caption.'
+        the_metaimage.save()
+        assert manifest.local.get(the_metaimage.pk) is None
+
+    def test_views_counted_at_once(self):
+        metaimages = list(MetaImage.objects.order_by('id'))
+        resolve_renditions(metaimages, 'width500')
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        reset_queries()
+        try:
+            resolve_renditions(metaimages, 'width500')
+            # One UPDATE for all three views:
+            self.assertEqual(len(connection.queries), 1)
+        finally:
+            settings.DEBUG = old_debug
+        self.assertEqual(
+            [metaimage.view_count
+             for metaimage in MetaImage.objects.order_by('id')], [2, 2, 2])
+
+    def test_photosize_changed(self):
+        the_metaimage = MetaImage.objects.get(title='Chart 1')
+        self.assertEqual(get_rendition(the_metaimage, 'square50')[1:],
+                         (50, 50))
+        photosize = PhotoSize.objects.get(name='square50')
+        photosize.width = photosize.height = 40
+        photosize.save()
+        self.assertEqual(get_rendition(the_metaimage, 'square50')[1:],
+                         (40, 40))
+
+    def test_lru(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')),
+                         (1, None, 3))
+
+    def tearDown(self):
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestRendering(TestCase):
+    """
+    Making renditions ahead of time with render_renditions().
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        for i in range(3):
+            the_metaimage = MetaImage(title='Chart %s' % i, creator=self.foo)
+            the_metaimage.skip_pre_cache = True
+            the_metaimage.save(image_data=make_image_data(size=(60 + i, 40)))
+        self.pre_cache_sizes = [photosize.name for photosize
+                                in PhotoSize.objects.filter(pre_cache=True)]
+
+    def test_render_all(self):
+        report = render_renditions(processes=1)
+        self.assertEqual(report.images, 3)
+        for name in self.pre_cache_sizes:
+            self.assertEqual(report.counts[name], 3)
+        for the_metaimage in MetaImage.objects.all():
+            assert the_metaimage.renditions_cached
+            for name in self.pre_cache_sizes:
+                assert os.path.isfile(
+                    getattr(the_metaimage, 'get_%s_filename' % name)())
+        # Up to date renditions are left alone:
+        report = render_renditions(processes=1)
+        self.assertEqual(report.counts, {})
+
+    def test_render_pending(self):
+        # The images saved without their renditions are the queue:
+        self.assertEqual(render_pending(processes=1).images, 3)
+        assert not MetaImage.objects.filter(renditions_cached=False).exists()
+        self.assertEqual(render_pending(processes=1).images, 0)
+
+    def test_out_of_date(self):
+        render_renditions(processes=1)
+        the_metaimage = MetaImage.objects.get(title='Chart 0')
+        later = time.time() + 10
+        os.utime(the_metaimage.image.path, (later, later))
+        report = render_renditions(processes=1)
+        self.assertEqual(report.counts['square50'], 1)
+
+    def test_backfill_new_size(self):
+        render_renditions(processes=1)
+        PhotoSize.objects.create(name='tiny', width=10, height=10,
+                                 crop=True, pre_cache=True)
+        assert not MetaImage.objects.filter(renditions_cached=True).exists()
+        render_renditions(size_names=['tiny'], processes=1)
+        for the_metaimage in MetaImage.objects.all():
+            assert os.path.isfile(the_metaimage.get_tiny_filename())
+            assert the_metaimage.renditions_cached
+
+    def test_undecodable(self):
+        the_metaimage = MetaImage.objects.get(title='Chart 0')
+        old_max_pixels = models.MAX_IMAGE_PIXELS
+        models.MAX_IMAGE_PIXELS = 1000
+        try:
+            the_metaimage.save()
+        finally:
+            models.MAX_IMAGE_PIXELS = old_max_pixels
+        assert not the_metaimage.renditions_cached
+        assert not MetaImage.objects.get(pk=the_metaimage.pk).renditions_cached
+
+    def tearDown(self):
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestRenditionVariants(TestCase):
+    """
+    Renditions in other formats and pixel densities, per RenditionPolicy.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        variants._policies['square50'] = variants.RenditionPolicy(
+            formats=('JPEG',), densities=(1, 2), quality={'JPEG': 60})
+        self.the_metaimage = MetaImage(title='Chart', creator=self.foo)
+        self.the_metaimage.save(image_data=make_image_data(size=(60, 40)))
+
+    def test_variants_made(self):
+        photosize = PhotoSize.objects.get(name='square50')
+        paths = self.the_metaimage.get_rendition_paths(photosize)
+        self.assertEqual(
+            [os.path.basename(path) for path in paths[1:]],
+            [os.path.basename(paths[0])[:-len('.png')] + suffix
+             for suffix in ('.jpg', '@2x.png', '@2x.jpg')])
+        for path in paths:
+            assert os.path.isfile(path)
+        self.assertEqual(Image.open(paths[3]).size, (100, 100))
+
+    def test_render(self):
+        html = self.the_metaimage.render('square50')
+        url = self.the_metaimage.get_square50_url()
+        base = url[:-len('.png')]
+        self.assertEqual(
+            html,
+            '<picture><source type="image/jpeg" srcset="%s.jpg 1x, '
+            '%s@2x.jpg 2x"><img src="%s" srcset="%s 1x, %s@2x.png 2x" '
+            'height="50" width="50" alt="Chart"></picture>'
+            % (base, base, url, url, base))
+        # Sizes without a policy are rendered as before:
+        assert self.the_metaimage.render('square25').startswith('<img src=')
+
+    def tearDown(self):
+        del variants._policies['square50']
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestFragmentCache(TestCase):
+    """
+    Rendered HTML cached per image, until the image or its tags change.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        for i in range(2):
+            the_metaimage = MetaImage(title='Chart %s' % i, creator=self.foo)
+            the_metaimage.save(image_data=make_image_data(size=(10 + i, 10)))
+
+    def cached_titles(self):
+        metaimages = MetaImage.objects.order_by('title')
+        cached = get_fragments(metaimages, 'render', 'square25', (False,))
+        return [metaimage.title for metaimage in metaimages
+                if metaimage.pk in cached]
+
+    def test_invalidation(self):
+        render_metaimages(MetaImage.objects.all(), 'square25')
+        self.assertEqual(self.cached_titles(), ['Chart 0', 'Chart 1'])
+        the_metaimage = MetaImage.objects.get(title='Chart 0')
+        the_metaimage.caption = 'Now with a caption.'
+        the_metaimage.save()
+        self.assertEqual(self.cached_titles(), ['Chart 1'])
+        MetaImage.objects.get(title='Chart 1').tags.add('chart')
+        self.assertEqual(self.cached_titles(), [])
+
+    def test_photosize_changed(self):
+        render_metaimages(MetaImage.objects.all(), 'square25')
+        PhotoSize.objects.get(name='square25').save()
+        self.assertEqual(self.cached_titles(), [])
+
+    def test_views_counted(self):
+        the_metaimage = MetaImage.objects.get(title='Chart 0')
+        updated = the_metaimage.updated
+        render_metaimages([the_metaimage], 'width500')
+        render_metaimages([the_metaimage], 'width500')
+        the_metaimage = MetaImage.objects.get(title='Chart 0')
+        self.assertEqual(the_metaimage.view_count, 2)
+        # Views don't count as updates:
+        self.assertEqual(the_metaimage.updated, updated)
+
+    def test_template_tag(self):
+        the_metaimage = MetaImage.objects.get(title='Chart 0')
+        fragment = Template(
+            '{% load metaimage_tags %}'
+            '{% metaimage_fragment the_metaimage "test" %}'
+            '{{ the_metaimage.title }}{% endmetaimage_fragment %}')
+        self.assertEqual(
+            fragment.render(Context({'the_metaimage': the_metaimage})),
+            'Chart 0')
+        the_metaimage.title = 'Not saved'
+        self.assertEqual(
+            fragment.render(Context({'the_metaimage': the_metaimage})),
+            'Chart 0')
+
+    def tearDown(self):
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestImporter(TestCase):
+    """
+    Bulk import from a local directory of images.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        self.import_dir = tempfile.mkdtemp()
+        for filename, size in (('red_square.png', (10, 10)),
+                               ('red_square_copy.png', (10, 10)),
+                               ('wide.png', (30, 10))):
+            image_file = open(os.path.join(self.import_dir, filename), 'wb')
+            image_file.write(make_image_data(size=size))
+            image_file.close()
+        image_file = open(os.path.join(self.import_dir, 'broken.png'), 'wb')
+        image_file.write('Not an image')
+        image_file.close()
+        self.state_path = os.path.join(self.import_dir, 'state.txt')
+
+    def run_import(self):
+        importer = MetaImageImporter(
+            self.foo, num_workers=2, batch_size=2, state_path=self.state_path)
+        return importer.run(read_directory(self.import_dir, tags=['imported']))
+
+    def test_import(self):
+        report = self.run_import()
+        self.assertEqual(report.imported, 3)
+        self.assertEqual([key for key, error in report.failures],
+                         ['broken.png'])
+        the_metaimage = MetaImage.objects.get(title='wide')
+        self.assertEqual([tag.name for tag in the_metaimage.tags.all()],
+                         ['imported'])
+        # The two identical files are stored once:
+        self.assertEqual(ImageBlob.objects.count(), 2)
+
+    def test_archives(self):
+        archive_dir = tempfile.mkdtemp()
+        try:
+            zip_path = os.path.join(archive_dir, 'photos.zip')
+            archive = zipfile.ZipFile(zip_path, 'w')
+            for filename in sorted(os.listdir(self.import_dir)):
+                archive.write(os.path.join(self.import_dir, filename),
+                              'photos/' + filename)
+            archive.close()
+            tar_path = os.path.join(archive_dir, 'photos.tar.gz')
+            archive = tarfile.open(tar_path, 'w:gz')
+            archive.add(self.import_dir, 'photos')
+            archive.close()
+            for path in (zip_path, tar_path):
+                importer = MetaImageImporter(
+                    self.foo, num_workers=2, batch_size=2)
+                report = importer.run(read_archive(path, tags=['imported']))
+                self.assertEqual(report.imported, 3)
+                self.assertEqual([key for key, error in report.failures],
+                                 ['photos/broken.png'])
+        finally:
+            shutil.rmtree(archive_dir)
+        self.assertEqual(MetaImage.objects.filter(title='wide').count(), 2)
+
+    def test_resume(self):
+        self.run_import()
+        report = self.run_import()
+        self.assertEqual(report.imported, 0)
+        self.assertEqual(report.skipped, 3)
+        self.assertEqual(MetaImage.objects.count(), 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.import_dir)
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class FailingImporter(MetaImageImporter):
+    # Fails to write the 'wide' image, after storing its file:
+    def _create(self, item):
+        MetaImageImporter._create(self, item)
+        if item.title == 'wide':
+            raise ValueError('wide')
+
+
+class TestImportRollback(TransactionTestCase):
+    """
+    Files stored for a batch that's rolled back are deleted, rather
+    than left behind with copies stored when it's retried.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        self.import_dir = tempfile.mkdtemp()
+        for filename, size in (('red_square.png', (10, 10)),
+                               ('wide.png', (30, 10))):
+            image_file = open(os.path.join(self.import_dir, filename), 'wb')
+            image_file.write(make_image_data(size=size))
+            image_file.close()
+
+    def test_rollback(self):
+        importer = FailingImporter(self.foo, num_workers=1, batch_size=2)
+        report = importer.run(read_directory(self.import_dir))
+        self.assertEqual(report.imported, 1)
+        stored = []
+        for dirpath, dirnames, filenames in os.walk(
+                os.path.join(settings.MEDIA_ROOT, METAIMAGE_DIR)):
+            if 'cache' in dirnames:
+                dirnames.remove('cache')
+            stored.extend(filenames)
+        self.assertEqual(
+            stored, [os.path.basename(blob.name)
+                     for blob in ImageBlob.objects.all()])
+
+    def tearDown(self):
+        shutil.rmtree(self.import_dir)
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestQueryCounts(TestCase):
+    """
+    Listing MetaImages should take the same number of queries however
+    many there are.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        self.client = Client()
+        self.client.login(username='foo', password='bar')
+        self.add_metaimages(3)
+
+    def add_metaimages(self, count):
+        for i in range(count):
+            the_metaimage = MetaImage(title='Chart', creator=self.foo)
+            the_metaimage.save(image_data=make_image_data(size=(10 + i, 10)))
+            the_metaimage.tags.add('chart', 'test')
+
+    def count_queries(self, func):
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        reset_queries()
+        try:
+            func()
+            return len(connection.queries)
+        finally:
+            settings.DEBUG = old_debug
+
+    def test_feed_views(self):
+        for url in (reverse('show_metaimages'),
+                    reverse('your_metaimages'),
+                    reverse('show_user_metaimages', args=('foo',))):
+            self.client.get(url)
+            queries = self.count_queries(lambda: self.client.get(url))
+            self.add_metaimages(3)
+            self.assertEqual(
+                self.count_queries(lambda: self.client.get(url)), queries)
+
+    def test_tag_lists(self):
+        metaimage_admin = MetaImageAdmin(MetaImage, admin.site)
+        ContentType.objects.get_for_model(MetaImage)
+        def list_tags():
+            for metaimage in MetaImage.objects.with_tags():
+                self.assertEqual(metaimage_admin.the_tags(metaimage),
+                                 'chart, test')
+        # One for the MetaImages, one for all their tags:
+        self.assertEqual(self.count_queries(list_tags), 2)
+
+    def tearDown(self):
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestKeysetPagination(TestCase):
+    """
+    Paging through feeds by (created, id) cursors.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        for i in range(5):
+            the_metaimage = MetaImage(title='Chart %s' % i, creator=self.foo)
+            the_metaimage.save(image_data=make_image_data(size=(10 + i, 10)))
+        # Pages must split cleanly even between images created at the
+        # same moment:
+        MetaImage.objects.filter(title__in=('Chart 1', 'Chart 2', 'Chart 3')
+                                 ).update(created=datetime(2011, 2, 1, 12))
+
+    def test_pages(self):
+        titles = []
+        page = keyset_page(MetaImage.objects.all(), per_page=2)
+        while True:
+            titles.extend([metaimage.title for metaimage in page])
+            if not page.has_next:
+                break
+            page = keyset_page(
+                MetaImage.objects.all(), page.next_cursor, per_page=2)
+        self.assertEqual(
+            titles,
+            [metaimage.title for metaimage
+             in MetaImage.objects.order_by('-created', '-id')])
+
+    def test_feed_view(self):
+        client = Client()
+        client.login(username='foo', password='bar')
+        response = client.get(reverse('your_metaimages'))
+        self.assertEqual(len(response.context['metaimages']), 5)
+        assert not response.context['page'].has_next
+        response = client.get(reverse('your_metaimages'), {'before': 'junk'})
+        self.assertEqual(response.status_code, 404)
+
+    def tearDown(self):
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestConditionalViews(TestCase):
+    """
+    ETags, Last-Modified and 304 responses from the details and feed
+    views.
+    """
+
+    def setUp(self):
+        self.foo = User.objects.create_user('foo', 'foo@test.com', 'bar')
+        self.baz = User.objects.create_user('baz', 'baz@test.com', 'bar')
+        self.client = Client()
+        self.client.login(username='foo', password='bar')
+        self.the_metaimage = MetaImage(title='Chart', creator=self.foo)
+        self.the_metaimage.save(image_data=make_image_data())
+
+    def test_details(self):
+        url = reverse('metaimage_details', args=(self.the_metaimage.id,))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        assert 'private' in response['Cache-Control']
+        assert 'Cookie' in response['Vary']
+        response = self.client.get(
+            url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        etag = response['ETag']
+        self.the_metaimage.title = 'Renamed chart'
+        self.the_metaimage.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        # Another user gets a different ETag for the same image:
+        client = Client()
+        client.login(username='baz', password='bar')
+        assert client.get(url)['ETag'] != response['ETag']
+
+    def test_private_details(self):
+        self.the_metaimage.privacy = 2
+        self.the_metaimage.save()
+        client = Client()
+        client.login(username='baz', password='bar')
+        response = client.get(
+            reverse('metaimage_details', args=(self.the_metaimage.id,)))
+        self.assertEqual(response.status_code, 404)
+        assert not response.has_header('ETag')
+
+    def test_feed(self):
+        url = reverse('show_metaimages')
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        the_metaimage = MetaImage(title='Another chart', creator=self.baz)
+        the_metaimage.save(image_data=make_image_data(size=(20, 20)))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def tearDown(self):
+        shutil.rmtree(METAIMAGE_DIR, ignore_errors=True)
+
+
+class TestBenchmarkSuite(TestCase):
+    """
+    The timing and comparison parts of the benchmark suite; the
+    benchmarks themselves are run with the metaimage_benchmark command.
+    """
+
+    def test_measure(self):
+        calls = []
+        result = measure(lambda: calls.append(1), number=3, repeat=2)
+        self.assertEqual(len(calls), 6)
+        self.assertEqual(result['calls'], 6)
+        self.assertTrue(0 <= result['min'] <= result['median'])
+
+    def test_compare_results(self):
+        baseline = {'results': {
+            'render.thumbnail': {'median': 0.010},
+            'save.upload': {'median': 0.100},
+            'feed.10.first_page': {'median': 0.050}}}
+        results = {'results': {
+            'render.thumbnail': {'median': 0.011},
+            'save.upload': {'median': 0.200},
+            'feed.1000.first_page': {'median': 0.070}}}
+        comparisons = compare_results(results, baseline, tolerance=0.25)
+        self.assertEqual([name for name, ratio, regressed in comparisons],
+                         ['render.thumbnail', 'save.upload'])
+        self.assertEqual([regressed for name, ratio, regressed in comparisons],
+                         [False, True])
+        self.assertAlmostEqual(comparisons[1][1], 2.0)
+
+
 class TestViews(TestCase):
     """
     Tests of metaimage/views.py module.
@@ -6,6 +6,8 @@ urlpatterns = patterns('',
         name="show_metaimages"),
     url(r'^details/(?P<id>\d+)/$', 'metaimage.views.metaimage_details',
         name="metaimage_details"),
+    url(r'^status/(?P<id>\d+)/$', 'metaimage.views.metaimage_status',
+        name="metaimage_status"),
     url(r'^edit/(?P<id>\d+)/$', 'metaimage.views.edit_metaimage',
         name='edit_metaimage'),
     url(r'^upload/$', 'metaimage.views.upload_metaimage',
@@ -0,0 +1,63 @@
+"""Encoding PIL images in the formats renditions may be served in.
+
+No Django here, so that the byte-size benchmark can use it on its own.
+"""
+
+from cStringIO import StringIO
+
+from PIL import Image, ImageFile
+
+
+FORMAT_EXTENSIONS = {
+    'JPEG': 'jpg',
+    'WEBP': 'webp',
+    'PNG': 'png',
+    'GIF': 'gif'}
+FORMAT_MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'WEBP': 'image/webp',
+    'PNG': 'image/png',
+    'GIF': 'image/gif'}
+
+
+def format_supported(format):
+    """Whether this PIL build can write format, e.g. "WEBP"."""
+    Image.init()
+    return format in Image.SAVE
+
+
+def convert_for(im, format):
+    """Return im in a mode that format can store."""
+    if format == 'JPEG' and im.mode not in ('RGB', 'L', 'CMYK'):
+        return im.convert('RGB')
+    if format == 'WEBP' and im.mode not in ('RGB', 'RGBA'):
+        if im.mode == 'P' and 'transparency' in im.info or im.mode == 'LA':
+            return im.convert('RGBA')
+        return im.convert('RGB')
+    return im
+
+
+def save_image(im, fp, format, quality=75, progressive=True):
+    """Save im to fp (a filename or file object) as format; JPEGs are
+    written with optimized Huffman tables, and progressive unless
+    progressive=False.
+    """
+    im = convert_for(im, format)
+    if format == 'JPEG':
+        # PIL needs a buffer big enough for the whole image to write
+        # optimized or progressive JPEGs:
+        ImageFile.MAXBLOCK = max(ImageFile.MAXBLOCK,
+                                 im.size[0] * im.size[1] * 4)
+        im.save(fp, 'JPEG', quality=int(quality), optimize=True,
+                progressive=progressive)
+    elif format == 'WEBP':
+        im.save(fp, 'WEBP', quality=int(quality))
+    else:
+        im.save(fp, format)
+
+
+def encode_image(im, format, quality=75, progressive=True):
+    """Return the bytes of im saved as format; see save_image()."""
+    out = StringIO()
+    save_image(im, out, format, quality, progressive)
+    return out.getvalue()
@@ -0,0 +1,115 @@
+"""Reading the EXIF data of an already opened PIL image into plain,
+JSON-serializable values, with the few fields worth indexing picked out.
+"""
+
+from datetime import datetime
+
+from PIL import ExifTags
+
+
+# Binary or bulky tags, not worth keeping:
+SKIPPED_TAGS = frozenset([
+    'MakerNote', 'UserComment', 'PrintImageMatching', 'ComponentsConfiguration',
+    'FileSource', 'SceneType', 'CFAPattern', 'DeviceSettingDescription',
+    'ExifOffset', 'ExifInteroperabilityOffset', 'JPEGThumbnail',
+    # Where the photo was taken isn't for publishing along with it:
+    'GPSInfo'])
+# Tags of the RATIONAL and SRATIONAL types, whose (numerator,
+# denominator) pairs are read as numbers.  Older PILs give all values
+# as tuples, without their types, and a pair of SHORTs (such as
+# YCbCrSubSampling) looks just the same:
+RATIONAL_TAGS = frozenset([
+    'XResolution', 'YResolution', 'WhitePoint', 'PrimaryChromaticities',
+    'YCbCrCoefficients', 'ReferenceBlackWhite', 'ExposureTime', 'FNumber',
+    'CompressedBitsPerPixel', 'ShutterSpeedValue', 'ApertureValue',
+    'BrightnessValue', 'ExposureBiasValue', 'MaxApertureValue',
+    'SubjectDistance', 'FocalLength', 'FlashEnergy', 'FocalPlaneXResolution',
+    'FocalPlaneYResolution', 'ExposureIndex', 'DigitalZoomRatio', 'Gamma',
+    'LensSpecification'])
+MAX_VALUE_LENGTH = 256
+EXIF_DATETIME_FORMAT = '%Y:%m:%d %H:%M:%S'
+
+
+def _rational(value):
+    if hasattr(value, 'numerator'):
+        value = (value.numerator, value.denominator)
+    numerator, denominator = value
+    if not denominator:
+        return None
+    return round(float(numerator) / denominator, 6)
+
+
+def _plain_value(value, rational=False):
+    """value as a string, number or list of those, or None if it can't
+    be put simply.  Pairs of integers are taken as rationals only if
+    rational is true."""
+    if isinstance(value, str):
+        value = value.strip('\x00 ')
+        if len(value) > MAX_VALUE_LENGTH or '\x00' in value:
+            return None
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, unicode):
+        return len(value) <= MAX_VALUE_LENGTH and value.strip() or None
+    if isinstance(value, (int, long, float)):
+        return value
+    if hasattr(value, 'numerator'):
+        return _rational(value)
+    if isinstance(value, tuple):
+        if rational and len(value) == 2 and all(
+                [isinstance(part, (int, long)) for part in value]):
+            return _rational(value)
+        if len(value) <= 16:
+            values = [_plain_value(part, rational) for part in value]
+            if None not in values:
+                return values
+    return None
+
+
+def read_exif(image):
+    """Return a dict of EXIF tag name -> plain value for the PIL image
+    (only JPEGs and TIFFs have any); {} if there is none or it can't be
+    read."""
+    getexif = getattr(image, '_getexif', None)
+    if getexif is None:
+        return {}
+    try:
+        raw_exif = getexif() or {}
+    except Exception:
+        return {}
+    exif = {}
+    for tag, value in raw_exif.items():
+        name = ExifTags.TAGS.get(tag)
+        if name is None or name in SKIPPED_TAGS:
+            continue
+        value = _plain_value(value, name in RATIONAL_TAGS)
+        if value is not None and value != u'':
+            exif[name] = value
+    return exif
+
+
+def exif_camera(exif):
+    """The camera's make and model, e.g. u'Canon EOS 5D', or u''."""
+    make = unicode(exif.get('Make', '')).strip()
+    model = unicode(exif.get('Model', '')).strip()
+    # Models usually repeat the make, but not always:
+    if make and not model.lower().startswith(make.split()[0].lower()):
+        return (u'%s %s' % (make, model)).strip()
+    return model or make
+
+
+def exif_orientation(exif):
+    """The EXIF orientation, 1 to 8, or None."""
+    orientation = exif.get('Orientation')
+    if isinstance(orientation, (int, long)) and 1 <= orientation <= 8:
+        return orientation
+    return None
+
+
+def exif_date_taken(exif):
+    """When the photo was taken, as a datetime, or None."""
+    for name in ('DateTimeOriginal', 'DateTimeDigitized', 'DateTime'):
+        try:
+            return datetime.strptime(exif.get(name, ''), EXIF_DATETIME_FORMAT)
+        except (TypeError, ValueError):
+            continue
+    return None
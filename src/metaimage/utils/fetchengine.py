@@ -0,0 +1,188 @@
+"""A fetch engine for getting many URLs at once: fetch_many() fetches
+hundreds of URLs concurrently, from a pool of threads, while keeping to
+a global cap on fetches in flight and a (smaller) cap per host, so that
+no one site is hammered.  Failed attempts - network errors, and the
+status codes in RETRY_STATUSES - are retried after an exponential
+backoff with full jitter, rather than a fixed delay, so that many
+fetches failing together don't all retry together.
+
+The results have the same shape as utils.openanything.fetch()'s
+(data, etag, lastmodified, url and status; {} if every attempt
+failed).  FetchEngine.fetch() and fetch_to_file() fetch one URL, under
+the same caps, for code that works a URL at a time, such as
+MetaImage.save().
+
+An engine can be given a breaker, to turn away fetches of URLs (or
+hosts) that have been failing; see metaimage/failures.py.
+"""
+
+import random
+import threading
+from time import sleep
+import urlparse
+
+from openanything import default_fetcher, fetch_to_file, FETCH_MAX_SIZE, \
+     FETCH_RETRY_NUM
+from timing import clock, NULL_TIMER
+from workers import run_in_threads
+
+
+FETCH_MAX_CONCURRENCY = 32  # fetches in flight at once, in all
+FETCH_PER_HOST = 4  # fetches in flight at once, per host
+FETCH_BACKOFF_BASE = 0.5  # seconds
+FETCH_BACKOFF_MAX = 30.0  # seconds
+# Responses worth another try, as the server may well be better soon:
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class FetchUnavailable(Exception):
+    """Raised instead of fetching a URL that the engine's breaker says
+    is failing."""
+    pass
+
+
+class FetchEngine(object):
+    """Fetches URLs with at most max_concurrency fetches in flight, and
+    at most per_host to any one host, retrying each up to
+    retry_attempts times in all.  Before the nth retry it waits a
+    random time between 0 and backoff_base * 2 ** (n - 1) seconds,
+    at most backoff_max.  Connections are made with fetcher, a
+    Fetcher, by default openanything's default_fetcher.  Safe to share
+    between threads.
+
+    breaker, if given, has a check(url) method, returning None if url
+    can be fetched or otherwise why not, which is called before each
+    fetch; and record(url, result), called with each fetch's final
+    result.  A fetch that check() turns away raises FetchUnavailable.
+    """
+
+    def __init__(self, max_concurrency=FETCH_MAX_CONCURRENCY, per_host=FETCH_PER_HOST, retry_attempts=FETCH_RETRY_NUM, backoff_base=FETCH_BACKOFF_BASE, backoff_max=FETCH_BACKOFF_MAX, fetcher=None, breaker=None):
+        self.max_concurrency = max_concurrency
+        self.per_host = per_host
+        self.retry_attempts = retry_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.fetcher = fetcher or default_fetcher
+        self.breaker = breaker
+        self.random = random.Random()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._host_slots = {}
+        self._lock = threading.Lock()
+
+    def _get_host_slots(self, source):
+        parsed_url = urlparse.urlsplit(source)
+        if parsed_url.scheme.lower() not in ('http', 'https'):
+            return None
+        host = (parsed_url.hostname, parsed_url.port)
+        self._lock.acquire()
+        try:
+            slots = self._host_slots.get(host)
+            if slots is None:
+                slots = self._host_slots[host] = threading.BoundedSemaphore(
+                    self.per_host)
+            return slots
+        finally:
+            self._lock.release()
+
+    def backoff(self, retry_num):
+        """Seconds to wait before retry number retry_num (from 1)."""
+        return self.random.uniform(0, min(
+            self.backoff_max, self.backoff_base * 2 ** (retry_num - 1)))
+
+    def _attempt(self, source, host_slots, kwargs):
+        # The host's slot is taken first, so that fetches waiting on a
+        # busy host don't hold on to global slots meanwhile:
+        if host_slots is not None:
+            host_slots.acquire()
+        try:
+            self._slots.acquire()
+            try:
+                return fetch_to_file(source, retry_attempts=1,
+                                     fetcher=self.fetcher, **kwargs)
+            finally:
+                self._slots.release()
+        finally:
+            if host_slots is not None:
+                host_slots.release()
+
+    def fetch_to_file(self, source, etag=None, lastmodified=None, timer=NULL_TIMER, timeouts=None, **kwargs):
+        """As openanything.fetch_to_file(), retrying with backoff; once
+        every attempt has failed, or there is no time left before the
+        deadline of timeouts (a FetchTimeouts, by default the
+        fetcher's) for another, gives the last result (which may be an
+        error response) or {}.  Time spent backing off is timed as
+        timer's retry_wait phase.
+        """
+        if self.breaker is not None:
+            reason = self.breaker.check(source)
+            if reason is not None:
+                raise FetchUnavailable(reason)
+        host_slots = self._get_host_slots(source)
+        timeouts = (timeouts or self.fetcher.timeouts).start()
+        kwargs.update(etag=etag, lastmodified=lastmodified, timer=timer,
+                      timeouts=timeouts)
+        result = self._attempt(source, host_slots, kwargs)
+        for retry_num in range(1, self.retry_attempts):
+            if result and result.get('status') not in RETRY_STATUSES:
+                break
+            delay = self.backoff(retry_num)
+            remaining = timeouts.remaining()
+            if remaining is not None and remaining <= delay:
+                break
+            if 'file' in result:
+                result['file'].close()
+            started = clock()
+            sleep(delay)
+            timer.add('retry_wait', clock() - started)
+            result = self._attempt(source, host_slots, kwargs)
+        if self.breaker is not None:
+            self.breaker.record(source, result)
+        return result
+
+    def fetch(self, source, etag=None, lastmodified=None, max_size=FETCH_MAX_SIZE, **kwargs):
+        """As openanything.fetch(), retrying with backoff."""
+        # Everything fits in memory anyway, so don't spool to disk:
+        result = self.fetch_to_file(source, etag, lastmodified,
+                                    max_size=max_size, spool_size=max_size,
+                                    **kwargs)
+        if 'file' in result:
+            f = result.pop('file')
+            result['data'] = f.read()
+            f.close()
+            del result['size']
+        return result
+
+    def fetch_many(self, sources, on_result=None, **kwargs):
+        """Fetch every URL in sources, concurrently, returning a dict of
+        URL -> fetch() result; kwargs are passed on to fetch().  If
+        on_result(url, result) is given, it is called with each result
+        as it comes in (from one thread at a time), and the results
+        aren't kept.
+        """
+        results = {}
+
+        def fetch_one(source):
+            return self.fetch(source, **kwargs)
+
+        def fetched(source, result, exc_info):
+            if exc_info is not None:
+                result = {}
+            if on_result is not None:
+                on_result(source, result)
+            else:
+                results[source] = result
+
+        run_in_threads(fetch_one, sources, self.max_concurrency,
+                       on_result=fetched)
+        return results
+
+
+default_engine = FetchEngine()
+
+
+def fetch_many(sources, engine=None, **kwargs):
+    """Fetch every URL in sources concurrently, with engine, a
+    FetchEngine, or the shared default_engine; see
+    FetchEngine.fetch_many().
+    """
+    return (engine or default_engine).fetch_many(sources, **kwargs)
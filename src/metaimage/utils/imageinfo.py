@@ -0,0 +1,96 @@
+"""Cheap checks on image data that don't need PIL, e.g. to reject a
+download from its first few bytes.
+"""
+
+import hashlib
+import struct
+
+# Leading bytes of the image formats we expect to be given, and the
+# PIL format name for each:
+IMAGE_SIGNATURES = (
+    ('\x89PNG\r\n\x1a\n', 'PNG'),
+    ('\xff\xd8\xff', 'JPEG'),
+    ('GIF87a', 'GIF'),
+    ('GIF89a', 'GIF'),
+    ('BM', 'BMP'),
+    ('II*\x00', 'TIFF'),
+    ('MM\x00*', 'TIFF'),
+    ('\x00\x00\x01\x00', 'ICO'),
+    )
+# How many leading bytes sniff_image_format() wants to see:
+SNIFF_SIZE = 16
+# How far into the data sniff_image_size() can be worth trying; a JPEG
+# can have a lot of EXIF data (and a thumbnail) before its size:
+SIZE_SNIFF_LIMIT = 131072
+# The JPEG start-of-frame markers, which give the image size:
+JPEG_SOF_MARKERS = frozenset([0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7,
+                              0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf])
+
+
+def sniff_image_format(header):
+    """Return the PIL format name for data beginning with header, or
+    None if it does not look like an image at all.
+    """
+    for signature, format in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return format
+    if header[:4] == 'RIFF' and header[8:12] == 'WEBP':
+        return 'WEBP'
+    return None
+
+
+def _jpeg_size(data):
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != '\xff':
+            return None
+        marker = ord(data[offset + 1])
+        if marker == 0xff:
+            # Fill byte
+            offset += 1
+            continue
+        if marker == 0x01 or 0xd0 <= marker <= 0xd9:
+            # Markers without a length
+            offset += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + struct.unpack('>H', data[offset + 2:offset + 4])[0]
+    return None
+
+
+def sniff_image_size(header):
+    """Return the (width, height) of a PNG, GIF, BMP or JPEG image
+    whose data begins with header, or None if they aren't in header
+    (or it isn't one of those), so that an image too big to decode can
+    be turned down before it has been downloaded.
+    """
+    format = sniff_image_format(header)
+    if format == 'PNG' and len(header) >= 24:
+        return struct.unpack('>II', header[16:24])
+    if format == 'GIF' and len(header) >= 10:
+        return struct.unpack('<HH', header[6:10])
+    if format == 'BMP' and len(header) >= 26:
+        width, height = struct.unpack('<ii', header[18:26])
+        return width, abs(height)
+    if format == 'JPEG':
+        return _jpeg_size(header)
+    return None
+
+
+def file_digest(the_file, chunk_size=65536):
+    """Return the hex SHA-256 digest of the_file's contents, reading it
+    a chunk at a time from the start, and leave it rewound.
+    """
+    the_file.seek(0)
+    digest = hashlib.sha256()
+    while True:
+        chunk = the_file.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+    the_file.seek(0)
+    return digest.hexdigest()
@@ -7,42 +7,299 @@ Code originally from Mark Pilgrim's book, Dive Into Python.
 """
 
 from cStringIO import StringIO
-import gzip
+import httplib
 import socket
+import sys
+import tempfile
+import threading
 from time import sleep
-import urllib2 
 import urlparse
+import zlib
+
+from imageinfo import sniff_image_size, SIZE_SNIFF_LIMIT
+from timing import clock, NULL_TIMER
 
 
 USER_AGENT = 'Test'
 FETCH_RETRY_NUM = 5
 FETCH_RETRY_DELAY = 1.2  # seconds
 FETCH_MAX_SIZE = 1048576  # 1 MB
-# Set global timeout
-timeout = 5  # seconds
-socket.setdefaulttimeout(timeout)
+FETCH_CHUNK_SIZE = 65536  # bytes read from the source at a time
+# fetch_to_file() keeps up to this much of the body in memory, the
+# rest goes to a temporary file on disk:
+FETCH_SPOOL_SIZE = 262144
+FETCH_POOL_SIZE = 4  # idle keep-alive connections kept per host
+FETCH_MAX_REDIRECTS = 5
+# Why fetch_to_file() turned a response down, in result['rejected']:
+REJECTED_TOO_LARGE = 'too large'
+REJECTED_CONTENT_TYPE = 'content type'
+REJECTED_HEADER = 'header'
+REJECTED_TOO_MANY_PIXELS = 'too many pixels'
+FETCH_CONNECT_TIMEOUT = 5  # seconds
+FETCH_READ_TIMEOUT = 10  # seconds
 
 
-class SmartRedirectHandler(urllib2.HTTPRedirectHandler):
-    def http_error_301(self, req, fp, code, msg, headers):
-        result = urllib2.HTTPRedirectHandler.http_error_301(self, req, fp, code, msg, headers)
-        result.status = code
-        return result
+class DeadlineExceeded(socket.timeout):
+    pass
 
-    def http_error_302(self, req, fp, code, msg, headers):
-        result = urllib2.HTTPRedirectHandler.http_error_302(self, req, fp, code, msg, headers)
-        result.status = code
-        return result
 
+class FetchTimeouts(object):
+    """The time limits of a fetch, in seconds, each of which can be
+    None for none: connect, to make each connection; read, for each
+    read from it (including waiting for the response headers); and
+    deadline, for the whole fetch - every attempt, redirect, wait
+    between retries and read of the body - counted from start().
 
-class DefaultErrorHandler(urllib2.HTTPDefaultErrorHandler):
-    def http_error_default(self, req, fp, code, msg, headers):
-        result = urllib2.HTTPError(req.get_full_url(), code, msg, headers, fp)
-        result.status = code
-        return result
+    These only apply to the sockets of the fetch itself, unlike
+    socket.setdefaulttimeout(), which would apply to every socket in
+    the process (database and cache connections included).
+    """
+
+    def __init__(self, connect=FETCH_CONNECT_TIMEOUT, read=FETCH_READ_TIMEOUT, deadline=None):
+        self.connect = connect
+        self.read = read
+        self.deadline = deadline
+        self.expires = None
+
+    def start(self):
+        """These timeouts, with the deadline counting from now; or, if
+        they have been started already, themselves."""
+        if self.expires is not None or self.deadline is None:
+            return self
+        timeouts = FetchTimeouts(self.connect, self.read, self.deadline)
+        timeouts.expires = clock() + self.deadline
+        return timeouts
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return self.expires - clock()
+
+    def expired(self):
+        return self.expires is not None and self.remaining() <= 0
+
+    def _limit(self, timeout):
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if remaining <= 0:
+            raise DeadlineExceeded('The fetch deadline has passed')
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+    def connect_timeout(self):
+        """The timeout for connecting now, or DeadlineExceeded."""
+        return self._limit(self.connect)
+
+    def read_timeout(self):
+        """The timeout for reading now, or DeadlineExceeded."""
+        return self._limit(self.read)
+
+
+DEFAULT_TIMEOUTS = FetchTimeouts()
+
+
+class PooledResponse(object):
+    """A response from Fetcher.open(), which looks enough like what
+    urllib2 returns (read, close, headers, url, status) for fetch().
+    Closing it once the body has been read hands the connection back
+    to the Fetcher's pool.
+    """
+
+    def __init__(self, fetcher, key, conn, response, url, status, timeouts=DEFAULT_TIMEOUTS):
+        self._fetcher = fetcher
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._timeouts = timeouts
+        self.headers = response.msg
+        self.url = url
+        self.status = status
+        self.code = response.status
+
+    def read(self, amt=None):
+        if self._timeouts.expires is not None:
+            # Each read has to finish by the deadline.  The response's
+            # own socket, as httplib has already closed the connection
+            # (leaving its sock None) of a response that will close:
+            sock = getattr(self._response.fp, '_sock', None)
+            if sock is not None:
+                sock.settimeout(self._timeouts.read_timeout())
+        if amt is None:
+            return self._response.read()
+        return self._response.read(amt)
+
+    def close(self):
+        if self._conn is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            # The whole body was read, so the connection is ready for
+            # another request.
+            self._fetcher._release(self._key, self._conn)
+        else:
+            self._response.close()
+            self._conn.close()
+        self._conn = None
+
+
+class Fetcher(object):
+    """Opens http and https URLs over persistent connections, keeping
+    up to pool_size idle keep-alive connections per host so that many
+    fetches from the same host don't each pay for a new TCP (and TLS)
+    handshake.  Safe to share between threads.
+
+    As urllib2 used to with Dive Into Python's SmartRedirectHandler
+    and DefaultErrorHandler, redirects are followed (with status set to
+    the redirect's code), and error responses are returned with their
+    status rather than raised.  Network errors, and timeouts, give
+    None.  timeouts, a FetchTimeouts, are the time limits of fetches
+    that don't give their own.
+    """
+
+    redirect_codes = (301, 302, 303, 307)
+
+    def __init__(self, pool_size=FETCH_POOL_SIZE, max_redirects=FETCH_MAX_REDIRECTS, agent=USER_AGENT, timeouts=DEFAULT_TIMEOUTS):
+        self.pool_size = pool_size
+        self.max_redirects = max_redirects
+        self.agent = agent
+        self.timeouts = timeouts
+        self.connections_opened = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, key):
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+            self.connections_opened += 1
+        finally:
+            self._lock.release()
+        scheme, host, port = key
+        if scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        return connection_class(host, port), False
+
+    def _release(self, key, conn):
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _send(self, conn, reused, path, headers, timer, timeouts):
+        if not reused:
+            # Connecting explicitly, rather than in request(), lets the
+            # DNS lookup and handshake be timed on their own:
+            started = clock()
+            conn.timeout = timeouts.connect_timeout()
+            conn.connect()
+            timer.add('connect', clock() - started)
+        conn.sock.settimeout(timeouts.read_timeout())
+        started = clock()
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        timer.add('response', clock() - started)
+        return response
+
+    def _request(self, key, path, headers, timer=NULL_TIMER, timeouts=DEFAULT_TIMEOUTS):
+        conn, reused = self._acquire(key)
+        try:
+            return conn, self._send(conn, reused, path, headers, timer,
+                                    timeouts)
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+        # The server had closed the idle connection; try a new one.
+        conn, reused = self._acquire_new(key)
+        try:
+            return conn, self._send(conn, reused, path, headers, timer,
+                                    timeouts)
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            raise
+
+    def _acquire_new(self, key):
+        # Any other idle connections to the host are likely stale too:
+        self._lock.acquire()
+        try:
+            stale = self._idle.pop(key, [])
+        finally:
+            self._lock.release()
+        for conn in stale:
+            conn.close()
+        return self._acquire(key)
+
+    def open(self, url, etag=None, lastmodified=None, agent=None, timer=NULL_TIMER, timeouts=None):
+        """Open url, returning a PooledResponse, or None on a network
+        error or timeout.  etag and lastmodified make the request
+        conditional, as for open_anything().  The time spent connecting
+        (new connections only) and waiting for the response headers is
+        added to timer's connect and response phases.  timeouts, a
+        FetchTimeouts, default to the Fetcher's.
+        """
+        timeouts = (timeouts or self.timeouts).start()
+        headers = {
+            'User-Agent': agent or self.agent,
+            'Accept-encoding': 'gzip'}
+        if lastmodified:
+            headers['If-Modified-Since'] = lastmodified
+        if etag:
+            headers['If-None-Match'] = etag
+        status = None
+        for redirect_num in range(self.max_redirects + 1):
+            parsed_url = urlparse.urlsplit(url)
+            scheme = parsed_url.scheme.lower()
+            if scheme not in ('http', 'https'):
+                return None
+            port = parsed_url.port or (scheme == 'https' and 443 or 80)
+            key = (scheme, parsed_url.hostname, port)
+            path = parsed_url.path or '/'
+            if parsed_url.query:
+                path += '?' + parsed_url.query
+            try:
+                conn, response = self._request(
+                    key, path, headers, timer, timeouts)
+            except (socket.error, httplib.HTTPException):
+                return None
+            result = PooledResponse(
+                self, key, conn, response, url, status or response.status,
+                timeouts)
+            location = response.getheader('location')
+            if response.status not in self.redirect_codes or not location:
+                return result
+            # Drain the redirect's body so its connection can be reused:
+            result.read()
+            result.close()
+            status = response.status
+            url = urlparse.urljoin(url, location)
+        return None
 
 
-def open_anything(source, etag=None, lastmodified=None, agent=USER_AGENT):
+default_fetcher = Fetcher()
+
+
+def open_anything(source, etag=None, lastmodified=None, agent=USER_AGENT, fetcher=None, timer=NULL_TIMER, timeouts=None):
     """URL, filename, or string --> stream
 
     This function lets you define parsers that take any input source
@@ -61,25 +318,19 @@ def open_anything(source, etag=None, lastmodified=None, agent=USER_AGENT):
 
     If the agent argument is supplied, it will be used as the value of a
     User-Agent request header.
+
+    URLs are opened with fetcher, a Fetcher, or by default with the
+    shared default_fetcher and its pool of keep-alive connections,
+    within timeouts (a FetchTimeouts; by default, the fetcher's), and
+    timed with timer, a utils.timing.PhaseTimer.
     """
     if hasattr(source, 'read'):
         return source
     if source == '-':
         return sys.stdin
-    if urlparse.urlparse(source)[0] == 'http':
-        # Open URL with urllib2
-        request = urllib2.Request(source)
-        request.add_header('User-Agent', agent)
-        if lastmodified:
-            request.add_header('If-Modified-Since', lastmodified)
-        if etag:
-            request.add_header('If-None-Match', etag)
-        request.add_header('Accept-encoding', 'gzip')
-        opener = urllib2.build_opener(SmartRedirectHandler(), DefaultErrorHandler())
-        try:
-            return opener.open(request)
-        except urllib2.URLError:
-            return None
+    if urlparse.urlparse(source)[0] in ('http', 'https'):
+        return (fetcher or default_fetcher).open(
+            source, etag, lastmodified, agent, timer, timeouts)
     # Try to open with native open function (if source is a filename)
     try:
         return open(source)
@@ -89,30 +340,218 @@ def open_anything(source, etag=None, lastmodified=None, agent=USER_AGENT):
     return StringIO(str(source))
 
 
-def fetch(source, etag=None, lastmodified=None, agent=USER_AGENT, retry_attempts=FETCH_RETRY_NUM, retry_delay=FETCH_RETRY_DELAY, max_size=FETCH_MAX_SIZE):
-    """Fetch data and metadata from a URL, file, stream, or string.
-    """
-    result = {}
-    attempt_num = 0
+def _open_with_retries(source, etag, lastmodified, agent, retry_attempts, retry_delay, fetcher, timer=NULL_TIMER, timeouts=DEFAULT_TIMEOUTS):
     f = None
+    attempt_num = 0
     while f is None and attempt_num < retry_attempts:
         if attempt_num > 0:
+            remaining = timeouts.remaining()
+            if remaining is not None and remaining <= retry_delay:
+                # No time left for another attempt.
+                break
+            started = clock()
             sleep(retry_delay)
+            timer.add('retry_wait', clock() - started)
         attempt_num += 1
-        f = open_anything(source, etag, lastmodified, agent)
-    result['data'] = f.read(max_size)
+        f = open_anything(source, etag, lastmodified, agent, fetcher, timer,
+                          timeouts)
+    return f
+
+
+def iter_body(f, gzipped=False, chunk_size=FETCH_CHUNK_SIZE, timer=NULL_TIMER):
+    """Yield the body of stream f in chunks of at most chunk_size bytes,
+    gunzipping as we go if gzipped is true.  Reading and gunzipping are
+    timed as timer's download and gunzip phases.
+    """
+    if gzipped:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        started = clock()
+        chunk = f.read(chunk_size)
+        timer.add('download', clock() - started, len(chunk))
+        if not chunk:
+            break
+        if not gzipped:
+            yield chunk
+            continue
+        # Limiting each decompress() call's output keeps a small
+        # compressed chunk from expanding into a huge string:
+        while chunk:
+            started = clock()
+            decoded = decompressor.decompress(chunk, chunk_size)
+            chunk = decompressor.unconsumed_tail
+            timer.add('gunzip', clock() - started, len(decoded))
+            if decoded:
+                yield decoded
+    if gzipped:
+        decoded = decompressor.flush()
+        if decoded:
+            yield decoded
+
+
+def content_type_accepted(content_type, accept_types):
+    """Whether a Content-Type header value starts with one of the
+    accept_types, e.g. ('image/',); a missing one is given the benefit
+    of the doubt.
+    """
+    if not content_type:
+        return True
+    content_type = content_type.split(';')[0].strip().lower()
+    for accept_type in accept_types:
+        if content_type.startswith(accept_type):
+            return True
+    return False
+
+
+def fetch_to_file(source, etag=None, lastmodified=None, agent=USER_AGENT, retry_attempts=FETCH_RETRY_NUM, retry_delay=FETCH_RETRY_DELAY, max_size=FETCH_MAX_SIZE, chunk_size=FETCH_CHUNK_SIZE, spool_size=FETCH_SPOOL_SIZE, check_header=None, header_size=16, fetcher=None, timer=NULL_TIMER, accept_types=None, max_pixels=None, timeouts=None):
+    """Fetch metadata like fetch(), but stream the (decoded) data into
+    result['file'], a spooled temporary file, rather than reading it
+    into a string.  At most max_size bytes are written, and only
+    spool_size of them are held in memory; result['size'] is the
+    number written.  If there was more, result['truncated'] is set.
+
+    A successful response is turned down as early as possible, with
+    result['rejected'] set to the reason instead of result['file']:
+
+    - REJECTED_TOO_LARGE, before reading the body, if its
+      Content-Length is over max_size;
+    - REJECTED_CONTENT_TYPE, before reading the body, if accept_types
+      is given and its Content-Type doesn't start with one of them;
+    - REJECTED_HEADER, if check_header is given, and returns a false
+      value when called with the first header_size bytes of the data;
+    - REJECTED_TOO_MANY_PIXELS, if max_pixels is given and the data
+      begins with an image (PNG, GIF, BMP or JPEG) bigger than that.
+
+    Error responses, and a 304 Not Modified (which gives an empty
+    file), aren't checked.
+
+    Each phase of the fetch - connect, response, retry_wait, download,
+    gunzip and spool (writing to the temporary file) - is timed with
+    timer, a utils.timing.PhaseTimer, if one is given.
+
+    URLs are fetched within timeouts, a FetchTimeouts, by default the
+    fetcher's; its deadline covers every attempt.  A network error or
+    timeout while reading the body gives {}, as if every attempt had
+    failed.
+    """
+    result = {}
+    timeouts = (timeouts or (fetcher or default_fetcher).timeouts).start()
+    f = _open_with_retries(
+        source, etag, lastmodified, agent, retry_attempts, retry_delay,
+        fetcher, timer, timeouts)
+    if f is None:
+        # Every attempt failed; callers check for an empty result.
+        return result
+    gzipped = False
     if hasattr(f, 'headers'):
         # save ETag, if the server sent one
         result['etag'] = f.headers.get('ETag')
         # save Last-Modified header, if the server sent one
         result['lastmodified'] = f.headers.get('Last-Modified')
-        if f.headers.get('content-encoding') == 'gzip':
-            # data came back gzip-compressed, decompress it
-            result['data'] = gzip.GzipFile(fileobj=StringIO(result['data'])).read()
+        gzipped = f.headers.get('content-encoding') == 'gzip'
     if hasattr(f, 'url'):
         result['url'] = f.url
         result['status'] = 200
     if hasattr(f, 'status'):
         result['status'] = f.status
-    f.close()
+    if not 200 <= getattr(f, 'code', result.get('status', 200)) < 300:
+        # Nothing of the caller's to check.
+        check_header = accept_types = max_pixels = None
+    rejected = None
+    if hasattr(f, 'headers'):
+        rejected = _check_headers(f.headers, gzipped, max_size, accept_types)
+    if rejected is not None:
+        f.close()
+        result['rejected'] = rejected
+        return result
+    out = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    size = 0
+    header = ''
+    sniffing = max_pixels is not None
+    # How much of the start of the data to keep for checking:
+    header_limit = sniffing and max(header_size, SIZE_SNIFF_LIMIT) \
+                   or header_size
+    try:
+        for chunk in iter_body(f, gzipped, chunk_size, timer):
+            if size >= max_size:
+                # A gzip bomb, or simply a file too big, is cut short
+                # here without the rest being read, let alone decoded.
+                result['truncated'] = True
+                break
+            if len(chunk) > max_size - size:
+                chunk = chunk[:max_size - size]
+                result['truncated'] = True
+            if (check_header is not None and len(header) < header_size) \
+                   or sniffing:
+                header += chunk[:header_limit - len(header)]
+                rejected = _check_start(header, check_header, header_size,
+                                        max_pixels, sniffing)
+                if rejected is not None:
+                    break
+                sniffing = sniffing and sniff_image_size(header) is None \
+                           and len(header) < SIZE_SNIFF_LIMIT
+            started = clock()
+            out.write(chunk)
+            timer.add('spool', clock() - started, len(chunk))
+            size += len(chunk)
+            if result.get('truncated'):
+                break
+        else:
+            # A body shorter than header_size still gets checked:
+            if check_header is not None and len(header) < header_size \
+                   and not check_header(header):
+                rejected = REJECTED_HEADER
+    except (socket.error, httplib.HTTPException):
+        out.close()
+        return {}
+    finally:
+        f.close()
+    if rejected is not None:
+        out.close()
+        result.pop('truncated', None)
+        result['rejected'] = rejected
+        return result
+    out.seek(0)
+    result['file'] = out
+    result['size'] = size
+    return result
+
+
+def _check_headers(headers, gzipped, max_size, accept_types):
+    content_length = headers.get('content-length', '')
+    if not gzipped and content_length.isdigit() \
+           and int(content_length) > max_size:
+        return REJECTED_TOO_LARGE
+    if accept_types is not None and not content_type_accepted(
+            headers.get('content-type'), accept_types):
+        return REJECTED_CONTENT_TYPE
+    return None
+
+
+def _check_start(header, check_header, header_size, max_pixels, sniffing):
+    if check_header is not None and len(header) >= header_size \
+           and not check_header(header[:header_size]):
+        return REJECTED_HEADER
+    if sniffing:
+        image_size = sniff_image_size(header)
+        if image_size is not None \
+               and image_size[0] * image_size[1] > max_pixels:
+            return REJECTED_TOO_MANY_PIXELS
+    return None
+
+
+def fetch(source, etag=None, lastmodified=None, agent=USER_AGENT, retry_attempts=FETCH_RETRY_NUM, retry_delay=FETCH_RETRY_DELAY, max_size=FETCH_MAX_SIZE, fetcher=None, timeouts=None):
+    """Fetch data and metadata from a URL, file, stream, or string.
+    At most max_size bytes of data are read; if there was more,
+    result['truncated'] is set.
+    """
+    # Everything fits in memory anyway, so don't spool to disk:
+    result = fetch_to_file(source, etag, lastmodified, agent, retry_attempts,
+                           retry_delay, max_size, spool_size=max_size,
+                           fetcher=fetcher, timeouts=timeouts)
+    if 'file' in result:
+        f = result.pop('file')
+        result['data'] = f.read()
+        f.close()
+        del result['size']
     return result
@@ -0,0 +1,95 @@
+"""A small local HTTP/1.1 server, serving canned responses, so that
+the fetching code can be tested and benchmarked without going out to
+the Internet.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import socket
+import threading
+import time
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep connections alive:
+    protocol_version = 'HTTP/1.1'
+    # Buffer each response (it is flushed after every request), so the
+    # headers don't go out as many small packets:
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.protocol_version = self.server.protocol_version
+        # As real web servers do, don't let Nagle's algorithm hold back
+        # the tail of a response on a kept-alive connection:
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.count('connections')
+        if self.server.connect_delay:
+            time.sleep(self.server.connect_delay)
+
+    def do_GET(self):
+        self.server.count('requests')
+        route = self.server.routes.get(self.path.split('?')[0])
+        if route is None:
+            status, headers, body = 404, {'Content-Type': 'text/plain'}, 'Not found'
+        else:
+            status, headers, body = route
+        etag = headers.get('ETag')
+        if etag and self.headers.get('If-None-Match') == etag:
+            status, body = 304, ''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubHTTPServer(ThreadingMixIn, HTTPServer):
+    """Serves routes, a dict of path -> (status, headers, body), on a
+    free port of 127.0.0.1, from a background thread.  A response with
+    an ETag header is answered with a 304 when the request's
+    If-None-Match matches it.  The connections and requests attributes
+    count what has been received.
+
+    connect_delay, in seconds, is added to the start of every new
+    connection, to stand in for the round trips of a TCP/TLS handshake
+    with a remote host.  protocol_version 'HTTP/1.0' makes it close
+    each connection after one response, as older servers do.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, routes=None, connect_delay=0,
+                 protocol_version='HTTP/1.1'):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubRequestHandler)
+        self.routes = routes or {}
+        self.connect_delay = connect_delay
+        self.protocol_version = protocol_version
+        self.connections = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def count(self, name):
+        self._lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self._lock.release()
+
+    def url(self, path='/'):
+        return 'http://127.0.0.1:%s%s' % (self.server_address[1], path)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
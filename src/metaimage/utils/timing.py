@@ -0,0 +1,54 @@
+"""Phase timers: the time taken, and bytes handled, by each named phase
+of a piece of work, e.g. the connect, download and gunzip phases of a
+fetch.  Code being timed calls timer.add() with each measurement; when
+nothing is being timed it is given NULL_TIMER, whose add() does
+nothing, so the cost is a couple of clock() calls per phase.
+"""
+
+import time
+
+
+clock = time.time
+
+
+class PhaseTimer(object):
+    """Adds up the seconds, bytes and number of times of each phase,
+    remembering the order the phases first came in."""
+
+    enabled = True
+
+    def __init__(self):
+        self.started = clock()
+        self.phases = {}
+        self.order = []
+
+    def add(self, name, seconds, nbytes=0):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = [0.0, 0, 0]
+            self.order.append(name)
+        phase[0] += seconds
+        phase[1] += nbytes
+        phase[2] += 1
+
+    def seconds(self, name):
+        return self.phases.get(name, (0.0,))[0]
+
+    def elapsed(self):
+        return clock() - self.started
+
+    def as_list(self):
+        """A list of (name, seconds, bytes, count) of each phase."""
+        return [(name,) + tuple(self.phases[name]) for name in self.order]
+
+
+class NullTimer(PhaseTimer):
+    """A PhaseTimer that doesn't keep anything."""
+
+    enabled = False
+
+    def add(self, name, seconds, nbytes=0):
+        pass
+
+
+NULL_TIMER = NullTimer()
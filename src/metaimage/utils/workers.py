@@ -0,0 +1,60 @@
+"""A minimal pool of threads, for running many independent, I/O-bound
+calls (such as fetching URLs) at once.
+"""
+
+import Queue
+import sys
+import threading
+
+
+_STOP = object()
+
+
+def run_in_threads(func, items, num_workers, on_result=None, on_exit=None):
+    """Call func(item) for every item in the iterable items, using
+    num_workers threads.  items is consumed lazily, so it can be a
+    long-running generator.
+
+    on_result(item, result, exc_info), if given, is called after each
+    call, from one worker thread at a time; exc_info is None, or the
+    sys.exc_info() of an exception that func raised.  on_exit(), if
+    given, is called by each worker thread just before it finishes.
+    """
+    work = Queue.Queue(num_workers * 2)
+    result_lock = threading.Lock()
+
+    def worker():
+        try:
+            while True:
+                item = work.get()
+                if item is _STOP:
+                    return
+                result, exc_info = None, None
+                try:
+                    result = func(item)
+                except Exception:
+                    exc_info = sys.exc_info()
+                if on_result is not None:
+                    result_lock.acquire()
+                    try:
+                        on_result(item, result, exc_info)
+                    finally:
+                        result_lock.release()
+        finally:
+            if on_exit is not None:
+                on_exit()
+
+    threads = []
+    for i in range(num_workers):
+        thread = threading.Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    try:
+        for item in items:
+            work.put(item)
+    finally:
+        for thread in threads:
+            work.put(_STOP)
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,83 @@
+"""
+Per-PhotoSize policies for the variants of each rendition: the same
+rendition encoded in other formats (e.g. WebP), and at higher pixel
+densities for high-DPI screens, from which browsers pick the smallest
+they can use via srcset and <picture>.
+
+Policies are set in settings.py by PhotoSize name, with "*" for the
+default, e.g.
+
+    METAIMAGE_RENDITION_POLICIES = {
+        '*': {'formats': ('WEBP',), 'quality': {'WEBP': 80}},
+        'width500': {'formats': ('WEBP', 'JPEG'), 'densities': (1, 2),
+                     'quality': {'WEBP': 78, 'JPEG': 80}},
+        }
+
+formats are the extra formats to encode each rendition in, besides
+that of its original; densities the pixel densities to make (1 is
+always made); quality the encoder quality per format, defaulting to
+the PhotoSize's quality; progressive whether JPEGs, including plain
+JPEG renditions, are written progressive (the default).  Formats that
+the installed PIL can't write are left out.
+"""
+import copy
+
+from django.conf import settings
+
+from metaimage.utils.encoding import format_supported
+
+
+RENDITION_POLICIES = getattr(settings, 'METAIMAGE_RENDITION_POLICIES', {})
+
+
+class RenditionPolicy(object):
+
+    def __init__(self, formats=(), densities=(1,), quality=None,
+                 progressive=True):
+        self.formats = tuple([format.upper() for format in formats
+                              if format_supported(format.upper())])
+        self.densities = tuple(sorted(set((1,) + tuple(densities))))
+        self.quality = quality or {}
+        self.progressive = progressive
+
+    def get_quality(self, format, photosize):
+        if isinstance(self.quality, dict):
+            return self.quality.get(format, photosize.quality)
+        return self.quality
+
+    def variants(self):
+        """
+        (format, density) of each variant, format None being that of
+        the original image, besides the plain rendition (None, 1).
+        """
+        return [(format, density)
+                for density in self.densities
+                for format in (None,) + self.formats
+                if (format, density) != (None, 1)]
+
+
+_policies = {}
+
+
+def get_policy(photosize):
+    """
+    The RenditionPolicy for photosize.
+    """
+    if photosize.name not in _policies:
+        options = RENDITION_POLICIES.get(
+            photosize.name, RENDITION_POLICIES.get('*', {}))
+        _policies[photosize.name] = RenditionPolicy(**options)
+    return _policies[photosize.name]
+
+
+def scale_photosize(photosize, density):
+    """
+    A copy of photosize (never to be saved) for density times as many
+    pixels each way.
+    """
+    if density == 1:
+        return photosize
+    scaled = copy.copy(photosize)
+    scaled.width = photosize.width * density
+    scaled.height = photosize.height * density
+    return scaled
@@ -3,37 +3,120 @@ from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
 from django.db.models import Q
 from django.http import Http404
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
+from django.utils import simplejson
 from django.utils.translation import ugettext_lazy as _
 
+from metaimage.conditional import conditional_page, make_etag
 from metaimage.models import MetaImage, PRIVACY_CHOICES
 from metaimage.forms import MetaImageUploadForm, MetaImageEditForm
+from metaimage.pagination import keyset_page, keyset_page_versions, \
+     InvalidCursor
 
 
 assert PRIVACY_CHOICES[0][0] == 1
 assert PRIVACY_CHOICES[0][1] == 'Public'
 PUBLIC_SETTING = PRIVACY_CHOICES[0][0]
+# Not shown in the feed templates, and potentially long:
+FEED_DEFERRED_FIELDS = ('caption', 'admin_notes')
+
+
+def feed_queryset(queryset):
+    """
+    Tune a queryset of MetaImages for listing: the creators come in the
+    same query, the tags in one query per batch (if asked for at all),
+    and the long text fields are left out.
+    """
+    return queryset.select_related('creator').defer(
+        *FEED_DEFERRED_FIELDS).with_tags()
+
+
+def render_feed(request, queryset, template_name, t_dict=None):
+    """
+    Render the page of queryset, newest first, after the cursor in
+    request.GET["before"] (or the first page).
+    """
+    try:
+        page = keyset_page(feed_queryset(queryset), request.GET.get("before"))
+    except InvalidCursor:
+        raise Http404
+    t_dict = dict(t_dict or {})
+    t_dict.update({
+        "metaimages": page.object_list,
+        "page": page})
+    return render_to_response(
+        template_name,
+        t_dict,
+        context_instance=RequestContext(request))
+
+
+def feed_validators(get_metaimages):
+    """
+    Returns a function giving the (etag, last_modified) of the page of
+    the feed get_metaimages(request, *args, **kwargs) that request asks
+    for, which changes whenever an image on it is added, changed or
+    removed.
+    """
+    def validators(request, *args, **kwargs):
+        cursor = request.GET.get("before")
+        try:
+            versions = keyset_page_versions(
+                get_metaimages(request, *args, **kwargs), cursor)
+        except InvalidCursor:
+            return None, None
+        last_modified = None
+        for pk, created, updated in versions:
+            last_modified = max(last_modified, created, updated)
+        return make_etag(request, cursor, versions), last_modified
+    return validators
+
+
+def details_validators(request, id, **kwargs):
+    """
+    The (etag, last_modified) of the details page of MetaImage id, or
+    (None, None) if it's not to be shown.
+    """
+    try:
+        creator_id, privacy, updated, ingest_status = \
+            MetaImage.objects.filter(pk=id).values_list(
+                'creator', 'privacy', 'updated', 'ingest_status')[0]
+    except IndexError:
+        return None, None
+    if updated is None or (
+            privacy != PUBLIC_SETTING and creator_id != request.user.id):
+        return None, None
+    return make_etag(request, id, updated, ingest_status), updated
+
+
+def latest_metaimages(request, **kwargs):
+    return MetaImage.objects.filter(
+        Q(privacy=PUBLIC_SETTING)
+        | Q(privacy__gt=PUBLIC_SETTING, creator=request.user))
+
+
+def own_metaimages(request, **kwargs):
+    return MetaImage.objects.filter(creator=request.user)
+
+
+def user_metaimages(request, username, **kwargs):
+    return MetaImage.objects.filter(
+        creator__username=username, privacy=PUBLIC_SETTING)
 
 
 @login_required
+@conditional_page(feed_validators(latest_metaimages))
 def show_metaimages(request, template_name="metaimage/latest.html"):
     """
     For an authenticated user only, show public and private images -
     most recent first.
     """
-    metaimages = MetaImage.objects.filter(
-        Q(privacy=PUBLIC_SETTING)
-        | Q(privacy__gt=PUBLIC_SETTING, creator=request.user)
-        ).order_by("-created")
-    return render_to_response(
-        template_name,
-        {"metaimages": metaimages},
-        context_instance=RequestContext(request))
+    return render_feed(request, latest_metaimages(request), template_name)
 
 
 @login_required
+@conditional_page(details_validators)
 def metaimage_details(request, id, template_name="metaimage/details.html"):
     """
     Show details for a MetaImage instance.
@@ -53,6 +136,27 @@ def metaimage_details(request, id, template_name="metaimage/details.html"):
         context_instance=RequestContext(request))
 
 
+@login_required
+def metaimage_status(request, id):
+    """
+    Report, as JSON, whether a MetaImage's image has been fetched yet;
+    pages showing a pending image's placeholder can poll this.
+    """
+    the_metaimage = get_object_or_404(MetaImage, id=id)
+    if not the_metaimage.privacy==PUBLIC_SETTING and the_metaimage.creator != request.user:
+        raise Http404
+    status_dct = {
+        "id": the_metaimage.id,
+        "ready": the_metaimage.is_ready,
+        "pending": the_metaimage.is_pending,
+        "failed": the_metaimage.is_failed}
+    if the_metaimage.is_ready:
+        status_dct["html"] = the_metaimage.render()
+    return HttpResponse(
+        simplejson.dumps(status_dct),
+        mimetype="application/json")
+
+
 @login_required
 def upload_metaimage(request, form_class=MetaImageUploadForm, template_name="metaimage/upload.html"):
     """
@@ -79,35 +183,29 @@ def upload_metaimage(request, form_class=MetaImageUploadForm, template_name="met
 
 
 @login_required
+@conditional_page(feed_validators(own_metaimages))
 def your_metaimages(request, template_name="metaimage/latest.html"):
     """
     Show MetaImages belonging to the currently authenticated user.
     """
-    metaimages = MetaImage.objects.filter(
-        creator=request.user).order_by("-created")
-    return render_to_response(
-        template_name,
-        {"metaimages": metaimages,
-         "page_title": _("Your Images")},
-        context_instance=RequestContext(request))
+    return render_feed(
+        request, own_metaimages(request), template_name,
+        {"page_title": _("Your Images")})
 
 
 @login_required
+@conditional_page(feed_validators(user_metaimages))
 def show_user_metaimages(request, username, template_name="metaimage/latest.html"):
     """
     Get a given user's public images, display them.
     """
     the_user = get_object_or_404(User, username=username)
     metaimages = MetaImage.objects.filter(
-        creator=the_user, privacy=PUBLIC_SETTING).order_by("-created")
+        creator=the_user, privacy=PUBLIC_SETTING)
     t_dict = {
-        "metaimages": metaimages,
         "page_title": _("Images by %s" % the_user.username),
         "the_user": the_user}
-    return render_to_response(
-        template_name,
-        t_dict,
-        context_instance=RequestContext(request))
+    return render_feed(request, metaimages, template_name, t_dict)
 
 
 @login_required